@@ -93,6 +93,28 @@ typedef structure {
 
 
 
+/*
+  KBase style object reference X/Y/Z to a KBaseGwasData.VariationShard reference
+    @id ws KBaseGwasData.VariationShard
+*/
+typedef string variation_shard_ref;
+
+/*
+    Entry of the shard directory of a Variations object
+    contig_id - contig of the variants in the shard
+    start - position of the first variant in the shard
+    end - position of the last variant in the shard
+    numvariants - number of variants in the shard
+    shard_ref - reference to the VariationShard object
+*/
+typedef structure {
+    string contig_id;
+    int start;
+    int end;
+    int numvariants;
+    variation_shard_ref shard_ref;
+} variation_shard_info;
+
 /*
     Variation object data structure
     num_genotypes - number of total genotypes within variant file
@@ -106,7 +128,12 @@ typedef structure {
     vcf_index_handle_ref - Handle reference to tabix indexed VCF index file
     genomic_indexes - List to store Linked index files for gff and fasta
     header - header from VCF
-    @optional genome_ref sample_attribute_ref genomic_indexes header
+    genotype_matrix_handle - Linked file with the genotypes of all samples as a
+        2 bit (or ploidy dependent) packed variants x samples numpy matrix
+    variation_shards - directory of the VariationShard objects that hold the
+        variant details when they do not fit in this object
+    @optional genome_ref sample_attribute_ref genomic_indexes header genotype_matrix_handle
+    @optional variation_shards
 */
 typedef structure {  
     int numgenotypes;
@@ -122,8 +149,24 @@ typedef structure {
     LinkedFile vcf_index_handle;
     list <LinkedFile> genomic_indexes;
     list <headerinfo> header;
+    LinkedFile genotype_matrix_handle;
+    list <variation_shard_info> variation_shards;
 } Variations;
 
+/*
+    Variant details of one region of a Variations object, in file order
+    contig_id, start, end, numvariants - same as in variation_shard_info
+    variation_details - one entry per variant with var ([contig, position, ref]),
+        alt_alleles and the optional annot and geno lists
+*/
+typedef structure {
+    string contig_id;
+    int start;
+    int end;
+    int numvariants;
+    list <UnspecifiedObject> variation_details;
+} VariationShard;
+
 
 /* 
   KBase style object reference X/Y/Z to a KBaseGwasData.Variations reference
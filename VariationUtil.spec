@@ -34,7 +34,10 @@ module VariationUtil {
 			sample_attribute_ref: x/y/z reference to kbase sample attribute
 			
         optional params:
-            NA
+            shard_size: save the variant details in VariationShard objects of at most
+                        this many variants (large files are sharded automatically)
+            genotype_track_samples: vcf sample names that get heterozygosity and
+                                    missing call rate tracks in the genome browser
 
         output report:
             report_name
@@ -53,6 +56,8 @@ module VariationUtil {
         filepath vcf_staging_file_path;
 		string variation_object_name;
 		obj_ref sample_attribute_ref;
+        int shard_size;
+        list<string> genotype_track_samples;
     } save_variation_input;
 
     typedef structure {
@@ -0,0 +1,143 @@
+import logging
+import re
+import struct
+import threading
+from array import array
+
+from VariationUtil.Util.DiskCache import DiskCache, DEFAULT_CACHE_SIZE
+
+# Only references with a version point to an object that can not change
+VERSIONED_REF = re.compile(r"^\d+/\d+/\d+$")
+
+
+class AssemblyContigs:
+    """
+    Contig ids and lengths of an assembly in the order of the assembly
+    object, lengths kept in a compact int64 array
+    """
+
+    def __init__(self, ids, lengths):
+        self.ids = tuple(ids)
+        self.lengths = array("q", lengths)
+        self._index = {contig_id: i for i, contig_id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, contig_id):
+        return contig_id in self._index
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def length(self, contig_id):
+        """
+        :raises KeyError: if the contig is not in the assembly
+        """
+        return self.lengths[self._index[contig_id]]
+
+    def items(self):
+        """
+        :return: (contig id, length) pairs
+        """
+        return zip(self.ids, self.lengths)
+
+    def to_bytes(self):
+        ids = "\0".join(self.ids).encode("utf-8")
+        return struct.pack("<Q", len(self.ids)) + self.lengths.tobytes() + ids
+
+    @classmethod
+    def from_bytes(cls, data):
+        n, = struct.unpack_from("<Q", data)
+        lengths = array("q")
+        lengths.frombytes(data[8:8 + 8 * n])
+        ids = data[8 + 8 * n:].decode("utf-8").split("\0") if n else []
+        return cls(ids, lengths)
+
+
+class AssemblyMetadata:
+    """
+    Contig ids and lengths of assemblies, fetched from the workspace
+    once per assembly and shared by the steps of one job:
+
+        contigs = AssemblyMetadata(wsc).contigs(assembly_ref)
+        if contig_id in contigs:
+            contigs.length(contig_id)
+
+    References are resolved to their ws/obj/ver form first, so a cached
+    entry always belongs to the object version the reference points to
+    now. The resolution goes through the workspace even for versioned
+    references: it checks that the user can read the object before the
+    contigs are served from the on-disk LRU cache (see DiskCache) that
+    jobs of all users share with cache_dir. An instance belongs to the
+    job (and the user) of wsc.
+    """
+
+    def __init__(self, wsc, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE):
+        self.wsc = wsc
+        self.cache = DiskCache(cache_dir, cache_size) if cache_dir else None
+        # reference -> ws/obj/ver reference, checked with the user of wsc
+        self._resolved = dict()
+        # ws/obj/ver reference -> AssemblyContigs
+        self._contigs = dict()
+        # ws/obj/ver reference -> lock held while its contigs are fetched
+        self._fetch_locks = dict()
+        self._lock = threading.Lock()
+
+    def resolve(self, assembly_ref):
+        """
+        :return: ws/obj/ver reference of the object assembly_ref points to
+        :raises: the workspace error if the user can not read the object
+        """
+        resolved = self._resolved.get(assembly_ref)
+        if resolved is None:
+            info = self.wsc.get_object_info3({
+                'objects': [{'ref': assembly_ref}]
+            })['infos'][0]
+            resolved = str(info[6]) + "/" + str(info[0]) + "/" + str(info[4])
+            with self._lock:
+                self._resolved[assembly_ref] = resolved
+        return resolved
+
+    def _fetch(self, assembly_ref):
+        logging.info("Fetching contigs of assembly " + assembly_ref)
+        contigs = self.wsc.get_object_subset([{
+            'included': ['/contigs'],
+            'ref': assembly_ref
+        }])[0]['data']['contigs']
+        return AssemblyContigs(contigs.keys(),
+                               [contig.get('length', 0) for contig in contigs.values()])
+
+    def _load(self, assembly_ref):
+        """
+        Contigs of a versioned reference from the disk cache or the workspace
+        """
+        key = "assembly_contigs:" + assembly_ref
+        if self.cache is not None:
+            data = self.cache.get(key)
+            if data is not None:
+                return AssemblyContigs.from_bytes(data)
+        contigs = self._fetch(assembly_ref)
+        if self.cache is not None:
+            self.cache.put(key, contigs.to_bytes())
+        return contigs
+
+    def contigs(self, assembly_ref):
+        """
+        :return: AssemblyContigs of the assembly
+        """
+        assembly_ref = self.resolve(assembly_ref)
+        with self._lock:
+            contigs = self._contigs.get(assembly_ref)
+            if contigs is not None:
+                return contigs
+            fetch_lock = self._fetch_locks.setdefault(assembly_ref, threading.Lock())
+
+        # other assemblies can be looked up while this one is fetched
+        with fetch_lock:
+            contigs = self._contigs.get(assembly_ref)
+            if contigs is None:
+                contigs = self._load(assembly_ref)
+                with self._lock:
+                    self._contigs[assembly_ref] = contigs
+            return contigs
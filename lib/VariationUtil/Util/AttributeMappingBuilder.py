@@ -0,0 +1,79 @@
+NODE_ATTRIBUTES = ('id', 'type', 'parent')
+
+
+def _attribute_key(attribute):
+    return tuple(sorted(attribute.items()))
+
+
+class AttributeMappingBuilder:
+    """
+    Builds the attributes and instances of a KBaseExperiments.AttributeMapping
+    from SampleService samples with one pass over their node trees:
+
+        builder = AttributeMappingBuilder(fetch_attributes)
+        for sample in samples:
+            builder.add_sample(sample)
+        am_data = builder.build()
+
+    Attributes are registered in an ordered dict; an attribute seen again
+    moves to the end, giving the order of the last occurrence of each
+    attribute. Each node is recorded with the metadata its values are read
+    from (meta_user if present, otherwise meta_controlled), and the
+    instance rows are emitted from those records once the attribute
+    columns are known.
+    """
+
+    def __init__(self, fetch_attributes):
+        """
+        :param fetch_attributes: function returning the attribute dicts of
+                                 a meta_controlled / meta_user mapping
+        """
+        self.fetch_attributes = fetch_attributes
+        self._attributes = dict()
+        self._samples = list()
+
+    def _register(self, meta):
+        for attribute in self.fetch_attributes(meta):
+            key = _attribute_key(attribute)
+            self._attributes.pop(key, None)
+            self._attributes[key] = attribute
+
+    def add_sample(self, sample_data):
+        nodes = list()
+        for node in sample_data.get('node_tree', [{}]):
+            meta_controlled = node.get('meta_controlled')
+            meta_user = node.get('meta_user')
+            if meta_controlled:
+                self._register(meta_controlled)
+            if meta_user:
+                self._register(meta_user)
+            nodes.append((node, meta_user or meta_controlled))
+        self._samples.append((sample_data['name'], nodes))
+
+    def attributes(self):
+        return [{'attribute': name, 'source': 'SampleService'} for name in NODE_ATTRIBUTES] \
+            + list(self._attributes.values())
+
+    def build(self):
+        """
+        :return: AttributeMapping data with ontology_mapping_method,
+                 attributes and instances
+        """
+        attributes = self.attributes()
+        columns = [(attribute['attribute'], attribute['attribute'] in NODE_ATTRIBUTES)
+                   for attribute in attributes]
+        instances = dict()
+        for name, nodes in self._samples:
+            instance = list()
+            for node, meta in nodes:
+                for column, from_node in columns:
+                    if from_node:
+                        instance.append(str(node.get(column)))
+                    elif meta:
+                        instance.append(str(meta.get(column, {}).get('value')))
+            instances[name] = instance
+        return {
+            'ontology_mapping_method': "SampleService",
+            'instances': instances,
+            'attributes': attributes
+        }
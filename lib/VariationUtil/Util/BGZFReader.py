@@ -0,0 +1,189 @@
+import gzip
+import io
+import logging
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+# Empty block that marks the end of a BGZF file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Number of threads used to inflate blocks when the caller does not ask
+# for a specific number
+DEFAULT_THREADS = os.cpu_count() or 1
+
+
+def read_bgzf_block(handle):
+    """
+    Reads one raw BGZF block from an open binary file handle
+    A BGZF block is a gzip member with a "BC" extra subfield holding
+    the total block size - 1 (BSIZE)
+    :param handle: binary file handle positioned at the start of a block
+    :return: (compressed deflate data, crc32, uncompressed size)
+             or None at end of file
+    """
+    header = handle.read(12)
+    if not header:
+        return None
+    if len(header) < 12 or header[:4] != BGZF_MAGIC:
+        raise ValueError("Not a valid BGZF block at offset "
+                         + str(handle.tell() - len(header)))
+    xlen = struct.unpack("<H", header[10:12])[0]
+    extra = handle.read(xlen)
+    bsize = None
+    pos = 0
+    while pos + 4 <= xlen:
+        slen = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+        if extra[pos:pos + 2] == b"BC" and slen == 2:
+            bsize = struct.unpack("<H", extra[pos + 4:pos + 6])[0]
+        pos += 4 + slen
+    if bsize is None:
+        raise ValueError("BGZF block without BC extra field")
+    cdata = handle.read(bsize - xlen - 19)
+    crc, isize = struct.unpack("<II", handle.read(8))
+    return cdata, crc, isize
+
+
+def inflate_bgzf_block(block):
+    """
+    Decompresses one block returned by read_bgzf_block
+    zlib releases the GIL while inflating, so this scales on threads
+    """
+    cdata, crc, isize = block
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise ValueError("Corrupted BGZF block, crc or size mismatch")
+    return data
+
+
+def is_bgzf_file(filepath):
+    """
+    Checks if the first gzip member of the file carries the BGZF "BC"
+    extra subfield
+    """
+    with open(filepath, "rb") as handle:
+        try:
+            return read_bgzf_block(handle) is not None
+        except (ValueError, struct.error):
+            return False
+
+
+def has_bgzf_eof(filepath):
+    """
+    Checks if the file ends with the BGZF end of file marker,
+    a missing marker usually means a truncated file
+    """
+    with open(filepath, "rb") as handle:
+        handle.seek(0, os.SEEK_END)
+        if handle.tell() < len(BGZF_EOF):
+            return False
+        handle.seek(-len(BGZF_EOF), os.SEEK_END)
+        return handle.read() == BGZF_EOF
+
+
+def is_valid_bgzf_file(filepath):
+    """
+    BGZF "BC" extra subfield in the first block and EOF marker at the end
+    """
+    return is_bgzf_file(filepath) and has_bgzf_eof(filepath)
+
+
+class BGZFReader:
+    """
+    Line iterator over a bgzipped file that inflates the independent
+    64 KB BGZF blocks on a thread pool and returns them in file order.
+    Files that are plain gzip (not BGZF) are read with gzip.open
+    on a single thread.
+
+    with BGZFReader(vcf_filepath, threads=4) as reader:
+        for record in reader:
+            ...
+
+    Lines are returned as text with the trailing newline, the same
+    way gzip.open(..., "rt") returns them.
+
+    start is a BGZF virtual offset (e.g. from a tabix index) to begin
+    reading from; the consumer decides where to stop.
+    """
+
+    def __init__(self, filepath, threads=None, start=0):
+        self.filepath = filepath
+        self.threads = threads or DEFAULT_THREADS
+        self.start = start
+        # Number of blocks that are read ahead of the consumer
+        self.prefetch = self.threads * 4
+        self._lines = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self._lines is None:
+            if is_bgzf_file(self.filepath):
+                self._lines = self._bgzf_lines()
+            elif self.start:
+                raise ValueError(self.filepath + " is not BGZF, can not seek")
+            else:
+                logging.info(self.filepath + " is not BGZF, reading with gzip")
+                self._lines = self._gzip_lines()
+        return self._lines
+
+    def close(self):
+        if self._lines is not None:
+            self._lines.close()
+
+    def _gzip_lines(self):
+        with gzip.open(self.filepath, "rt") as reader:
+            yield from reader
+
+    def blocks(self, with_offsets=False):
+        """
+        Generator of uncompressed blocks in file order
+        :param with_offsets: yield (compressed offset of the block, data)
+        """
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        pending = deque()
+        skip = self.start & 0xFFFF
+        try:
+            with open(self.filepath, "rb") as handle:
+                handle.seek(self.start >> 16)
+                while True:
+                    coffset = handle.tell()
+                    block = read_bgzf_block(handle)
+                    if block is not None:
+                        pending.append((coffset, executor.submit(inflate_bgzf_block, block)))
+                    if pending and (block is None or len(pending) >= self.prefetch):
+                        coffset, future = pending.popleft()
+                        data = future.result()
+                        if skip:
+                            data, skip = data[skip:], 0
+                        yield (coffset, data) if with_offsets else data
+                    if block is None and not pending:
+                        break
+        finally:
+            # Consumer may stop early (e.g. after the header line)
+            for _, future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _bgzf_lines(self):
+        remainder = b""
+        blocks = self.blocks()
+        try:
+            for data in blocks:
+                if not data:
+                    continue
+                chunk = remainder + data
+                end = chunk.rfind(b"\n") + 1
+                remainder = chunk[end:]
+                if end:
+                    yield from io.StringIO(chunk[:end].decode("utf-8"))
+            if remainder:
+                yield remainder.decode("utf-8")
+        finally:
+            blocks.close()
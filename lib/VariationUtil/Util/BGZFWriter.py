@@ -0,0 +1,186 @@
+import gzip
+import io
+import logging
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from VariationUtil.Util.BGZFReader import BGZFReader, BGZF_EOF, DEFAULT_THREADS, is_bgzf_file
+
+# Uncompressed bytes per block, same as bgzip
+BLOCK_SIZE = 0xff00
+MAX_BLOCK_SIZE = 0x10000
+# Bytes read from the input file at a time
+READ_SIZE = 1 << 20
+
+
+def deflate_bgzf_block(data, level):
+    """
+    Compresses up to BLOCK_SIZE bytes into one BGZF block
+    zlib releases the GIL while compressing, so this scales on threads
+    :return: bytes of the complete block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    if len(cdata) + 26 > MAX_BLOCK_SIZE:
+        # Incompressible data, stored blocks always fit
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff,
+                         6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class BGZFWriter:
+    """
+    Writes a BGZF file, compressing the blocks on a thread pool and
+    writing them to disk in order
+
+    with BGZFWriter(destination_path, level=6, threads=4) as writer:
+        writer.write(data)
+    logging.info(writer.stats())
+
+    Every block except the last holds exactly BLOCK_SIZE uncompressed bytes,
+    so the virtual offset of any uncompressed position is known once the
+    block has been written (see virtual_offset)
+    """
+
+    def __init__(self, filepath, level=6, threads=None):
+        self.filepath = filepath
+        self.level = level
+        self.threads = threads or DEFAULT_THREADS
+        # Number of blocks that can wait for compression / writing
+        self.prefetch = self.threads * 4
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Compressed file offset of each block
+        self.block_offsets = list()
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._handle = open(filepath, "wb")
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._start_time = time.time()
+        self._end_time = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def write(self, data):
+        """
+        :param data: uncompressed bytes
+        """
+        self._buffer += data
+        self.bytes_in += len(data)
+        while len(self._buffer) >= BLOCK_SIZE:
+            self._submit(bytes(self._buffer[:BLOCK_SIZE]))
+            del self._buffer[:BLOCK_SIZE]
+
+    def _submit(self, data):
+        self._pending.append(self._executor.submit(deflate_bgzf_block, data, self.level))
+        while self._pending and (len(self._pending) > self.prefetch
+                                 or self._pending[0].done()):
+            self._write_block(self._pending.popleft().result())
+
+    def _write_block(self, block):
+        self.block_offsets.append(self.bytes_out)
+        self._handle.write(block)
+        self.bytes_out += len(block)
+
+    def close(self):
+        """
+        Flushes the remaining data and writes the BGZF end of file marker
+        """
+        if self._handle.closed:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_block(self._pending.popleft().result())
+        # Offset of the EOF marker, used for offsets at the very end of the data
+        self.block_offsets.append(self.bytes_out)
+        self._handle.write(BGZF_EOF)
+        self.bytes_out += len(BGZF_EOF)
+        self._handle.close()
+        self._executor.shutdown()
+        self._end_time = time.time()
+
+    def _abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=False)
+        self._handle.close()
+
+    def virtual_offset(self, uoffset):
+        """
+        BGZF virtual offset of an uncompressed position, only valid
+        for data of blocks already written to disk
+        """
+        block, within = divmod(uoffset, BLOCK_SIZE)
+        return self.block_offsets[block] << 16 | within
+
+    def stats(self):
+        """
+        :return: bytes in, bytes out and throughput of the compression
+        """
+        seconds = (self._end_time or time.time()) - self._start_time
+        return {
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "seconds": round(seconds, 3),
+            "mb_per_second": round(self.bytes_in / 1e6 / seconds, 2) if seconds else None
+        }
+
+
+def read_chunks(filepath, filetype, threads=None):
+    """
+    Uncompressed content of a plain or gzip input file in chunks
+    :param filetype: "gzip" or "text", see VCFUtils.looks_like_vcf_file
+    """
+    if filetype == "gzip" and is_bgzf_file(filepath):
+        yield from BGZFReader(filepath, threads).blocks()
+        return
+    opener = gzip.open if filetype == "gzip" else open
+    with opener(filepath, "rb") as f:
+        while True:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def read_lines(filepath, filetype, threads=None):
+    """
+    Uncompressed content of a plain or gzip input file as lines of bytes,
+    with the trailing newline
+    """
+    remainder = b""
+    for chunk in read_chunks(filepath, filetype, threads):
+        chunk = remainder + chunk
+        end = chunk.rfind(b"\n") + 1
+        remainder = chunk[end:]
+        if end:
+            yield from io.BytesIO(chunk[:end])
+    if remainder:
+        yield remainder
+
+
+def bgzip_file(filepath, filetype, destination_path, level=6, threads=None):
+    """
+    Compresses a plain or gzip file to BGZF
+    :return: compression statistics
+    """
+    with BGZFWriter(destination_path, level, threads) as writer:
+        for chunk in read_chunks(filepath, filetype, threads):
+            writer.write(chunk)
+    stats = writer.stats()
+    logging.info("Compressed " + filepath + ": " + str(stats))
+    return stats
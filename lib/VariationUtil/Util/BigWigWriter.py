@@ -0,0 +1,296 @@
+import logging
+import struct
+import zlib
+
+import numpy as np
+
+BIGWIG_MAGIC = 0x888FFC26
+CHROM_TREE_MAGIC = 0x78CA8C91
+R_TREE_MAGIC = 0x2468ACE0
+BIGWIG_VERSION = 4
+HEADER_SIZE = 64
+ZOOM_HEADER_SIZE = 24
+TOTAL_SUMMARY_SIZE = 40
+# Items per data block and children per index node, same as bedGraphToBigWig
+ITEMS_PER_SLOT = 1024
+BLOCK_SIZE = 256
+# Each zoom level summarises ZOOM_FACTOR times more bases than the one before
+ZOOM_FACTOR = 4
+MAX_ZOOM_LEVELS = 10
+BEDGRAPH_SECTION = 1
+
+ITEM_DTYPE = np.dtype([("start", "<u4"), ("end", "<u4"), ("value", "<f4")])
+ZOOM_DTYPE = np.dtype([("chrom", "<u4"), ("start", "<u4"), ("end", "<u4"), ("count", "<u4"),
+                       ("min", "<f4"), ("max", "<f4"), ("sum", "<f4"), ("squares", "<f4")])
+
+
+def _tree_levels(items, block_size):
+    """
+    Groups items into nodes of block_size children, then those nodes into
+    parent nodes until one root is left
+    :return: list of levels, leaves first, each a list of nodes (lists)
+    """
+    levels = [[items[i:i + block_size] for i in range(0, len(items), block_size)] or [[]]]
+    while len(levels[-1]) > 1:
+        nodes = levels[-1]
+        levels.append([list(range(i, min(i + block_size, len(nodes))))
+                       for i in range(0, len(nodes), block_size)])
+    return levels
+
+
+def _level_offsets(levels, root_offset, leaf_item_size, node_item_size):
+    """
+    Offsets of the nodes of each level when levels are written root first
+    :return: list (same order as levels) of lists of node offsets
+    """
+    offsets = [None] * len(levels)
+    position = root_offset
+    for depth in range(len(levels) - 1, -1, -1):
+        item_size = leaf_item_size if depth == 0 else node_item_size
+        offsets[depth] = list()
+        for node in levels[depth]:
+            offsets[depth].append(position)
+            position += 4 + item_size * len(node)
+    return offsets
+
+
+def write_chrom_tree(out, chroms, block_size=BLOCK_SIZE):
+    """
+    Writes the B+ tree of chromosome names
+    :param chroms: list of (name, chrom id, size) sorted by name
+    """
+    key_size = max([len(name.encode("utf-8")) for name, _, _ in chroms] or [1])
+    keys = [name.encode("utf-8").ljust(key_size, b"\0") for name, _, _ in chroms]
+    items = [(key, struct.pack("<II", chrom_id, size))
+             for key, (_, chrom_id, size) in zip(keys, chroms)]
+    block_size = max(min(block_size, len(items)), 1)
+    levels = _tree_levels(items, block_size)
+    root_offset = out.tell() + 32
+    offsets = _level_offsets(levels, root_offset, key_size + 8, key_size + 8)
+
+    out.write(struct.pack("<IIIIQQ", CHROM_TREE_MAGIC, block_size, key_size, 8, len(items), 0))
+
+    def first_key(depth, node):
+        while depth > 0:
+            node = levels[depth - 1][node[0]]
+            depth -= 1
+        return node[0][0]
+
+    for depth in range(len(levels) - 1, -1, -1):
+        for node in levels[depth]:
+            out.write(struct.pack("<BBH", depth == 0, 0, len(node)))
+            for item in node:
+                if depth == 0:
+                    out.write(item[0] + item[1])
+                else:
+                    child = levels[depth - 1][item]
+                    out.write(first_key(depth - 1, child)
+                              + struct.pack("<Q", offsets[depth - 1][item]))
+
+
+def write_r_tree(out, blocks, end_offset, block_size=BLOCK_SIZE,
+                 items_per_slot=ITEMS_PER_SLOT):
+    """
+    Writes the R tree index of the data blocks
+    :param blocks: list of (chrom id, start, end, file offset, size) sorted
+                   by chrom id and start
+    :param end_offset: file offset of the end of the data blocks
+    """
+    levels = _tree_levels(blocks, block_size)
+    # bounds of every node, level by level
+    bounds = [[(node[0][0], node[0][1], node[-1][2], max(b[3] for b in node if b[2] == node[-1][2]))
+               if node else (0, 0, 0, 0) for node in levels[0]]]
+    for depth in range(1, len(levels)):
+        children = bounds[depth - 1]
+        bounds.append([(children[node[0]][0], children[node[0]][1],
+                        children[node[-1]][2], children[node[-1]][3]) for node in levels[depth]])
+    root_offset = out.tell() + 48
+    offsets = _level_offsets(levels, root_offset, 32, 24)
+
+    start_chrom, start_base, end_chrom, end_base = bounds[-1][0]
+    out.write(struct.pack("<IIQIIIIQII", R_TREE_MAGIC, block_size, len(blocks),
+                          start_chrom, start_base, end_chrom, end_base,
+                          end_offset, items_per_slot, 0))
+    for depth in range(len(levels) - 1, -1, -1):
+        for node in levels[depth]:
+            out.write(struct.pack("<BBH", depth == 0, 0, len(node)))
+            for item in node:
+                if depth == 0:
+                    out.write(struct.pack("<IIIIQQ", *item))
+                else:
+                    out.write(struct.pack("<IIIIQ", *bounds[depth - 1][item],
+                                          offsets[depth - 1][item]))
+
+
+def summarise(starts, ends, values, reduction, chrom_size):
+    """
+    Zoom records of one chromosome, intervals are split at the zoom bin
+    boundaries
+    :return: (bin starts, bin ends, covered bases, min, max, sum, sum of squares)
+    """
+    first = starts // reduction
+    counts = (ends - 1) // reduction - first + 1
+    index = np.repeat(np.arange(len(starts)), counts)
+    bins = first[index] + np.arange(len(index)) - np.repeat(np.cumsum(counts) - counts, counts)
+    bases = (np.minimum(ends[index], (bins + 1) * reduction)
+             - np.maximum(starts[index], bins * reduction)).astype(np.float64)
+    values = values[index].astype(np.float64)
+
+    groups = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+    bin_starts = bins[groups] * reduction
+    return (bin_starts, np.minimum(bin_starts + reduction, chrom_size),
+            np.add.reduceat(bases, groups),
+            np.minimum.reduceat(values, groups), np.maximum.reduceat(values, groups),
+            np.add.reduceat(values * bases, groups),
+            np.add.reduceat(values * values * bases, groups))
+
+
+class BigWigWriter:
+    """
+    Writes a BigWig file from bedgraph style intervals held in memory,
+    with the chromosome B+ tree, the R tree index and zoom levels:
+
+        with BigWigWriter(filepath, contig_lengths) as bigwig:
+            bigwig.add(contig, starts, ends, values)
+
+    Intervals of a contig are numpy arrays sorted by start and not
+    overlapping. Contigs can be added in any order, they are written in
+    sorted name order. Zoom levels start at ZOOM_FACTOR times the longest
+    interval and grow ZOOM_FACTOR times until they cover the longest
+    chromosome.
+    """
+
+    def __init__(self, filepath, chrom_sizes, compress=True):
+        """
+        :param chrom_sizes: (contig id, length) pairs
+        """
+        self.filepath = filepath
+        self.chrom_sizes = {str(name): int(size) for name, size in chrom_sizes}
+        self.compress = compress
+        self._intervals = dict()
+        self._max_block = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+
+    def add(self, contig, starts, ends, values):
+        if contig not in self.chrom_sizes:
+            raise ValueError("Contig " + contig + " is not in the chromosome sizes")
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if len(starts) and (ends.max() > self.chrom_sizes[contig] or (ends <= starts).any()):
+            raise ValueError("Invalid intervals for contig " + contig)
+        if contig in self._intervals:
+            raise ValueError("Intervals of contig " + contig + " were already added")
+        self._intervals[contig] = (starts, ends, np.asarray(values, dtype=np.float32))
+
+    def _write_block(self, out, data):
+        self._max_block = max(self._max_block, len(data))
+        if self.compress:
+            data = zlib.compress(data)
+        offset = out.tell()
+        out.write(data)
+        return offset, len(data)
+
+    def _write_data(self, out, chroms):
+        blocks = list()
+        out.write(struct.pack("<Q", sum((len(self._intervals[name][0]) + ITEMS_PER_SLOT - 1)
+                                        // ITEMS_PER_SLOT for name, _, _ in chroms)))
+        for name, chrom_id, _ in chroms:
+            starts, ends, values = self._intervals[name]
+            for i in range(0, len(starts), ITEMS_PER_SLOT):
+                items = np.empty(min(ITEMS_PER_SLOT, len(starts) - i), dtype=ITEM_DTYPE)
+                items["start"] = starts[i:i + ITEMS_PER_SLOT]
+                items["end"] = ends[i:i + ITEMS_PER_SLOT]
+                items["value"] = values[i:i + ITEMS_PER_SLOT]
+                start, end = int(items["start"][0]), int(items["end"].max())
+                header = struct.pack("<IIIIIBBH", chrom_id, start, end, 0, 0,
+                                     BEDGRAPH_SECTION, 0, len(items))
+                offset, size = self._write_block(out, header + items.tobytes())
+                blocks.append((chrom_id, start, chrom_id, end, offset, size))
+        return blocks
+
+    def _write_zoom(self, out, chroms, reduction):
+        records = list()
+        for name, chrom_id, size in chroms:
+            starts, ends, values = self._intervals[name]
+            summary = summarise(starts, ends, values, reduction, size)
+            zoom = np.empty(len(summary[0]), dtype=ZOOM_DTYPE)
+            zoom["chrom"] = chrom_id
+            for field, column in zip(ZOOM_DTYPE.names[1:], summary):
+                zoom[field] = column
+            records.append(zoom)
+        records = np.concatenate(records)
+
+        data_offset = out.tell()
+        out.write(struct.pack("<I", len(records)))
+        blocks = list()
+        for i in range(0, len(records), ITEMS_PER_SLOT):
+            block = records[i:i + ITEMS_PER_SLOT]
+            offset, size = self._write_block(out, block.tobytes())
+            blocks.append((int(block["chrom"][0]), int(block["start"][0]),
+                           int(block["chrom"][-1]), int(block["end"][-1]), offset, size))
+        index_offset = out.tell()
+        write_r_tree(out, blocks, index_offset)
+        return data_offset, index_offset
+
+    def _reductions(self, chroms):
+        spans = [int((ends - starts).max()) for starts, ends, _ in self._intervals.values()
+                 if len(starts)]
+        if not spans:
+            return []
+        longest = max(size for _, _, size in chroms)
+        reductions = list()
+        reduction = ZOOM_FACTOR * max(spans)
+        while reduction < longest and len(reductions) < MAX_ZOOM_LEVELS:
+            reductions.append(reduction)
+            reduction *= ZOOM_FACTOR
+        return reductions
+
+    def _total_summary(self):
+        bases, minimum, maximum, total, squares = 0, 0.0, 0.0, 0.0, 0.0
+        first = True
+        for starts, ends, values in self._intervals.values():
+            if not len(starts):
+                continue
+            lengths = (ends - starts).astype(np.float64)
+            values = values.astype(np.float64)
+            bases += int(lengths.sum())
+            minimum = values.min() if first else min(minimum, values.min())
+            maximum = values.max() if first else max(maximum, values.max())
+            total += float((values * lengths).sum())
+            squares += float((values * values * lengths).sum())
+            first = False
+        return struct.pack("<Qdddd", bases, minimum, maximum, total, squares)
+
+    def close(self):
+        names = sorted(self.chrom_sizes, key=lambda name: name.encode("utf-8"))
+        chroms = [(name, chrom_id, self.chrom_sizes[name]) for chrom_id, name in enumerate(names)]
+        data_chroms = [chrom for chrom in chroms if chrom[0] in self._intervals]
+        reductions = self._reductions(data_chroms)
+
+        with open(self.filepath, "wb") as out:
+            # header, zoom headers and total summary are written at the end
+            out.write(b"\0" * (HEADER_SIZE + ZOOM_HEADER_SIZE * len(reductions) + TOTAL_SUMMARY_SIZE))
+            chrom_tree_offset = out.tell()
+            write_chrom_tree(out, chroms)
+            data_offset = out.tell()
+            blocks = self._write_data(out, data_chroms)
+            index_offset = out.tell()
+            write_r_tree(out, blocks, index_offset)
+            zooms = [self._write_zoom(out, data_chroms, reduction) for reduction in reductions]
+
+            out.seek(0)
+            out.write(struct.pack("<IHHQQQHHQQIQ", BIGWIG_MAGIC, BIGWIG_VERSION, len(reductions),
+                                  chrom_tree_offset, data_offset, index_offset, 0, 0, 0,
+                                  HEADER_SIZE + ZOOM_HEADER_SIZE * len(reductions),
+                                  self._max_block if self.compress else 0, 0))
+            for reduction, (zoom_data_offset, zoom_index_offset) in zip(reductions, zooms):
+                out.write(struct.pack("<IIQQ", reduction, 0, zoom_data_offset, zoom_index_offset))
+            out.write(self._total_summary())
+        logging.info("Wrote bigwig file " + self.filepath + " with "
+                     + str(len(reductions)) + " zoom levels")
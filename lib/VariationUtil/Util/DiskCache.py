@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+# Default size limit of a cache directory in bytes
+DEFAULT_CACHE_SIZE = 1 << 30
+# Eviction removes files until the directory is under this part of the limit
+EVICT_TARGET = 0.8
+# Puts between two scans of the directory, other processes sharing it
+# change its size without this process knowing
+RESCAN_PUTS = 1000
+
+
+class DiskCache:
+    """
+    Size bounded key / value cache in a directory, values are bytes
+    stored one file per key. Reading a value marks it as recently used;
+    when the directory grows over max_bytes the least recently used
+    files are removed. The size of the directory is kept as a running
+    total, it is only scanned when the total crosses the limit (and
+    every RESCAN_PUTS puts).
+
+    Files are written to a temporary name and renamed into place, so
+    several processes can share a directory. Values should only be
+    stored for keys that never change (e.g. versioned object references).
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # bytes in the directory, None until the first scan
+        self._total = None
+        self._puts = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _size(path):
+        try:
+            return os.stat(path).st_size
+        except OSError:
+            return 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        """
+        :return: bytes stored for key or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        :param data: bytes
+        """
+        path = self._path(key)
+        tmp_path = path + "." + str(uuid.uuid4()) + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            replaced = self._size(path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning("Could not write cache file " + path + ": " + str(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        with self._lock:
+            self._puts += 1
+            if self._total is not None and self._puts < RESCAN_PUTS:
+                self._total += len(data) - replaced
+                if self._total <= self.max_bytes:
+                    return
+            self._evict()
+
+    def get_json(self, key):
+        data = self.get(key)
+        return None if data is None else json.loads(data.decode("utf-8"))
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value).encode("utf-8"))
+
+    def delete(self, key):
+        path = self._path(key)
+        size = self._size(path)
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total is not None:
+                self._total -= size
+
+    def _evict(self):
+        """
+        Scans the directory and removes the least recently used files
+        when it is over the limit, called with self._lock held
+        """
+        self._puts = 0
+        entries = list()
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+        if total > self.max_bytes:
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes * EVICT_TARGET:
+                    break
+        self._total = total
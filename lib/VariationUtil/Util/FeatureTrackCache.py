@@ -0,0 +1,68 @@
+import logging
+
+from requests.exceptions import RequestException
+
+from installed_clients.baseclient import get_session
+from VariationUtil.Util.AssemblyMetadata import VERSIONED_REF
+from VariationUtil.Util.DiskCache import DiskCache, DEFAULT_CACHE_SIZE
+
+
+class FeatureTrackCache:
+    """
+    Shock handles of the genome features track (bgzipped gff and its
+    index) of versioned genome references, kept in an on-disk LRU cache
+    (see DiskCache) so that imports against the same genome reuse them:
+
+        cache = FeatureTrackCache(cache_dir, shock_url, token)
+        entry = cache.get(genome_ref)
+        if entry is None:
+            ...
+            cache.put(genome_ref, {"handles": handles, ...})
+
+    Before an entry is used, the shock nodes are checked to still exist
+    and to be readable with the token of the current user; entries that
+    fail the check are dropped.
+    """
+
+    def __init__(self, cache_dir, shock_url, token, cache_size=DEFAULT_CACHE_SIZE):
+        self.cache = DiskCache(cache_dir, cache_size)
+        self.shock_url = shock_url.rstrip("/")
+        self.token = token
+
+    @staticmethod
+    def _key(genome_ref):
+        return "genome_features:" + genome_ref
+
+    def _node_readable(self, node_id):
+        try:
+            resp = get_session().get(self.shock_url + "/node/" + node_id,
+                                     headers={"Authorization": "OAuth " + self.token},
+                                     timeout=30)
+        except RequestException as e:
+            logging.info("Could not check shock node " + node_id + ": " + str(e))
+            return False
+        return resp.status_code == 200
+
+    def get(self, genome_ref):
+        """
+        :return: cached entry of the genome or None
+        """
+        if not VERSIONED_REF.match(genome_ref):
+            return None
+        entry = self.cache.get_json(self._key(genome_ref))
+        if entry is None:
+            return None
+        if not all(self._node_readable(handle['id']) for handle in entry['handles']):
+            logging.info("Cached genome features track of " + genome_ref + " is no longer valid")
+            self.cache.delete(self._key(genome_ref))
+            return None
+        logging.info("Reusing genome features track of " + genome_ref)
+        return entry
+
+    def put(self, genome_ref, entry):
+        """
+        :param entry: json serializable dict with the shock handles of the
+                      track files in handles
+        """
+        if VERSIONED_REF.match(genome_ref):
+            self.cache.put_json(self._key(genome_ref), entry)
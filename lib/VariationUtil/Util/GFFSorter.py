@@ -0,0 +1,119 @@
+import heapq
+import logging
+import os
+import tempfile
+
+from VariationUtil.Util.BGZFWriter import BGZFWriter
+from VariationUtil.Util.TabixIndex import TabixIndexBuilder, GFF_PRESET
+
+# Bytes of gff lines sorted in memory; larger files are sorted in runs of
+# this size that are merged from disk
+MEMORY_LIMIT = 256 << 20
+
+
+def gff_sort_key(line):
+    """
+    Sort order of sort -k1,1 -k4,4n: seqid, then start
+    """
+    fields = line.split(b"\t", 4)
+    if len(fields) < 5:
+        raise ValueError("Invalid gff line: " + line[:200].decode("utf-8", "replace"))
+    return fields[0], int(fields[3])
+
+
+class GFFSorter:
+    """
+    Sorts a gff file by seqid and start, compresses it with BGZF and
+    builds its tabix index in the same pass (replaces sort, bgzip and
+    tabix -p gff):
+
+        sorter = GFFSorter(tmp_dir, threads=4)
+        gff_gz, gff_index = sorter.sort_compress_index(gff_file, gff_gz)
+
+    Comment and directive lines go to the top of the file, a ##FASTA
+    section is dropped. Files up to memory_limit bytes are sorted in
+    memory, larger files with an external merge sort of runs written
+    to tmp_dir.
+    """
+
+    def __init__(self, tmp_dir, threads=None, memory_limit=MEMORY_LIMIT, level=6):
+        self.tmp_dir = tmp_dir
+        self.threads = threads
+        self.memory_limit = memory_limit
+        self.level = level
+
+    def _spill(self, lines):
+        """
+        Writes a sorted run to disk
+        :return: path of the run file
+        """
+        lines.sort(key=gff_sort_key)
+        fd, run_path = tempfile.mkstemp(suffix=".gff_run", dir=self.tmp_dir)
+        with os.fdopen(fd, "wb") as run:
+            run.writelines(lines)
+        return run_path
+
+    @staticmethod
+    def _read_run(run_path):
+        with open(run_path, "rb") as run:
+            yield from run
+
+    def _sorted_lines(self, gff_file, header):
+        """
+        Data lines of the gff file in sorted order, comment lines are
+        appended to header
+        """
+        lines = list()
+        size = 0
+        runs = list()
+        with open(gff_file, "rb") as f:
+            for line in f:
+                if line.startswith(b"##FASTA"):
+                    break
+                if not line.strip():
+                    continue
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                if line[:1] == b"#":
+                    header.append(line)
+                    continue
+                lines.append(line)
+                size += len(line)
+                if size >= self.memory_limit:
+                    runs.append(self._spill(lines))
+                    lines = list()
+                    size = 0
+
+        if not runs:
+            lines.sort(key=gff_sort_key)
+            return iter(lines), runs
+        if lines:
+            runs.append(self._spill(lines))
+        logging.info("Merging " + str(len(runs)) + " sorted runs of " + gff_file)
+        return heapq.merge(*[self._read_run(run) for run in runs], key=gff_sort_key), runs
+
+    def sort_compress_index(self, gff_file, destination_path):
+        """
+        :param gff_file: path of the gff file
+        :param destination_path: path of the bgzipped output
+        :return: (path of the bgzipped gff, path of its .tbi / .csi index)
+        """
+        header = list()
+        builder = TabixIndexBuilder(GFF_PRESET)
+        lines, runs = self._sorted_lines(gff_file, header)
+        try:
+            with BGZFWriter(destination_path, self.level, self.threads) as writer:
+                for line in header:
+                    writer.write(line)
+                for line in lines:
+                    record_start = writer.bytes_in
+                    writer.write(line)
+                    fields = line.split(b"\t", 5)
+                    beg = int(fields[3]) - 1
+                    builder.push(fields[0].decode("utf-8"), beg, max(int(fields[4]), beg + 1),
+                                 record_start, writer.bytes_in)
+        finally:
+            for run in runs:
+                os.remove(run)
+        logging.info("Sorted and compressed " + gff_file + ": " + str(writer.stats()))
+        return destination_path, builder.write(destination_path, writer.virtual_offset)
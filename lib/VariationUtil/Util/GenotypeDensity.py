@@ -0,0 +1,119 @@
+import numpy as np
+
+# Bin size (bp) of the per sample genotype tracks
+GENOTYPE_BINSIZE = 10000
+TRACK_KINDS = ("het", "missing")
+
+
+class GenotypeDensity:
+    """
+    Heterozygous and missing calls per bin of a few selected samples,
+    counted from the genotype blocks of GenotypeMatrixWriter while the vcf
+    is ingested:
+
+        density = GenotypeDensity(["strain_1", "strain_2"])
+        writer = GenotypeMatrixWriter(path, density=density)
+        ...
+        for contig, starts, ends, rates in density.arrays("strain_1", "het"):
+            ...
+
+    het rate of a bin is the fraction of the called genotypes of the sample
+    that are heterozygous, missing rate the fraction of the variants with a
+    missing call.
+    """
+
+    def __init__(self, samples, binsize=GENOTYPE_BINSIZE):
+        self.samples = list(samples)
+        self.binsize = binsize
+        self.sample_indexes = None
+        # contig -> (variants per bin, het calls per bin and sample,
+        #            missing calls per bin and sample)
+        self._counts = dict()
+
+    def select(self, vcf_samples):
+        """
+        Finds the columns of the selected samples
+        :param vcf_samples: sample names of the vcf (#CHROM line)
+        """
+        columns = {name: i for i, name in enumerate(vcf_samples)}
+        unknown = [name for name in self.samples if name not in columns]
+        if unknown:
+            raise ValueError("Samples selected for genotype tracks are not in the vcf file: "
+                             + ", ".join(unknown))
+        self.sample_indexes = [columns[name] for name in self.samples]
+
+    def contigs(self):
+        return sorted(self._counts)
+
+    def _grow(self, contig, nbins):
+        counts = self._counts.get(contig)
+        if counts is None:
+            counts = (np.zeros(0, dtype=np.int64),
+                      np.zeros((0, len(self.samples)), dtype=np.int64),
+                      np.zeros((0, len(self.samples)), dtype=np.int64))
+        if len(counts[0]) < nbins:
+            extra = nbins - len(counts[0])
+            counts = (np.pad(counts[0], (0, extra)),
+                      np.pad(counts[1], ((0, extra), (0, 0))),
+                      np.pad(counts[2], ((0, extra), (0, 0))))
+        self._counts[contig] = counts
+        return counts
+
+    def add_block(self, contigs, positions, codes, ploidy, missing_code):
+        """
+        :param contigs: contig id of each row
+        :param positions: numpy array of 0-based positions of the rows
+        :param codes: uint8 (variants, samples) dosages of all samples
+        :param ploidy: uint8 (variants, samples) ploidy of each call, a
+                       call is het when 0 < dosage < its own ploidy
+        :param missing_code: code of missing calls in codes
+        """
+        if not self.samples:
+            return
+        codes = codes[:, self.sample_indexes]
+        missing = codes == missing_code
+        het = (codes > 0) & (codes < ploidy[:, self.sample_indexes]) & ~missing
+        bins = positions // self.binsize
+        nsamples = len(self.samples)
+
+        # rows of a block are in vcf order, so each contig is one run
+        boundaries = [i for i in range(1, len(contigs)) if contigs[i] != contigs[i - 1]]
+        for start, end in zip([0] + boundaries, boundaries + [len(contigs)]):
+            run_bins = bins[start:end]
+            nbins = int(run_bins.max()) + 1
+            totals, het_counts, missing_counts = self._grow(contigs[start], nbins)
+            cells = (run_bins[:, None] * nsamples + np.arange(nsamples)).ravel()
+            totals[:nbins] += np.bincount(run_bins, minlength=nbins)
+            het_counts[:nbins] += np.bincount(cells, weights=het[start:end].ravel(),
+                                              minlength=nbins * nsamples
+                                              ).reshape(nbins, nsamples).astype(np.int64)
+            missing_counts[:nbins] += np.bincount(cells, weights=missing[start:end].ravel(),
+                                                  minlength=nbins * nsamples
+                                                  ).reshape(nbins, nsamples).astype(np.int64)
+
+    def arrays(self, sample, kind, contig_lengths=None):
+        """
+        Rates of one sample in the bins with variants, in contig order
+        :param kind: "het" or "missing"
+        :param contig_lengths: dict like contig id -> length, bins are
+                               clipped to the end of the contig
+        :return: generator of (contig, starts, ends, rates) numpy arrays
+        """
+        if kind not in TRACK_KINDS:
+            raise ValueError("Unknown genotype track " + kind)
+        column = self.samples.index(sample)
+        for contig in self.contigs():
+            totals, het_counts, missing_counts = self._counts[contig]
+            bins = np.flatnonzero(totals)
+            missing = missing_counts[bins, column]
+            if kind == "het":
+                called = totals[bins] - missing
+                rates = np.divide(het_counts[bins, column], called,
+                                  out=np.zeros(len(bins)), where=called > 0)
+            else:
+                rates = missing / totals[bins]
+            starts = bins * self.binsize
+            ends = starts + self.binsize
+            if contig_lengths is not None:
+                np.minimum(ends, int(contig_lengths[contig]), out=ends)
+            yield contig, starts, ends, rates
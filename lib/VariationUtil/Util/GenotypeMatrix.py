@@ -0,0 +1,253 @@
+import json
+import os
+import re
+import zipfile
+
+import numpy as np
+
+# Variants per chunk of the matrix
+CHUNK_ROWS = 4096
+GT_SEPARATOR = re.compile(r"[/|]")
+FORMAT_FIELDS = re.compile(r":[^\t]*")
+
+
+def bits_for_ploidy(ploidy):
+    """
+    Bits per genotype call: enough for every alt allele dosage
+    0..ploidy plus the missing value (all bits set)
+    """
+    for bits in (2, 4, 8):
+        if ploidy + 1 < (1 << bits):
+            return bits
+    raise ValueError("Ploidy " + str(ploidy) + " is not supported")
+
+
+def pack_codes(codes, bits):
+    """
+    Packs a (variants, samples) uint8 matrix of codes into bytes,
+    8 // bits calls per byte along the samples axis
+    """
+    per_byte = 8 // bits
+    rows, samples = codes.shape
+    padded = -samples % per_byte
+    if padded:
+        codes = np.pad(codes, ((0, 0), (0, padded)))
+    codes = codes.reshape(rows, -1, per_byte)
+    packed = np.zeros(codes.shape[:2], dtype=np.uint8)
+    for i in range(per_byte):
+        packed |= codes[:, :, i] << (8 - bits * (i + 1))
+    return packed
+
+
+def unpack_codes(packed, bits, samples):
+    """
+    Inverse of pack_codes
+    """
+    per_byte = 8 // bits
+    mask = (1 << bits) - 1
+    codes = np.empty(packed.shape + (per_byte,), dtype=np.uint8)
+    for i in range(per_byte):
+        codes[:, :, i] = (packed >> (8 - bits * (i + 1))) & mask
+    return codes.reshape(packed.shape[0], -1)[:, :samples]
+
+
+class GenotypeMatrixWriter:
+    """
+    Encodes the genotype calls of a vcf into a compact variants x samples
+    matrix, written next to the vcf as a numpy .npz file:
+        chunk_NNNNN - packed uint8 array for CHUNK_ROWS variants
+        meta - json with samples, number of variants and bits per chunk
+
+    Each call is stored as the number of non reference alleles (dosage),
+    missing calls as all bits set. Diploid panels use 2 bits per call,
+    higher ploidies 4 or 8 bits (see bits_for_ploidy). Allele identities
+    of multi allelic sites are not kept, the vcf stays the source for those.
+
+    Rows are pushed as vcf data lines with add(), usually by VCFIngest.
+    The file is created with the first chunk (or by close), so a sites
+    only vcf leaves nothing open; abort() removes a partly written file.
+    With density (a GenotypeDensity) every chunk is also counted into
+    per sample heterozygous / missing rates before it is packed.
+    """
+
+    def __init__(self, filepath, chunk_rows=CHUNK_ROWS, density=None):
+        self.filepath = filepath
+        self.chunk_rows = chunk_rows
+        self.density = density
+        self.n_variants = 0
+        self.n_samples = None
+        self.chunk_bits = list()
+        self._rows = list()
+        self._max_ploidy = 0
+        self._codes = dict()
+        # contig, position and per call ploidy of the rows, kept for
+        # density only
+        self._row_contigs = list()
+        self._row_positions = list()
+        self._row_ploidy = list()
+        self._zip = None
+
+    def _open(self):
+        if self._zip is None:
+            self._zip = zipfile.ZipFile(self.filepath, "w", zipfile.ZIP_DEFLATED)
+        return self._zip
+
+    def _code(self, gt):
+        code = self._codes.get(gt)
+        if code is None:
+            alleles = GT_SEPARATOR.split(gt)
+            if "." in alleles or not gt:
+                code = (-1, len(alleles))
+            else:
+                code = (sum(a != "0" for a in alleles), len(alleles))
+            self._codes[gt] = code
+        return code
+
+    def _row_codes(self, genos):
+        """
+        :param genos: tab separated GT calls of one variant
+        :return: (uint8 array of dosages, 255 for missing,
+                  uint8 array of the ploidy of each call)
+        """
+        raw = np.frombuffer(genos.encode("ascii"), dtype=np.uint8)
+        if len(raw) == 4 * self.n_samples - 1 and raw[1] in (47, 124):
+            # Fast path for diploid calls with single digit alleles "a/b"
+            cells = np.append(raw, 9).reshape(self.n_samples, 4)
+            first, second = cells[:, 0], cells[:, 2]
+            if (cells[:, 3] == 9).all():
+                codes = (first != 48).astype(np.uint8) + (second != 48)
+                codes[(first == 46) | (second == 46)] = 255
+                return codes, np.full(self.n_samples, 2, dtype=np.uint8)
+        codes, ploidy = zip(*(self._code(gt) for gt in genos.split("\t")))
+        return (np.array(codes, dtype=np.int16).astype(np.uint8),
+                np.array(ploidy, dtype=np.uint8))
+
+    @staticmethod
+    def _gt_calls(fields):
+        """
+        :param fields: columns of a vcf data line, the sample columns unsplit
+        :return: tab separated GT calls of the samples
+        """
+        keys = fields[8].split(":")
+        if keys[0] == "GT":
+            if len(keys) == 1:
+                return fields[9]
+            return FORMAT_FIELDS.sub("", fields[9])
+        if "GT" not in keys:
+            # the calls are missing, the row still stands for the record
+            return "\t".join(["."] * (fields[9].count("\t") + 1))
+        # trailing fields can be dropped from a call, GT is then missing
+        gt_index = keys.index("GT")
+        calls = [call.split(":") for call in fields[9].split("\t")]
+        return "\t".join(call[gt_index] if gt_index < len(call) else "."
+                         for call in calls)
+
+    def set_samples(self, samples):
+        """
+        :param samples: sample names of the vcf (#CHROM line)
+        """
+        if self.density is not None:
+            self.density.select(samples)
+
+    def add(self, record):
+        """
+        :param record: vcf data line with FORMAT and sample columns
+        """
+        fields = record.rstrip("\n").split("\t", 9)
+        if len(fields) < 10:
+            return
+        genos = self._gt_calls(fields)
+        if self.n_samples is None:
+            self.n_samples = genos.count("\t") + 1
+        codes, ploidy = self._row_codes(genos)
+        if len(codes) != self.n_samples:
+            raise ValueError("Wrong number of genotype columns in record "
+                             + fields[0] + ":" + fields[1])
+        self._max_ploidy = max(self._max_ploidy, int(ploidy.max()))
+        self._rows.append(codes)
+        if self.density is not None:
+            self._row_contigs.append(fields[0])
+            self._row_positions.append(int(fields[1]) - 1)
+            self._row_ploidy.append(ploidy)
+        self.n_variants += 1
+        if len(self._rows) >= self.chunk_rows:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        bits = bits_for_ploidy(self._max_ploidy)
+        codes = np.vstack(self._rows)
+        codes[codes == 255] = (1 << bits) - 1
+        if self.density is not None:
+            self.density.add_block(self._row_contigs,
+                                   np.array(self._row_positions, dtype=np.int64),
+                                   codes, np.vstack(self._row_ploidy),
+                                   (1 << bits) - 1)
+            self._row_contigs = list()
+            self._row_positions = list()
+            self._row_ploidy = list()
+        name = "chunk_" + str(len(self.chunk_bits)).zfill(5) + ".npy"
+        with self._open().open(name, "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, pack_codes(codes, bits))
+        self.chunk_bits.append(bits)
+        self._rows = list()
+        self._max_ploidy = 0
+
+    def close(self, samples):
+        """
+        :param samples: sample names of the vcf (#CHROM line)
+        :return: path of the matrix file
+        """
+        if self._zip is not None and self._zip.fp is None:
+            return self.filepath
+        self._flush()
+        self._open()
+        meta = {
+            "samples": samples,
+            "n_variants": self.n_variants,
+            "chunk_rows": self.chunk_rows,
+            "chunk_bits": self.chunk_bits,
+            "encoding": "alt allele dosage, missing = all bits set"
+        }
+        with self._zip.open("meta.npy", "w") as f:
+            np.lib.format.write_array(f, np.array(json.dumps(meta)))
+        self._zip.close()
+        return self.filepath
+
+    def abort(self):
+        """
+        Closes and removes the matrix file after a failed ingest
+        """
+        if self._zip is None:
+            return
+        self._zip.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
+class GenotypeMatrix:
+    """
+    Reader for files written by GenotypeMatrixWriter
+
+    for codes, missing in GenotypeMatrix(path).chunks():
+        # codes: uint8 (variants, samples) dosages, missing: bool mask
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with np.load(filepath) as data:
+            self.meta = json.loads(str(data["meta"]))
+        self.samples = self.meta["samples"]
+
+    def chunks(self, sample_indexes=None):
+        """
+        :param sample_indexes: optional list of sample columns to return
+        """
+        with np.load(self.filepath) as data:
+            for i, bits in enumerate(self.meta["chunk_bits"]):
+                packed = data["chunk_" + str(i).zfill(5)]
+                codes = unpack_codes(packed, bits, len(self.samples))
+                if sample_indexes is not None:
+                    codes = codes[:, sample_indexes]
+                yield codes, codes == (1 << bits) - 1
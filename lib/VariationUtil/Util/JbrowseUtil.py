@@ -1,16 +1,21 @@
-import gzip
 import json
 import logging
 import os
 import shutil
-import subprocess
 import uuid
-from collections import Counter
-import requests
 
 from installed_clients.GenomeFileUtilClient import GenomeFileUtil
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.WorkspaceClient import Workspace
+from VariationUtil.Util.AssemblyMetadata import AssemblyMetadata
+from VariationUtil.Util.BigWigWriter import BigWigWriter
+from VariationUtil.Util.DiskCache import DEFAULT_CACHE_SIZE
+from VariationUtil.Util.FeatureTrackCache import FeatureTrackCache
+from VariationUtil.Util.GenotypeDensity import TRACK_KINDS
+from VariationUtil.Util.GFFSorter import GFFSorter
+from VariationUtil.Util.ServiceResolver import ServiceResolver
+from VariationUtil.Util.UploadScheduler import UploadScheduler
+from VariationUtil.Util.VCFIngest import VCFIngest
 
 
 class JbrowseUtil:
@@ -23,6 +28,16 @@ class JbrowseUtil:
         #service-wizard url
         self.sw_url = Config['sw_url']
         self.shock_url = Config['shock_url']
+        self.threads = Config.get('threads')
+        self.assembly_metadata = Config.get('assembly_metadata') or AssemblyMetadata(self.wsc)
+        self.uploads = Config.get('uploads') or UploadScheduler(self.dfu)
+        # Optional on-disk cache of the genome features track files, shared
+        # by imports against the same genome
+        self.feature_track_cache = None
+        if Config.get('feature_track_cache_dir'):
+            self.feature_track_cache = FeatureTrackCache(
+                Config['feature_track_cache_dir'], self.shock_url, os.environ['KB_AUTH_TOKEN'],
+                int(Config.get('feature_track_cache_size') or DEFAULT_CACHE_SIZE))
         scratch = Config['scratch']
         session = str(uuid.uuid4())
         self.session_dir = (os.path.join(scratch, session))
@@ -35,37 +50,15 @@ class JbrowseUtil:
         sw_url: service wizard url
         '''
         # TODO Fix the following dev thing to beta or release or future
-        json_obj = {
-            "method": "ServiceWizard.get_service_status",
-            "id": "",
-            "params": [{"module_name": "VariationFileServ", "version": "dev"}]
-        }
-        sw_resp = requests.post(url=sw_url, data=json.dumps(json_obj))
-        vfs_resp = sw_resp.json()
+        vfs_service_url = ServiceResolver(sw_url).get_url("VariationFileServ", "dev")
         self.shock_url = self.shock_url.replace("https://", "")
         #TODO: Find a better solution for Cross-Origin Read Blocking (CORB) 
         # blocked cross-origin respons
-        vfs_service_url = vfs_resp['result'][0]['url'].replace(":443","")
+        vfs_service_url = vfs_service_url.replace(":443","")
         
         vfs_url = vfs_service_url + "/jbrowse_query/" + self.shock_url + "/node"
         return vfs_url
 
-    def _run_cmd(self, cmd):
-        try:
-            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
-            stdout, stderr = process.communicate()
-            if stdout:
-                logging.info("ret> ", process.returncode)
-                logging.info("OK> output ", stdout)
-            if stderr:
-                logging.info("ret> ", process.returncode)
-                logging.info("Error> error ", stderr.strip())
-
-        except OSError as e:
-            logging.info("OSError > ", e.errno)
-            logging.info("OSError > ", e.strerror)
-            logging.info("OSError > ", e.filename)
-
     def create_refseqs_data_from_assembly(self, assembly_ref):
         '''
 
@@ -74,15 +67,12 @@ class JbrowseUtil:
         '''
         refseqs_data = []
         # 1) Download assembly contig info and parse contig length information
-        data = self.wsc.get_object_subset([{
-            'included': ['/contigs'],
-            'ref': assembly_ref
-        }])[0]['data']
-        for key in data['contigs']:
+        contigs = self.assembly_metadata.contigs(assembly_ref)
+        for contig_id, length in contigs.items():
             refseqs_data.append(
-                {"end": data['contigs'][key]["length"],
-                 "length": data['contigs'][key]["length"],
-                 "name": data['contigs'][key]["contig_id"],
+                {"end": length,
+                 "length": length,
+                 "name": contig_id,
                  "seqChunkSize": 20000,
                  "start": 0
                  }
@@ -100,36 +90,37 @@ class JbrowseUtil:
         shock_handles = list()
         gff_track = ""
 
-        # 1) Download gff using genomefileutil
-        gff_file_info = self.gfu.genome_to_gff({'genome_ref': genome_ref})
-        gff_file = gff_file_info["file_path"]
-
-        # 2) sort gff
-        outfile = gff_file + "_sorted"
-        sorted_gff_cmd = " ".join(["sort -k1,1 -k4,4n",
-                                  gff_file, ">", outfile])
-        self._run_cmd(sorted_gff_cmd)
-
-        # 3) compress gff
-        zip_cmd = "bgzip " + outfile
-        self._run_cmd(zip_cmd)
-
-        # 4) index gff
-        index_gff_cmd = "tabix -p gff " + gff_file + "_sorted.gz"
-        self._run_cmd(index_gff_cmd)
-
-        gff_gz_file_path = gff_file + "_sorted.gz"
-        gff_index_file_path = gff_file + "_sorted.gz.tbi"
-
-        # 5) Upload gff and gff index to shock
-        if os.path.exists(gff_gz_file_path):
-            gff_shock_ref = self.dfu.file_to_shock(
-                {'file_path': gff_gz_file_path, 'make_handle': 1}
-            )
-        if os.path.exists(gff_index_file_path):
-            gff_index_shock_ref = self.dfu.file_to_shock(
-                {'file_path': gff_index_file_path, 'make_handle': 1}
-            )
+        # Reuse the track files of an earlier import of the same genome
+        cached = None
+        if self.feature_track_cache is not None:
+            cached = self.feature_track_cache.get(genome_ref)
+        if cached is not None:
+            gff_handle, gff_index_handle = cached['handles']
+            index_template = cached['index_template']
+        else:
+            # 1) Download gff using genomefileutil
+            gff_file_info = self.gfu.genome_to_gff({'genome_ref': genome_ref})
+            gff_file = gff_file_info["file_path"]
+
+            # 2), 3), 4) sort, compress and index gff in one pass (see GFFSorter),
+            #    the index is .csi for contigs longer than 2^29
+            sorter = GFFSorter(self.session_dir, self.threads)
+            gff_gz_file_path, gff_index_file_path = sorter.sort_compress_index(
+                gff_file, gff_file + "_sorted.gz")
+            index_template = "csiUrlTemplate" if gff_index_file_path.endswith(".csi") else "tbiUrlTemplate"
+
+            # 5) Upload gff and gff index to shock
+            gff_upload = self.uploads.upload({'file_path': gff_gz_file_path, 'make_handle': 1})
+            gff_index_upload = self.uploads.upload({'file_path': gff_index_file_path, 'make_handle': 1})
+            gff_shock_ref = gff_upload.result()
+            gff_index_shock_ref = gff_index_upload.result()
+            gff_handle = gff_shock_ref['handle']
+            gff_index_handle = gff_index_shock_ref['handle']
+            if self.feature_track_cache is not None:
+                self.feature_track_cache.put(genome_ref, {
+                    'handles': [gff_handle, gff_index_handle],
+                    'index_template': index_template
+                })
 
         # 6 Create gff track text that will be used for genome features track
         gff_track = '''
@@ -138,107 +129,62 @@ class JbrowseUtil:
             "key": "GenomeFeatures",
             "storeClass": "JBrowse/Store/SeqFeature/GFF3Tabix",
             "urlTemplate":"<vfs_url>/<gff_shock_ref>",
-            "tbiUrlTemplate": "<vfs_url>/<gff_index_shock_ref>",
+            "<index_template>": "<vfs_url>/<gff_index_shock_ref>",
             "type": "JBrowse/View/Track/CanvasFeatures"
         }
         '''
         gff_track = gff_track.replace("<gff_shock_ref>",
-                                      gff_shock_ref['handle']['id'])
+                                      gff_handle['id'])
         gff_track = gff_track.replace("<gff_index_shock_ref>",
-                                      gff_index_shock_ref['handle']['id'])
+                                      gff_index_handle['id'])
+        gff_track = gff_track.replace("<index_template>", index_template)
         gff_track = gff_track.replace("<vfs_url>", vfs_url)
         gff_track_dict = json.loads(gff_track)
 
         # 7) Capture shock handles
-        shock_handles.append(gff_shock_ref['handle'])
-        shock_handles.append(gff_index_shock_ref['handle'])
+        shock_handles.append(gff_handle)
+        shock_handles.append(gff_index_handle)
 
         # 8) return shock handles and gff track info
         return {"shock_handle_list": shock_handles, "track_item": gff_track_dict}
 
 
 
-    def prepare_snp_frequency_track(self, vcf_filepath, assembly_ref, binsize, vfs_url):
+    def prepare_snp_frequency_track(self, vcf_filepath, assembly_ref, binsize, vfs_url,
+                                    density=None):
         """
 
         :param vcf_filepath:
         :param assembly_ref:
         :param binsize:
+        :param density: SNPDensity computed during VCF ingestion. The vcf
+                        file is only read again when this is not given or
+                        has no counts at binsize resolution
         :return:
         """
-        BEDGRAPHTOBIGWIG="/kb/deployment/bin/bedGraphToBigWig"
         shock_handles = list()
 
-        chr_length_dict = {}
-        chr_length_data = ""
-        chr_length_path = None
-        counts = Counter()
-
         # 1) Download assembly contig info and parse contig length information
-        data = self.wsc.get_object_subset([{
-            'included': ['/contigs'],
-            'ref': assembly_ref
-        }])[0]['data']
-
-        contigs = data["contigs"]
-        for contig in contigs:
-            contig_data = data["contigs"][contig]
-            chr_length_data += str(contig_data['contig_id']) + '\t' + str(contig_data['length']) + '\n'
-            c_id = str(contig_data['contig_id'])
-            c_length = str(contig_data['length'])
-            chr_length_dict[c_id] = c_length
-
-        # 2) Write contig lengths to a file (needed later)
-        if chr_length_data is not None:
-            chr_length_path = os.path.join(self.session_dir,
-                                            "chr_length.txt")
-            with open(chr_length_path, "w") as f:
-                f.write(chr_length_data)
-
-        # 3) Read and parse vcf file (must be bgzip compressed)
-        #    Caclculate number of SNPs in each bin and write in bedgraph format
-        reader = gzip.open(vcf_filepath, "rt")
-        logging.info("Generating bedgraph file\n")
-        for record in reader:
-            if record[0] == "#":
-                continue
-            rs = record.split("\t")
-            CHR, POS = rs[0], rs[1]
-            bin_pos = int(int(POS) / binsize)
-            bin_id = str(CHR) + "\t" + str(bin_pos)
-            counts[bin_id] += 1
-        bedgraph_file = os.path.join(self.session_dir, "vcf_bedgraph.txt")
-        try:
-            with open(bedgraph_file, "w") as fout:
-                for j, k in counts.items():
-                    chromosome, bin_num = j.split("\t")
-                    bin_start = int(bin_num) * binsize
-                    bin_end = bin_start + binsize
-                    chr_length = chr_length_dict[chromosome]
-                    if bin_end <= int(chr_length):
-                        fout.write(chromosome + "\t" + str(bin_start) + "\t" + str(bin_end) + "\t" + str(k) + "\n")
-                    else:
-                        fout.write(chromosome + "\t" + str(bin_start) + "\t" + str(chr_length) + "\t" + str(k) + "\n")
-        except IOError:
-            logging.info("Unable to write " + bedgraph_file, + " file on disk.")
-
-        # 4) Sort bedgraph file by chromosome id and co-ordinates
-        sorted_bedgraph_file = bedgraph_file + "_sorted"
-        sort_cmd = "sort -k1,1 -k2,2n " + bedgraph_file + "> " + sorted_bedgraph_file
-        self._run_cmd(sort_cmd)
-
-        # 5) Convert sorted bedgraph to bigwig format using utility bedgraphTOBigWig tool
-        output_bigwig_file = bedgraph_file + "_bigwig.bw"
-        cmd = BEDGRAPHTOBIGWIG + " " + sorted_bedgraph_file + " " + chr_length_path + " " + output_bigwig_file
-        logging.info("Generating bigwig ..\n" + cmd + "\n")
-        self._run_cmd(cmd)
+        chr_lengths = dict(self.assembly_metadata.contigs(assembly_ref).items())
+
+        # 2) Caclculate number of SNPs in each bin
+        if density is None or binsize not in density.binsizes:
+            logging.info("Counting variants per bin\n")
+            density = VCFIngest(binsizes=(binsize,), threads=self.threads).scan(vcf_filepath)['density']
+
+        # 3), 4), 5) Write the bins, clipped to the contig lengths, to a bigwig
+        #    file with zoom levels (see BigWigWriter)
+        output_bigwig_file = os.path.join(self.session_dir, "vcf_bedgraph.txt_bigwig.bw")
+        logging.info("Generating bigwig " + output_bigwig_file + "\n")
+        with BigWigWriter(output_bigwig_file, chr_lengths.items()) as bigwig:
+            for chromosome, starts, ends, counts in density.arrays(binsize, chr_lengths):
+                bigwig.add(chromosome, starts, ends, counts)
 
         # 6) upload bigwig file to shock
         logging.info("Uploading Bigwig file to shock")
-        if os.path.exists(output_bigwig_file):
-            bigwig_shock_ref = self.dfu.file_to_shock(
-                {'file_path': output_bigwig_file, 'make_handle': 1}
-            )
+        bigwig_shock_ref = self.uploads.upload(
+            {'file_path': output_bigwig_file, 'make_handle': 1}
+        ).result()
         # 7) Append shock handle to genomic_indexes
         shock_handles.append(bigwig_shock_ref['handle'])
 
@@ -260,11 +206,56 @@ class JbrowseUtil:
         return {"shock_handle_list": shock_handles, "track_item": snp_frequency_track_dict}
 
 
-    def prepare_snp_track(self, vcf_shock_id, vcf_index_shock_id, vfs_url):
+    def prepare_genotype_tracks(self, genotype_density, assembly_ref, vfs_url):
+        """
+        Builds heterozygosity and missingness tracks of the samples selected
+        during VCF ingestion
+
+        :param genotype_density: GenotypeDensity of the selected samples
+        :param assembly_ref:
+        :return: shock handles and track items
+        """
+        chr_lengths = dict(self.assembly_metadata.contigs(assembly_ref).items())
+        labels = {"het": "heterozygosity", "missing": "missing calls"}
+
+        # 1) Write one bigwig per sample and track kind, uploads start
+        #    while the next file is written
+        uploads = list()
+        for i, sample in enumerate(genotype_density.samples):
+            for kind in TRACK_KINDS:
+                bigwig_file = os.path.join(self.session_dir,
+                                           "genotype_" + str(i) + "_" + kind + ".bw")
+                with BigWigWriter(bigwig_file, chr_lengths.items()) as bigwig:
+                    for contig, starts, ends, rates in genotype_density.arrays(sample, kind,
+                                                                               chr_lengths):
+                        bigwig.add(contig, starts, ends, rates)
+                uploads.append((sample, kind, self.uploads.upload(
+                    {'file_path': bigwig_file, 'make_handle': 1})))
+
+        # 2) Build tracks from the shock handles
+        shock_handles = list()
+        track_items = list()
+        for sample, kind, upload in uploads:
+            handle = upload.result()['handle']
+            shock_handles.append(handle)
+            track_items.append({
+                "label": sample + " " + labels[kind],
+                "key": sample + "_" + kind + "_rate",
+                "storeClass": "JBrowse/Store/SeqFeature/BigWig",
+                "urlTemplate": vfs_url + "/" + handle['id'],
+                "type": "JBrowse/View/Track/Wiggle/XYPlot",
+                "min_score": 0,
+                "max_score": 1
+            })
+        return {"shock_handle_list": shock_handles, "track_items": track_items}
+
+    def prepare_snp_track(self, vcf_shock_id, vcf_index_shock_id, vfs_url,
+                          index_template="tbiUrlTemplate"):
         """
 
         :param vcf_shock_id:
         :param vcf_index_shock_id:
+        :param index_template: "csiUrlTemplate" for a .csi vcf index
         :return:
         """
         shock_handles = list()
@@ -275,12 +266,13 @@ class JbrowseUtil:
                 "key": "Variation", 
                 "storeClass": "JBrowse/Store/SeqFeature/VCFTabix", 
                 "urlTemplate": "<vfs_url>/<vcf_shock_id>", 
-                "tbiUrlTemplate": "<vfs_url>/<vcf_index_shock_id>", 
+                "<index_template>": "<vfs_url>/<vcf_index_shock_id>", 
                 "type": "JBrowse/View/Track/HTMLVariants"
             }
         '''
         snp_track = snp_track.replace("<vcf_shock_id>", vcf_shock_id)
         snp_track = snp_track.replace("<vcf_index_shock_id>", vcf_index_shock_id)
+        snp_track = snp_track.replace("<index_template>", index_template)
         snp_track = snp_track.replace("<vfs_url>", vfs_url)
         snp_track_dict = json.loads(snp_track)
         # shock handles should be empty list in return when built from shock ids
@@ -288,8 +280,8 @@ class JbrowseUtil:
 
     def build_jbrowse_data_folder(self, jbrowse_path):
         shock_handles = list()
-        data_folder_shock_ref = self.dfu.file_to_shock({'file_path': jbrowse_path,
-                                            'pack': 'zip', 'make_handle': 1})
+        data_folder_shock_ref = self.uploads.upload({'file_path': jbrowse_path,
+                                                     'pack': 'zip', 'make_handle': 1}).result()
         shock_handles.append(data_folder_shock_ref['handle'])
         return {"shock_handle_list": shock_handles}
 
@@ -359,10 +351,12 @@ class JbrowseUtil:
             raise ValueError ("assembly ref not found")
             return
 
-        # 2) Build genome features track
-        if 'genome_ref' in jbrowse_params:
-            genome_ref = jbrowse_params['genome_ref']
-            output = self.prepare_genome_features_track(genome_ref, vfs_url)
+        # 2) Build genome features track, unless it was built beforehand
+        #    (genome_features, output of prepare_genome_features_track)
+        if jbrowse_params.get('genome_features') or 'genome_ref' in jbrowse_params:
+            output = jbrowse_params.get('genome_features')
+            if output is None:
+                output = self.prepare_genome_features_track(jbrowse_params['genome_ref'], vfs_url)
             shock_handles, track_item = output["shock_handle_list"], output["track_item"]
             genomic_indexes = genomic_indexes + shock_handles
             tracklist_items.append(track_item)
@@ -378,7 +372,9 @@ class JbrowseUtil:
             vcf_path = jbrowse_params['vcf_path']
             assembly_ref = jbrowse_params['assembly_ref']
             binsize = jbrowse_params["binsize"]
-            output = self.prepare_snp_frequency_track(vcf_path, assembly_ref, binsize, vfs_url)
+            density = jbrowse_params.get("density")
+            output = self.prepare_snp_frequency_track(vcf_path, assembly_ref, binsize, vfs_url,
+                                                      density)
             shock_handles, track_item = output["shock_handle_list"], output["track_item"]
             if shock_handles:
                 genomic_indexes = genomic_indexes + shock_handles
@@ -386,13 +382,26 @@ class JbrowseUtil:
         else:
             print ("Skipping SNP frequency track")
 
+        # Per sample heterozygosity and missingness tracks, only for the
+        # samples selected for them
+        genotype_density = jbrowse_params.get("genotype_density")
+        if genotype_density is not None and genotype_density.samples:
+            output = self.prepare_genotype_tracks(genotype_density,
+                                                  jbrowse_params['assembly_ref'], vfs_url)
+            genomic_indexes = genomic_indexes + output["shock_handle_list"]
+            tracklist_items.extend(output["track_items"])
+
         # 4) Build SNP track
         cond1 = 'vcf_shock_id' in jbrowse_params
         cond2 = 'vcf_index_shock_id' in jbrowse_params
         if cond1 and cond2:
             vcf_shock_id = jbrowse_params['vcf_shock_id']
             vcf_index_shock_id = jbrowse_params['vcf_index_shock_id']
-            output = self.prepare_snp_track(vcf_shock_id, vcf_index_shock_id, vfs_url)
+            # the vcf index is .csi for contigs longer than 2^29
+            vcf_index_path = jbrowse_params.get('vcf_index_path') or ""
+            index_template = "csiUrlTemplate" if vcf_index_path.endswith(".csi") else "tbiUrlTemplate"
+            output = self.prepare_snp_track(vcf_shock_id, vcf_index_shock_id, vfs_url,
+                                            index_template)
             shock_handles, track_item = output["shock_handle_list"], output["track_item"]
             genomic_indexes = genomic_indexes + shock_handles
             tracklist_items.append(track_item)
@@ -0,0 +1,137 @@
+from array import array
+
+import numpy as np
+
+# Resolutions (bp) of the variant density, finest first
+DENSITY_BINSIZES = (1000, 10000, 100000)
+# Number of positions of a contig buffered before they are counted
+FLUSH_SIZE = 1 << 16
+
+
+class SNPDensity:
+    """
+    Number of variants per bin of each contig at several resolutions,
+    counted in one pass over the vcf:
+
+        density = SNPDensity((1000, 10000, 100000))
+        for record in records:
+            density.add(CHROM, int(POS) - 1)
+        for contig, start, end, count in density.intervals(10000, lengths):
+            ...
+
+    Positions (0-based) are buffered per contig in an int64 array and
+    counted with numpy bincount at every resolution when the buffer is
+    full, so memory stays proportional to the number of bins.
+    """
+
+    def __init__(self, binsizes=DENSITY_BINSIZES):
+        self.binsizes = tuple(sorted(set(binsizes)))
+        # contig -> binsize -> counts per bin
+        self._counts = dict()
+        self._buffers = dict()
+
+    def __contains__(self, contig):
+        return contig in self._counts
+
+    def contigs(self):
+        """
+        :return: contig ids in sorted order, the order of bedgraph and
+                 bigwig files
+        """
+        return sorted(self._counts)
+
+    def _add_counts(self, contig, binsize, counts):
+        current = self._counts[contig][binsize]
+        if len(counts) > len(current):
+            counts = counts.copy()
+            counts[:len(current)] += current
+            self._counts[contig][binsize] = counts
+        else:
+            current[:len(counts)] += counts
+
+    def _flush(self, contig):
+        buffer = self._buffers[contig]
+        if not buffer:
+            return
+        positions = np.frombuffer(buffer, dtype=np.int64)
+        for binsize in self.binsizes:
+            self._add_counts(contig, binsize, np.bincount(positions // binsize))
+        self._buffers[contig] = array("q")
+
+    def _new_contig(self, contig):
+        self._counts[contig] = {binsize: np.zeros(0, dtype=np.int64)
+                                for binsize in self.binsizes}
+        buffer = self._buffers[contig] = array("q")
+        return buffer
+
+    def add(self, contig, pos):
+        """
+        :param pos: 0-based position of the variant
+        """
+        buffer = self._buffers.get(contig)
+        if buffer is None:
+            buffer = self._new_contig(contig)
+        buffer.append(pos)
+        if len(buffer) >= FLUSH_SIZE:
+            self._flush(contig)
+
+    def add_positions(self, contig, positions):
+        """
+        :param positions: numpy array of 0-based positions
+        """
+        if contig not in self._counts:
+            self._new_contig(contig)
+        positions = np.asarray(positions, dtype=np.int64)
+        for binsize in self.binsizes:
+            self._add_counts(contig, binsize, np.bincount(positions // binsize))
+
+    def counts(self, contig, binsize):
+        """
+        :return: numpy array of the number of variants in each bin of the
+                 contig, bin i covers [i * binsize, (i + 1) * binsize)
+        """
+        if binsize not in self.binsizes:
+            raise ValueError("No variant density at " + str(binsize) + " bp resolution")
+        self._flush(contig)
+        return self._counts[contig][binsize]
+
+    def contig_counts(self, contig):
+        """
+        :return: dict of binsize to counts of one contig, see merge
+        """
+        return {binsize: self.counts(contig, binsize) for binsize in self.binsizes}
+
+    def merge(self, contig, counts):
+        """
+        Adds counts of a contig (or a region of it) counted separately
+        :param counts: output of contig_counts of another SNPDensity
+        """
+        if contig not in self._counts:
+            self._new_contig(contig)
+        for binsize in self.binsizes:
+            self._add_counts(contig, binsize, counts[binsize])
+
+    def arrays(self, binsize, contig_lengths=None):
+        """
+        Non empty bins of each contig in contig order (see contigs)
+        :param contig_lengths: dict like contig id -> length, bins are
+                               clipped to the end of the contig
+        :return: generator of (contig, starts, ends, counts) numpy arrays
+        """
+        for contig in self.contigs():
+            counts = self.counts(contig, binsize)
+            bins = np.flatnonzero(counts)
+            starts = bins * binsize
+            ends = starts + binsize
+            if contig_lengths is not None:
+                np.minimum(ends, int(contig_lengths[contig]), out=ends)
+            yield contig, starts, ends, counts[bins]
+
+    def intervals(self, binsize, contig_lengths=None):
+        """
+        Non empty bins in contig order and position order, see arrays
+        :return: generator of (contig, start, end, count)
+        """
+        for contig, starts, ends, counts in self.arrays(binsize, contig_lengths):
+            for start, end, count in zip(starts.tolist(), ends.tolist(), counts.tolist()):
+                yield contig, start, end, count
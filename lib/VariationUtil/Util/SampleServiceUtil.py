@@ -1,10 +1,18 @@
 
+import hashlib
 import json
-import requests
+import logging
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
 
+from installed_clients.baseclient import get_session
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.SampleServiceClient import SampleService
+from VariationUtil.Util.AttributeMappingBuilder import AttributeMappingBuilder
+from VariationUtil.Util.DiskCache import DiskCache, DEFAULT_CACHE_SIZE
+from VariationUtil.Util.ServiceResolver import ServiceResolver
 
 
 class SampleServiceUtil:
@@ -26,29 +34,54 @@ class SampleServiceUtil:
         self.scratch = config['scratch']
         self.token = config['KB_AUTH_TOKEN']
         self.srv_wiz_url = config['srv-wiz-url']
+        self.resolver = ServiceResolver(self.srv_wiz_url)
+        # Number of samples fetched from the SampleService at the same time
+        self.sample_threads = int(config.get('sample_threads') or 10)
+        # Optional on-disk cache of sample documents, a version of a
+        # sample never changes so they are kept across jobs. Entries are
+        # keyed by the token as well, a cached sample is only returned to
+        # a user the SampleService already gave it to
+        self.sample_cache = None
+        self.token_hash = hashlib.sha256(self.token.encode("utf-8")).hexdigest()
+        if config.get('sample_cache_dir'):
+            self.sample_cache = DiskCache(config['sample_cache_dir'],
+                                          int(config.get('sample_cache_size') or DEFAULT_CACHE_SIZE))
         self.dfu = DataFileUtil(self.callback_url)
         self.sample_ser = SampleService(self.callback_url)
 
     def get_sample_service_url(self):
 
-        payload = {
-            "method": "ServiceWizard.get_service_status",
-            "id": '',
-            "params": [{"module_name": "SampleService", "version": "dev"}],  # TODO: change to beta/release
-            "version": "1.1"
-        }
+        # TODO: change to beta/release
+        return self.resolver.get_url("SampleService", "dev")
 
-        sw_resp = requests.post(url=self.srv_wiz_url, data=json.dumps(payload))
-        wiz_resp = sw_resp.json()
-        if wiz_resp.get('error'):
-            raise RuntimeError("ServiceWizard Error - " + str(wiz_resp['error']))
-
-        return wiz_resp['result'][0]['url']
+    def _post_sample_service(self, payload):
+        """
+        posts a JSON-RPC payload to the SampleService, the cached service
+        url is dropped when the call shows it is no longer valid
+        """
+        sample_url = self.get_sample_service_url()
+        headers = {"Authorization": self.token}
+        try:
+            resp = get_session().post(url=sample_url, headers=headers,
+                                      data=json.dumps(payload, default=str))
+        except requests.exceptions.RequestException:
+            self.resolver.invalidate("SampleService", "dev")
+            raise
+        if self.resolver.is_stale_response(resp):
+            self.resolver.invalidate("SampleService", "dev")
+        return resp
 
     def get_sample(self, sample_id, version=None):
 
-        sample_url = self.get_sample_service_url()
-        headers = {"Authorization": self.token}
+        # only a sample with an explicit version can be cached
+        cache_key = None
+        if self.sample_cache is not None and version is not None:
+            cache_key = ("sample:" + self.token_hash + ":" + str(sample_id)
+                         + ":" + str(version))
+            sample = self.sample_cache.get_json(cache_key)
+            if sample is not None:
+                return sample
+
         params = {
             "id": sample_id,
             "version": version
@@ -59,23 +92,49 @@ class SampleServiceUtil:
             "params": [params],
             "version": "1.1"
         }
-        resp = requests.post(url=sample_url, headers=headers, data=json.dumps(payload))
+        resp = self._post_sample_service(payload)
         resp_json = resp.json()
         if resp_json.get('error'):
             raise RuntimeError(f"Error from SampleService - {resp_json['error']}")
         sample = resp_json['result'][0]
 
         # sample = self.sample_ser.get_sample(params)[0]
+        if cache_key is not None:
+            self.sample_cache.put_json(cache_key, sample)
 
         return sample
 
+    def get_samples(self, samples):
+        """
+        fetches samples concurrently, at most sample_threads at a time
+        :param samples: list of {'id': ..., 'version': ...} as in a SampleSet
+        :return: sample documents in the order of samples
+        """
+        with ThreadPoolExecutor(max_workers=self.sample_threads) as executor:
+            futures = [executor.submit(self.get_sample, sample.get('id'),
+                                       version=sample.get('version'))
+                       for sample in samples]
+
+        sample_datas = list()
+        errors = list()
+        for sample, future in zip(samples, futures):
+            try:
+                sample_datas.append(future.result())
+            except Exception as e:
+                errors.append(f"{sample.get('name', sample.get('id'))} "
+                              f"({sample.get('id')} version {sample.get('version')}): {e}")
+        if errors:
+            for error in errors:
+                logging.error("Failed to fetch sample " + error)
+            raise RuntimeError(f"Failed to fetch {len(errors)} of {len(samples)} samples:\n"
+                               + "\n".join(errors))
+        return sample_datas
+
     def save_sample(self, sample):
         """
         copied from sample_uploader
         (https://github.com/kbaseapps/sample_uploader/blob/master/lib/sample_uploader/utils/sample_utils.py#L79)
         """
-        sample_url = self.get_sample_service_url()
-        headers = {"Authorization": self.token}
         params = {
             "sample": sample,
             "prior_version": None,
@@ -86,7 +145,7 @@ class SampleServiceUtil:
             "params": [params],
             "version": "1.1"
         }
-        resp = requests.post(url=sample_url, headers=headers, data=json.dumps(payload, default=str))
+        resp = self._post_sample_service(payload)
         if not resp.ok:
             raise RuntimeError(f'Error from SampleService - {resp.text}')
         resp_json = resp.json()
@@ -117,8 +176,6 @@ class SampleServiceUtil:
                     'version': 1,
                     'node': 'root',}]
         """
-        sample_url = self.get_sample_service_url()
-        headers = {"Authorization": self.token}
         params = {
             "id": sample_id,
             "upa": upa,
@@ -132,78 +189,26 @@ class SampleServiceUtil:
             "params": [params],
             "version": "1.1"
         }
-        resp = requests.post(url=sample_url, headers=headers, data=json.dumps(payload, default=str))
+        resp = self._post_sample_service(payload)
         if not resp.ok:
             raise RuntimeError(f'Error from SampleService - {resp.text}')
         resp_json = resp.json()
         if resp_json.get('error'):
             raise RuntimeError(f"Error from SampleService - {resp_json['error']}")
 
-    def sample_set_to_attribute_mapping(self, sample_set_ref):
-
-        sample_set = self.dfu.get_objects(
-                    {"object_refs": [sample_set_ref]})['data'][0]['data']
+    def sample_set_to_attribute_mapping(self, sample_set_ref, sample_set=None):
+        """
+        :param sample_set: data of the SampleSet object if already fetched
+        """
+        if sample_set is None:
+            sample_set = self.dfu.get_objects(
+                        {"object_refs": [sample_set_ref]})['data'][0]['data']
 
         samples = sample_set['samples']
 
-        am_data = {'ontology_mapping_method': "SampleService", 'instances': {}}
-
-        attributes = list()
-
-        sample_datas = []
-        for sample in samples:
-            sample_id = sample.get('id')
-            version = sample.get('version')
-
-            sample_data = self.get_sample(sample_id, version=version)
-
-            node_tree = sample_data.get('node_tree', [{}])
-
-            for node in node_tree:
-                meta_controlled = node.get('meta_controlled')
-                meta_user = node.get('meta_user')
-
-                if meta_controlled:
-                    attributes_controlled = self._fetch_attri_from_meta(meta_controlled)
-                    attributes += attributes_controlled
-
-                if meta_user:
-                    attributes_user = self._fetch_attri_from_meta(meta_user)
-                    attributes += attributes_user
-
-            sample_datas.append(sample_data)
-
-        attributes = [i for n, i in enumerate(attributes) if i not in attributes[n + 1:]]
-        attributes = [{'attribute': 'id', 'source': 'SampleService'},
-                      {'attribute': 'type', 'source': 'SampleService'},
-                      {'attribute': 'parent', 'source': 'SampleService'}] + attributes
-
-        am_data['attributes'] = attributes
-
-        instances = am_data['instances']
-
-        for sample_data in sample_datas:
-            instance = list()
-            node_tree = sample_data.get('node_tree', [{}])
-
-            for node in node_tree:
-
-                meta_controlled = node.get('meta_controlled')
-                meta_user = node.get('meta_user')
-
-                for attribute in attributes:
-                    attri_name = attribute['attribute']
-
-                    if attri_name in ['id', 'type', 'parent']:
-                        instance.append(node.get(attri_name))
-                    else:
-                        if meta_user:
-                            instance.append(meta_user.get(attri_name, {}).get('value'))
-                        elif meta_controlled:
-                            instance.append(meta_controlled.get(attri_name, {}).get('value'))
-
-            instance = [str(i) for i in instance]
-
-            instances[sample_data['name']] = instance
+        builder = AttributeMappingBuilder(self._fetch_attri_from_meta)
+        for sample_data in self.get_samples(samples):
+            builder.add_sample(sample_data)
+        am_data = builder.build()
 
         return am_data
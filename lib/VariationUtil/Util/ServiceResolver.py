@@ -0,0 +1,70 @@
+import json
+import logging
+import threading
+import time
+
+from installed_clients.baseclient import get_session
+
+# Seconds a service url from the service wizard is used before asking again
+DEFAULT_TTL = 300
+# Responses that mean the resolved url no longer points to a running service
+STALE_URL_STATUS = (404, 502, 503, 504)
+
+
+class ServiceResolver:
+    """
+    Process-wide cache of dynamic service urls from the ServiceWizard
+
+        resolver = ServiceResolver(sw_url)
+        url = resolver.get_url("SampleService", "dev")
+
+    Urls are kept for ttl seconds. Callers invalidate() the url when a
+    call to it fails (see is_stale_response) so the next call asks the
+    service wizard again.
+    """
+
+    _urls = dict()
+    _lock = threading.Lock()
+
+    def __init__(self, sw_url, ttl=DEFAULT_TTL):
+        self.sw_url = sw_url
+        self.ttl = ttl
+
+    def _lookup(self, module_name, version):
+        payload = {
+            "method": "ServiceWizard.get_service_status",
+            "id": '',
+            "params": [{"module_name": module_name, "version": version}],
+            "version": "1.1"
+        }
+        sw_resp = get_session().post(url=self.sw_url, data=json.dumps(payload))
+        wiz_resp = sw_resp.json()
+        if wiz_resp.get('error'):
+            raise RuntimeError("ServiceWizard Error - " + str(wiz_resp['error']))
+        return wiz_resp['result'][0]['url']
+
+    def get_url(self, module_name, version):
+        """
+        :return: url of the dynamic service
+        """
+        key = (self.sw_url, module_name, version)
+        with self._lock:
+            cached = self._urls.get(key)
+            if cached is not None and cached[1] > time.time():
+                return cached[0]
+        url = self._lookup(module_name, version)
+        with self._lock:
+            self._urls[key] = (url, time.time() + self.ttl)
+        return url
+
+    def invalidate(self, module_name, version):
+        with self._lock:
+            if self._urls.pop((self.sw_url, module_name, version), None) is not None:
+                logging.info("Dropped cached url of " + module_name + " " + version)
+
+    @staticmethod
+    def is_stale_response(resp):
+        """
+        :param resp: requests response of a call to a resolved url
+        """
+        return resp.status_code in STALE_URL_STATUS
@@ -0,0 +1,126 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def check_cancelled(cancelled):
+    """
+    Stops a long running stage once the run it belongs to was cancelled
+    :param cancelled: StageScheduler.cancelled or None
+    """
+    if cancelled is not None and cancelled.is_set():
+        raise RuntimeError("Stage cancelled after another stage failed")
+
+
+class StageScheduler:
+    """
+    Runs the stages of an import as a dependency graph, each stage as soon
+    as the stages it depends on are done:
+
+        stages = StageScheduler()
+        stages.add("vcf", compress_vcf)
+        stages.add("samples", fetch_samples)
+        stages.add("strains", match_strains, after=("vcf", "samples"))
+        results = stages.run()
+
+    A stage function is called with the results of its dependencies as
+    keyword arguments named after the stages. Stages run on threads; the
+    cpu heavy parts (vcf compression, region parsing) have their own
+    thread and process pools.
+
+    The first failing stage stops the run: the cancelled event is set,
+    stages that have not started are cancelled and the exception of the
+    failed stage is raised right away. Running stages are not waited for,
+    long stages stop at their next check_cancelled(stages.cancelled).
+    Wall time of each finished stage is kept in timings.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self.stages = dict()
+        self.timings = dict()
+        # set when a stage failed, see check_cancelled
+        self.cancelled = threading.Event()
+
+    def add(self, name, func, after=()):
+        """
+        :param name: stage name, used as the keyword argument of its result
+        :param func: stage function
+        :param after: names of the stages this stage depends on
+        """
+        if name in self.stages:
+            raise ValueError("Stage " + name + " is already defined")
+        self.stages[name] = (func, tuple(after))
+
+    def _check(self):
+        for name, (func, after) in self.stages.items():
+            for dependency in after:
+                if dependency not in self.stages:
+                    raise ValueError("Stage " + name + " depends on unknown stage " + dependency)
+
+        # depth first search for cycles
+        visiting, done = set(), set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError("Stage " + name + " is part of a dependency cycle")
+            visiting.add(name)
+            for dependency in self.stages[name][1]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _run_stage(self, name, func, kwargs):
+        start = time.time()
+        logging.info("Stage " + name + " started")
+        try:
+            return func(**kwargs)
+        finally:
+            self.timings[name] = time.time() - start
+            logging.info("Stage " + name + " finished in "
+                         + str(round(self.timings[name], 2)) + " seconds")
+
+    def run(self):
+        """
+        :return: dict of stage name to stage result
+        """
+        self._check()
+        results = dict()
+        waiting = dict(self.stages)
+        running = dict()
+        workers = self.max_workers or max(len(self.stages), 1)
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while waiting or running:
+                for name, (func, after) in list(waiting.items()):
+                    if all(dependency in results for dependency in after):
+                        kwargs = {dependency: results[dependency] for dependency in after}
+                        running[executor.submit(self._run_stage, name, func, kwargs)] = name
+                        del waiting[name]
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is not None:
+                        logging.error("Stage " + name + " failed, cancelling "
+                                      + ", ".join(list(waiting) + list(running.values())))
+                        self.cancelled.set()
+                        raise error
+                    results[name] = future.result()
+        finally:
+            # all stages are done unless one failed, in which case the
+            # running ones are left to stop on their own
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        logging.info("Stage timings (seconds): " + ", ".join(
+            name + "=" + str(round(seconds, 2)) for name, seconds in self.timings.items())
+            + ", total=" + str(round(time.time() - start, 2)))
+        return results
@@ -1,6 +1,7 @@
 import os
 from installed_clients.DataFileUtilClient import DataFileUtil
 from VariationUtil.Util.SampleServiceUtil import SampleServiceUtil
+from VariationUtil.Util.StrainReconciler import StrainReconciler
 import logging
 
 class StrainInfo:
@@ -11,49 +12,31 @@ class StrainInfo:
         self.dfu = DataFileUtil(self.callback_url)
         self.sampleservice_util = SampleServiceUtil(config)
 
-    def _sampleset_to_strain_info(self, sample_set_ref, vcf_strain_ids):
+    def _sampleset_to_strain_info(self, reconciler, vcf_strain_ids):
         '''
-        :param sample_set_ref:
+        :param reconciler: StrainReconciler of the sample set
         :param vcf_strain_ids:
         :return: StrainInfo
         order of StrainInfo should be same as order of vcf_strain_ids
         '''
-        sample_set = self.dfu.get_objects({"object_refs": [sample_set_ref]})['data'][0]['data']
-        samples = sample_set['samples']
-        sample_dict = {}
-        for sample in samples:
-            name = sample['name']
-            sample_dict[name] = {
-                "name":name,
-                "sample_id": sample['id'],
-                "version": sample['version']
-            }
-        StrainInfo = []
-        missing_strains = []
-        duplicated_strains = []
-        seen_strain = {}
-        for strain in vcf_strain_ids:
-            if strain in seen_strain:
-                duplicated_strains.append(strain)
-            else:
-                seen_strain[strain]=1
-
-            if strain not in sample_dict:
-                missing_strains.append(strain)
-            else:
-                StrainInfo.append(sample_dict[strain])
+        result = reconciler.reconcile(vcf_strain_ids)
 
+        duplicated_strains = result['duplicated']
+        missing_strains = result['missing']
         dup_strains = ", ".join (duplicated_strains)
         if duplicated_strains:
             raise ValueError(f'duplicated strain ids need to be fixed in vcf file - {dup_strains}')
         if missing_strains:
             strains_not_found = ", ". join (missing_strains)
+            hints = "; ".join(f"{strain} -> {', '.join(names)}"
+                              for strain, names in result['normalised_matches'].items())
+            if hints:
+                strains_not_found += f' (names differ only in case or spaces: {hints})'
             raise ValueError (f'Missing strains from sample set {strains_not_found}')
 
-        return (StrainInfo)
+        return (result['matches'])
 
-    def _sample_set_to_attribute_mapping(self, axis_ids, sample_set_ref, obj_name, ws_id):
-        am_data = self.sampleservice_util.sample_set_to_attribute_mapping(sample_set_ref)
+    def _save_attribute_mapping(self, axis_ids, am_data, obj_name, ws_id):
         unmatched_ids = set(axis_ids) - set(am_data['instances'].keys())
         if unmatched_ids:
             name = "Column"
@@ -74,14 +57,28 @@ class StrainInfo:
         sample_attribute_ref = str(info[6]) + "/" + str(info[0]) + "/" + str(info[4])
         return (sample_attribute_ref)
 
-    def sample_strain_info(self, params):
+    def prepare_sample_set(self, sample_set_ref):
+        """
+        Fetches the sample set and builds its attribute mapping, neither
+        needs the vcf file so this can run while the vcf is compressed
+        :return: (StrainReconciler, attribute mapping data)
+        """
+        # The sample set is fetched once for both steps
+        reconciler = StrainReconciler.from_ref(self.dfu, sample_set_ref)
+        am_data = self.sampleservice_util.sample_set_to_attribute_mapping(sample_set_ref,
+                                                                         reconciler.sample_set)
+        return reconciler, am_data
+
+    def sample_strain_info(self, params, prepared=None):
+        """
+        :param prepared: result of prepare_sample_set, fetched here if not given
+        """
         vcf_strain_ids = params["vcf_strain_ids"]
         sample_set_ref = params["sample_set_ref"]
         ws_id = params["ws_id"]
         obj_name = params["sample_attribute_name"]
 
-        sample_attribute_ref = self._sample_set_to_attribute_mapping(vcf_strain_ids, sample_set_ref, obj_name, ws_id)
-        strains = self._sampleset_to_strain_info (sample_set_ref, vcf_strain_ids)
+        reconciler, am_data = prepared or self.prepare_sample_set(sample_set_ref)
+        sample_attribute_ref = self._save_attribute_mapping(vcf_strain_ids, am_data, obj_name, ws_id)
+        strains = self._sampleset_to_strain_info (reconciler, vcf_strain_ids)
         return (sample_attribute_ref, strains)
-
-
@@ -0,0 +1,70 @@
+def normalise_name(name):
+    return name.upper().strip()
+
+
+class StrainReconciler:
+    """
+    Matches the strain ids of a vcf file (#CHROM sample columns) to the
+    samples of a KBaseSets.SampleSet, with hash indexes on the exact and
+    the normalised (upper case, stripped) sample names
+
+        reconciler = StrainReconciler.from_ref(dfu, sample_set_ref)
+        result = reconciler.reconcile(vcf_strain_ids)
+    """
+
+    def __init__(self, sample_set):
+        """
+        :param sample_set: data of the SampleSet object
+        """
+        self.sample_set = sample_set
+        self.samples = sample_set['samples']
+        self.by_name = dict()
+        self.by_normalised_name = dict()
+        for sample in self.samples:
+            self.by_name[sample['name']] = sample
+            self.by_normalised_name.setdefault(normalise_name(sample['name']), list()).append(sample)
+
+    @classmethod
+    def from_ref(cls, dfu, sample_set_ref):
+        sample_set = dfu.get_objects({"object_refs": [sample_set_ref]})['data'][0]['data']
+        return cls(sample_set)
+
+    def reconcile(self, vcf_strain_ids):
+        """
+        :return: dict with
+            matches - {name, sample_id, version} of each strain with a sample
+                      of the same name, in the order of vcf_strain_ids
+            missing - strains without a sample of the same name
+            duplicated - strains that appear more than once in vcf_strain_ids
+            normalised_matches - {strain: [sample names]} for missing strains
+                                 that only match after normalising the names
+        """
+        matches = list()
+        missing = list()
+        duplicated = list()
+        normalised_matches = dict()
+        seen = set()
+        for strain in vcf_strain_ids:
+            if strain in seen:
+                duplicated.append(strain)
+            else:
+                seen.add(strain)
+
+            sample = self.by_name.get(strain)
+            if sample is None:
+                missing.append(strain)
+                candidates = self.by_normalised_name.get(normalise_name(strain))
+                if candidates:
+                    normalised_matches[strain] = [c['name'] for c in candidates]
+            else:
+                matches.append({
+                    "name": sample['name'],
+                    "sample_id": sample['id'],
+                    "version": sample['version']
+                })
+        return {
+            "matches": matches,
+            "missing": missing,
+            "duplicated": duplicated,
+            "normalised_matches": normalised_matches
+        }
@@ -0,0 +1,123 @@
+import json
+import logging
+
+from installed_clients.baseclient import BaseClient
+
+# Maximum size of the data of one workspace object
+WORKSPACE_OBJECT_LIMIT = 1 << 30
+# Items of a streamed list encoded and written together
+BATCH_SIZE = 1000
+
+
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Object of type " + type(obj).__name__ + " is not JSON serializable")
+
+
+class StreamingJSONWriter:
+    """
+    JSON encoder that writes to a file handle while it walks the object,
+    so that lists produced by generators are never held in memory
+
+    Dicts, plain lists and tuples are walked; lists that are not plain
+    lists (e.g. VCFReaderStream, which has no items of its own) and other
+    iterators are iterated and each item is encoded in one piece.
+
+    The bytes written for each value under data_key (the workspace object
+    data of save_objects parameters) are counted, and writing stops with
+    a ValueError as soon as one of them exceeds size_limit.
+    """
+
+    def __init__(self, handle, size_limit=WORKSPACE_OBJECT_LIMIT, data_key="data"):
+        self.handle = handle
+        self.size_limit = size_limit
+        self.data_key = data_key
+        self.bytes_written = 0
+        self.data_bytes = 0
+        self._object_bytes = 0
+        self._in_data = False
+        self._streamed_items = 0
+        self._encoder = json.JSONEncoder(default=_default)
+
+    def _write(self, text):
+        data = text.encode("utf-8")
+        self.handle.write(data)
+        self.bytes_written += len(data)
+        if self._in_data:
+            self.data_bytes += len(data)
+            self._object_bytes += len(data)
+            if self.size_limit and self._object_bytes > self.size_limit:
+                raise ValueError(
+                    "The object is larger than the workspace object size limit of "
+                    + str(self.size_limit) + " bytes (limit reached after "
+                    + str(self._streamed_items) + " streamed items). "
+                    + "Use a vcf with fewer samples or variants.")
+
+    @staticmethod
+    def _is_streamed(value):
+        if isinstance(value, (dict, str, bytes)):
+            return False
+        if isinstance(value, list):
+            return type(value) is not list
+        return hasattr(value, "__iter__") and not isinstance(value, (tuple, set, frozenset))
+
+    def write(self, value):
+        if isinstance(value, dict):
+            self._write("{")
+            for i, (key, item) in enumerate(value.items()):
+                self._write((", " if i else "") + self._encoder.encode(str(key)) + ": ")
+                if key == self.data_key and not self._in_data:
+                    self._in_data = True
+                    self._object_bytes = 0
+                    self.write(item)
+                    self._in_data = False
+                else:
+                    self.write(item)
+            self._write("}")
+        elif self._is_streamed(value):
+            self._write_stream(value)
+        elif isinstance(value, (list, tuple)):
+            self._write("[")
+            for i, item in enumerate(value):
+                if i:
+                    self._write(", ")
+                self.write(item)
+            self._write("]")
+        else:
+            self._write(self._encoder.encode(value))
+
+    def _write_stream(self, items):
+        self._write("[")
+        batch = list()
+        first = True
+        for item in items:
+            batch.append(self._encoder.encode(item))
+            self._streamed_items += 1
+            if len(batch) >= BATCH_SIZE:
+                self._write(("" if first else ", ") + ", ".join(batch))
+                batch = list()
+                first = False
+        if batch:
+            self._write(("" if first else ", ") + ", ".join(batch))
+        self._write("]")
+
+
+def save_objects_streaming(callback_url, params, scratch, size_limit=WORKSPACE_OBJECT_LIMIT):
+    """
+    DataFileUtil.save_objects with the request body streamed from a file
+    in scratch instead of being built as one string in memory
+    :param callback_url: url of the DataFileUtil callback server
+    :param params: save_objects parameters, see StreamingJSONWriter for
+                   the values that are streamed
+    :return: same as DataFileUtil.save_objects
+    """
+    def write_body(request, handle):
+        writer = StreamingJSONWriter(handle, size_limit)
+        writer.write(request)
+        logging.info("Saving objects, request body is " + str(writer.bytes_written)
+                     + " bytes, object data " + str(writer.data_bytes) + " bytes")
+
+    client = BaseClient(callback_url)
+    return client.run_job("DataFileUtil.save_objects", [params], "release",
+                          body_writer=write_body, body_dir=scratch)
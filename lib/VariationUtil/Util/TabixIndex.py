@@ -0,0 +1,354 @@
+import bisect
+import gzip
+import struct
+
+from VariationUtil.Util.BGZFWriter import BGZFWriter
+
+TBI_MAGIC = b"TBI\x01"
+CSI_MAGIC = b"CSI\x01"
+# Binning scheme of .tbi files: 16 kb smallest bins, 5 levels above them
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+# Each entry of the linear index covers 2^14 = 16 kb
+LINEAR_SHIFT = 14
+# Tabix header values for vcf (format, col_seq, col_beg, col_end, meta, skip)
+VCF_PRESET = (2, 1, 2, 0, ord("#"), 0)
+# Tabix header values for gff (generic format, 1-based begin and end columns)
+GFF_PRESET = (0, 1, 4, 5, ord("#"), 0)
+
+
+def pseudo_bin(depth):
+    """
+    Bin written by htslib after the real bins, holds the virtual offset
+    range of the contig and the number of mapped / unmapped records
+    (37450 for .tbi files)
+    """
+    return ((1 << (3 * depth + 3)) - 1) // 7 + 1
+
+
+class TabixIndex:
+    """
+    Reader for tabix (.tbi) and coordinate sorted (.csi) index files
+
+    Gives random access by contig to a bgzipped and tabix indexed file:
+        names - contig names in the order they appear in the file
+        refs - per contig dict with
+            bins: {bin: [(chunk_begin, chunk_end), ...]}
+            linear: list of virtual offsets for each 16 kb window (.tbi only)
+            loffsets: {bin: virtual offset of the first record overlapping
+                      the start of the bin} (.csi only)
+    Virtual offsets are (compressed block offset << 16 | offset in block)
+    """
+
+    def __init__(self, names, refs, fmt=None, n_no_coor=None,
+                 min_shift=TBI_MIN_SHIFT, depth=TBI_DEPTH):
+        self.names = names
+        self.refs = refs
+        self.format = fmt or {}
+        self.n_no_coor = n_no_coor
+        self.min_shift = min_shift
+        self.depth = depth
+        self.pseudo_bin = pseudo_bin(depth)
+        self.ref_ids = {name: i for i, name in enumerate(names)}
+
+    @staticmethod
+    def _read_tabix_header(data, pos):
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+            struct.unpack_from("<8i", data, pos)
+        pos += 32
+        names = [n.decode() for n in data[pos:pos + l_nm].split(b"\0")[:n_ref]]
+        fmt = {"format": fmt, "col_seq": col_seq, "col_beg": col_beg,
+               "col_end": col_end, "meta": chr(meta), "skip": skip}
+        return n_ref, names, fmt, pos + l_nm
+
+    @classmethod
+    def read(cls, index_filepath):
+        """
+        :param index_filepath: path of the .tbi or .csi file
+        :return: TabixIndex
+        """
+        with gzip.open(index_filepath, "rb") as f:
+            data = f.read()
+        is_csi = data[:4] == CSI_MAGIC
+        if data[:4] != TBI_MAGIC and not is_csi:
+            raise ValueError("Not a tabix index file " + index_filepath)
+
+        min_shift, depth = TBI_MIN_SHIFT, TBI_DEPTH
+        if is_csi:
+            min_shift, depth, l_aux = struct.unpack_from("<3i", data, 4)
+            aux = data[16:16 + l_aux]
+            pos = 16 + l_aux
+            n_ref, = struct.unpack_from("<i", data, pos)
+            pos += 4
+            if l_aux >= 28:
+                _, names, fmt, _ = cls._read_tabix_header(struct.pack("<i", n_ref) + aux, 0)
+            else:
+                names, fmt = [str(i) for i in range(n_ref)], None
+        else:
+            n_ref, names, fmt, pos = cls._read_tabix_header(data, 4)
+
+        refs = list()
+        for _ in range(n_ref):
+            n_bin, = struct.unpack_from("<i", data, pos)
+            pos += 4
+            bins = dict()
+            loffsets = dict()
+            for _ in range(n_bin):
+                if is_csi:
+                    bin_id, loffsets[bin_id], n_chunk = struct.unpack_from("<IQi", data, pos)
+                    pos += 16
+                else:
+                    bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+                    pos += 8
+                chunks = struct.unpack_from("<" + str(2 * n_chunk) + "Q", data, pos)
+                pos += 16 * n_chunk
+                bins[bin_id] = list(zip(chunks[::2], chunks[1::2]))
+            linear = list()
+            if not is_csi:
+                n_intv, = struct.unpack_from("<i", data, pos)
+                pos += 4
+                linear = list(struct.unpack_from("<" + str(n_intv) + "Q", data, pos))
+                pos += 8 * n_intv
+            refs.append({"bins": bins, "linear": linear, "loffsets": loffsets})
+
+        n_no_coor = None
+        if pos + 8 <= len(data):
+            n_no_coor, = struct.unpack_from("<Q", data, pos)
+
+        return cls(names, refs, fmt, n_no_coor, min_shift, depth)
+
+    def contig_offset(self, name):
+        """
+        :return: virtual offset of the first record of the contig
+        """
+        bins = self.refs[self.ref_ids[name]]["bins"]
+        return min(beg for bin_id, chunks in bins.items()
+                   if bin_id != self.pseudo_bin for beg, _ in chunks)
+
+    def region_offset(self, name, start):
+        """
+        Virtual offset from which all records of contig name at or
+        after 0-based position start can be found
+        """
+        ref = self.refs[self.ref_ids[name]]
+        linear = ref["linear"]
+        window = start >> LINEAR_SHIFT
+        if 0 < window < len(linear) and linear[window]:
+            return linear[window]
+        if start <= 0 or not ref["loffsets"]:
+            return self.contig_offset(name)
+        # .csi: loffset of the smallest bin holding start that is in the
+        # index (as htslib does), and the first chunk of the bins ending
+        # after start; small bins of sparse contigs are often missing
+        offset = 0
+        for level in range(self.depth, -1, -1):
+            first = ((1 << (3 * level)) - 1) // 7
+            bin_id = first + (start >> (self.min_shift + 3 * (self.depth - level)))
+            if bin_id in ref["loffsets"]:
+                offset = ref["loffsets"][bin_id]
+                break
+        if "bin_ends" not in ref:
+            self._index_bin_ends(ref)
+        i = bisect.bisect_right(ref["bin_ends"], start)
+        if i < len(ref["bin_ends"]):
+            offset = max(offset, ref["first_chunks"][i])
+        return offset or self.contig_offset(name)
+
+    def _bin_range(self, bin_id):
+        """
+        :return: (begin, end) positions covered by the bin
+        """
+        # find the level of the bin, level 0 is the single root bin
+        level, first = 0, 0
+        while bin_id >= first + (1 << (3 * level)):
+            first += 1 << (3 * level)
+            level += 1
+        shift = self.min_shift + 3 * (self.depth - level)
+        return (bin_id - first) << shift, (bin_id - first + 1) << shift
+
+    def _index_bin_ends(self, ref):
+        """
+        Sorts the bins of ref by end position, first_chunks[i] is the
+        smallest chunk offset of the bins from bin_ends[i] on
+        """
+        ends = sorted((self._bin_range(bin_id)[1], min(beg for beg, _ in chunks))
+                      for bin_id, chunks in ref["bins"].items() if bin_id != self.pseudo_bin)
+        first_chunks = [offset for _, offset in ends]
+        for i in range(len(first_chunks) - 2, -1, -1):
+            first_chunks[i] = min(first_chunks[i], first_chunks[i + 1])
+        ref["bin_ends"] = [end for end, _ in ends]
+        ref["first_chunks"] = first_chunks
+
+    def contig_span(self, name):
+        """
+        :return: upper bound of the positions covered by the index
+        """
+        ref = self.refs[self.ref_ids[name]]
+        if ref["linear"]:
+            return len(ref["linear"]) << LINEAR_SHIFT
+        return max((self._bin_range(bin_id)[1] for bin_id in ref["bins"]
+                    if bin_id != self.pseudo_bin), default=0)
+
+    def record_count(self, name):
+        """
+        :return: number of records of the contig, None if the index
+                 has no pseudo bin with counts
+        """
+        chunks = self.refs[self.ref_ids[name]]["bins"].get(self.pseudo_bin)
+        if not chunks or len(chunks) < 2:
+            return None
+        return chunks[1][0]
+
+
+class TabixIndexBuilder:
+    """
+    Builds a tabix index from records pushed in file order while the
+    file is being written, so the data does not have to be read again
+
+        builder.push(contig, beg, end, record_start, record_end)
+
+    Record offsets are positions in the uncompressed data; they are
+    translated to virtual offsets when the index is written (see
+    BGZFWriter.virtual_offset). Positions are 0-based, end exclusive.
+    A .csi index is written instead of .tbi when a record ends beyond
+    2^29, the limit of the .tbi binning scheme.
+    """
+
+    def __init__(self, preset=VCF_PRESET):
+        self.preset = preset
+        self.names = list()
+        self.refs = list()
+        self.max_end = 0
+        self._seen = set()
+        self._ref = None
+        self._last = None
+
+    def _new_ref(self, contig):
+        if contig in self._seen:
+            raise ValueError("File is not sorted, contig " + contig
+                             + " appears in more than one block")
+        self._seen.add(contig)
+        self.names.append(contig)
+        # bins are keyed by (level counted from the 16 kb level, index in level)
+        # until the depth of the index is known, chunks are (start, end)
+        # uncompressed offsets of consecutive records in the same bin
+        self._ref = {"bins": dict(), "linear": list(),
+                     "off_beg": None, "off_end": None, "n_mapped": 0}
+        self.refs.append(self._ref)
+        self._last = None
+
+    def push(self, contig, beg, end, record_start, record_end):
+        if not self.names or self.names[-1] != contig:
+            self._new_ref(contig)
+        elif beg < self._last:
+            raise ValueError("File is not sorted at " + contig + ":" + str(beg + 1))
+        self._last = beg
+        end = max(end, beg + 1)
+        self.max_end = max(self.max_end, end)
+        ref = self._ref
+        if ref["off_beg"] is None:
+            ref["off_beg"] = record_start
+        ref["off_end"] = record_end
+        ref["n_mapped"] += 1
+
+        shift, level = TBI_MIN_SHIFT, 0
+        while beg >> shift != (end - 1) >> shift:
+            shift += 3
+            level += 1
+        chunks = ref["bins"].setdefault((level, beg >> shift), list())
+        if chunks and chunks[-1][1] == record_start:
+            chunks[-1] = (chunks[-1][0], record_end)
+        else:
+            chunks.append((record_start, record_end))
+
+        linear = ref["linear"]
+        last_window = (end - 1) >> LINEAR_SHIFT
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> LINEAR_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = record_start
+
+    @staticmethod
+    def _linear(ref, to_virtual):
+        """
+        Linear index in virtual offsets, empty windows take the
+        offset of the window before them
+        """
+        linear = list()
+        previous = 0
+        for offset in ref["linear"]:
+            if offset is not None:
+                previous = to_virtual(offset)
+            linear.append(previous)
+        return linear
+
+    @staticmethod
+    def _bins(ref, depth, to_virtual, linear):
+        """
+        Bin ids for an index of the given depth, chunks translated to
+        virtual offsets. Chunks that touch the same BGZF block are merged
+        :return: {bin: (loffset, chunks)}, loffset is the smallest offset of
+                 records overlapping the first 16 kb of the bin (.csi only)
+        """
+        bins = dict()
+        for (level, index), chunks in ref["bins"].items():
+            bin_id = ((1 << (3 * (depth - level))) - 1) // 7 + index
+            window = (index << (TBI_MIN_SHIFT + 3 * level)) >> LINEAR_SHIFT
+            loffset = linear[window] if window < len(linear) else 0
+            merged = list()
+            for beg, end in ((to_virtual(b), to_virtual(e)) for b, e in chunks):
+                if merged and merged[-1][1] >> 16 == beg >> 16:
+                    merged[-1] = (merged[-1][0], end)
+                else:
+                    merged.append((beg, end))
+            bins[bin_id] = (loffset, merged)
+        bins[pseudo_bin(depth)] = (0, [(to_virtual(ref["off_beg"]), to_virtual(ref["off_end"])),
+                                       (ref["n_mapped"], 0)])
+        return bins
+
+    def _tabix_header(self):
+        names = b"".join(name.encode() + b"\0" for name in self.names)
+        return struct.pack("<6i", *self.preset) + struct.pack("<i", len(names)) + names
+
+    def write(self, index_filepath, to_virtual):
+        """
+        Writes the index, BGZF compressed
+        :param index_filepath: path without the .tbi / .csi suffix
+        :param to_virtual: function mapping an uncompressed offset to a virtual offset
+        :return: path of the index file
+        """
+        depth = TBI_DEPTH
+        while self.max_end > 1 << (TBI_MIN_SHIFT + 3 * depth):
+            depth += 1
+        use_csi = depth != TBI_DEPTH
+
+        out = list()
+        if use_csi:
+            index_filepath += ".csi"
+            aux = self._tabix_header()
+            out.append(CSI_MAGIC + struct.pack("<3i", TBI_MIN_SHIFT, depth, len(aux)) + aux)
+            out.append(struct.pack("<i", len(self.names)))
+        else:
+            index_filepath += ".tbi"
+            out.append(TBI_MAGIC + struct.pack("<i", len(self.names)) + self._tabix_header())
+
+        for ref in self.refs:
+            linear = self._linear(ref, to_virtual)
+            bins = self._bins(ref, depth, to_virtual, linear)
+            out.append(struct.pack("<i", len(bins)))
+            for bin_id, (loffset, chunks) in bins.items():
+                if use_csi:
+                    out.append(struct.pack("<IQi", bin_id, loffset, len(chunks)))
+                else:
+                    out.append(struct.pack("<Ii", bin_id, len(chunks)))
+                for chunk in chunks:
+                    out.append(struct.pack("<2Q", *chunk))
+            if not use_csi:
+                out.append(struct.pack("<i", len(linear)))
+                out.append(struct.pack("<" + str(len(linear)) + "Q", *linear))
+        out.append(struct.pack("<Q", 0))
+
+        with BGZFWriter(index_filepath, threads=1) as writer:
+            writer.write(b"".join(out))
+        return index_filepath
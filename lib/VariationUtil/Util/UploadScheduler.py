@@ -0,0 +1,54 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of file_to_shock calls running at the same time
+DEFAULT_UPLOADS = 4
+
+
+class UploadScheduler:
+    """
+    Runs DataFileUtil.file_to_shock uploads on a thread pool so that files
+    are uploaded while the import goes on; each upload is started as soon
+    as its file has been written:
+
+        uploads = UploadScheduler(dfu)
+        vcf_upload = uploads.upload({'file_path': vcf_path, 'make_handle': 1})
+        ...
+        handle = vcf_upload.result()['handle']
+
+    One scheduler is shared by all steps of an import (see the uploads
+    entry of the VCFToVariation / JbrowseUtil configs), which keeps the
+    number of uploads running at the same time bounded.
+    """
+
+    def __init__(self, dfu, max_uploads=DEFAULT_UPLOADS):
+        self.dfu = dfu
+        self._executor = ThreadPoolExecutor(max_workers=max_uploads)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.shutdown(wait=exc_type is None)
+
+    def _upload(self, params):
+        file_path = params['file_path']
+        if not os.path.exists(file_path):
+            raise ValueError("Can not upload " + file_path + ", file does not exist")
+        start = time.time()
+        result = self.dfu.file_to_shock(params)
+        logging.info("Uploaded " + file_path + " in "
+                     + str(round(time.time() - start, 2)) + " seconds")
+        return result
+
+    def upload(self, params):
+        """
+        :param params: DataFileUtil.file_to_shock parameters
+        :return: Future of the file_to_shock output
+        """
+        return self._executor.submit(self._upload, params)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,233 @@
+import logging
+import re
+from VariationUtil.Util.BGZFReader import BGZFReader
+from VariationUtil.Util.SNPDensity import SNPDensity, DENSITY_BINSIZES
+from VariationUtil.Util.StageScheduler import check_cancelled
+from VariationUtil.Util.StreamingJSON import WORKSPACE_OBJECT_LIMIT
+
+# Data lines fed between two checks of the cancelled event
+CANCEL_CHECK_INTERVAL = 1 << 14
+
+
+class VCFIngest:
+    """
+    Single streaming pass over a VCF file that collects everything the
+    import needs from the file contents:
+        version, header records, strain ids (#CHROM sample columns),
+        per-contig variant counts, SNP density bins, annotated variant
+        counts and the decision whether genotypes can be stored in the
+        Variations object.
+
+    Lines can be pushed one at a time with feed() (so that other streaming
+    stages, e.g. compression, can share the same pass) or a whole file can
+    be read with scan().
+    """
+
+    ANNOT = {
+        "synonymous_variant": 1,
+        "missense_variant": 1,
+        "frameshift_variant": 1,
+        "stop_gained": 1,
+        "stop_lost": 1
+    }
+
+    def __init__(self, binsizes=DENSITY_BINSIZES, size_limit=WORKSPACE_OBJECT_LIMIT, threads=None,
+                 genotypes=None, cancelled=None):
+        # Optional GenotypeMatrixWriter that gets every data line
+        self.genotypes = genotypes
+        # Optional StageScheduler.cancelled event of the import
+        self.cancelled = cancelled
+        # Number of threads used to decompress the vcf in scan()
+        self.threads = threads
+        # Workspace object size limit in bytes
+        self.size_limit = size_limit
+        self.version = ""
+        self.header = list()
+        self.genotype_ids = list()
+        self.chromosome_ids = list()
+        self.contigs = dict()
+        # variants per bin at each of the binsizes
+        self.density = SNPDensity(binsizes)
+        self.total_variants = 0
+        self.annotated_variants = 0
+
+    @staticmethod
+    def parse_header(record, category):
+        """
+        parses vcf header which looks like the following
+        and get details for the IDs like DP, q10
+        This information is useful in filtering
+        ##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">
+        ##FILTER=<ID=q10,Description="Quality below 10">
+        ##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
+        """
+        returninfo = {"Category": category}
+
+        # remove all comma within quotes
+        record = re.sub(r'(?!(([^"]*"){2})*[^"]*$),', '', record)
+        record = record.rstrip()
+        # Remove last > character
+        record = record[:-1]
+        info = re.sub(".*=<", "", record)
+        infolist = info.replace('"', '').rstrip().split(",")
+        for fields in infolist:
+            data = fields.split("=")
+            key = data.pop(0)
+            val = "=".join(data)
+            val = val.replace("\"", "")
+            returninfo[key] = val
+        return returninfo
+
+    @classmethod
+    def parse_annotation(cls, info_string):
+        """
+        parses annotation string into a structure
+        [allele, annotation, gene_id, transcript_id, base, prot]
+        Fields are delimited by ; annotation field starts with ANN=
+        Each allele-effect in annotation field is separated by ,
+        :param info_string: INFO column of a VCF record
+        :return: list of annotations or None
+        """
+        annotation_info = list()
+
+        ann_string = None
+        for j in info_string.split(";"):
+            if j.startswith("ANN="):
+                ann_string = j
+
+        if ann_string is None:
+            return None
+        # TODO: Add more variant effects that
+        # TODO: may not be affecting the protein coding region
+
+        for a in ann_string.split(","):
+            eff = a.split("|")
+            allele = eff[0].replace("ANN=", "")
+            annot = eff[1]
+            if annot not in cls.ANNOT:
+                continue
+            gene_id = eff[3]
+            transcript_id = eff[6]
+            base = eff[9]
+            prot = eff[10]
+            annotation_info.append([allele, annot, gene_id, transcript_id, base, prot])
+
+        if annotation_info:
+            return annotation_info
+        else:
+            return None
+
+    def _feed_meta(self, record):
+        if record.startswith("##fileformat"):
+            self.version = record.replace("##fileformat=", "").rstrip()
+        elif record.startswith("##INFO=<"):
+            self.header.append(self.parse_header(record, "INFO"))
+        elif record.startswith("##FORMAT=<"):
+            self.header.append(self.parse_header(record, "FORMAT"))
+        elif record.startswith("##FILTER=<"):
+            self.header.append(self.parse_header(record, "FILTER"))
+        elif record.startswith("#CHROM"):
+            # This is the chrome line
+            self.genotype_ids = record.rstrip().split("\t")[9:]
+            if self.genotypes is not None:
+                self.genotypes.set_samples(self.genotype_ids)
+
+    def feed(self, record):
+        """
+        Process one line of the VCF file
+        :param record: VCF line (header or data)
+        """
+        if record[0] == "#":
+            self._feed_meta(record)
+            return
+
+        CHROM, POS, _, _, _, _, _, INFO, *_ = record.split("\t", 8)
+
+        self.total_variants += 1
+        if self.total_variants % CANCEL_CHECK_INTERVAL == 0:
+            check_cancelled(self.cancelled)
+        contig = self.contigs.get(CHROM)
+        if contig is None:
+            self.chromosome_ids.append(CHROM)
+            self.contigs[CHROM] = {
+                'contig_id': CHROM,
+                'totalvariants': 1
+            }
+        else:
+            contig['totalvariants'] += 1
+        self.density.add(CHROM, int(POS) - 1)
+
+        if "ANN=" in INFO and self.parse_annotation(INFO) is not None:
+            self.annotated_variants += 1
+
+        if self.genotypes is not None:
+            self.genotypes.add(record)
+
+    def merge_region(self, contig, total_variants, annotated_variants, density_counts):
+        """
+        Adds the counts of a region processed separately (see VCFRegions)
+        Regions have to be merged in file order
+        """
+        check_cancelled(self.cancelled)
+        if contig not in self.contigs:
+            self.chromosome_ids.append(contig)
+            self.contigs[contig] = {
+                'contig_id': contig,
+                'totalvariants': 0
+            }
+        self.contigs[contig]['totalvariants'] += total_variants
+        if density_counts is not None:
+            self.density.merge(contig, density_counts)
+        self.total_variants += total_variants
+        self.annotated_variants += annotated_variants
+
+    def populate_genos(self, vcf_filepath):
+        '''
+        The workspace object size limit creates a problem for large vcf
+        with too many samples. Single sample vcf may be ok. So that is
+        always true, otherwise the size of the variation details is
+        projected from a sample of the file (see VariationSizeEstimator).
+        :param vcf_filepath: path of the bgzipped vcf file
+        '''
+        if len(self.genotype_ids) == 1:
+            return True
+        # imported here, VariationSizeEstimator parses records with
+        # VCFReaderStream which depends on this module
+        from VariationUtil.Util.VariationSizeEstimator import VariationSizeEstimator
+        estimator = VariationSizeEstimator(vcf_filepath, size_limit=self.size_limit)
+        return estimator.populate_genos(self.total_variants)
+
+    def result(self, vcf_filepath):
+        """
+        :param vcf_filepath: path of the bgzipped vcf file the lines came from
+        :return: vcf_info dictionary
+        """
+        genotype_matrix = None
+        if self.genotypes is not None and self.genotype_ids:
+            genotype_matrix = self.genotypes.close(self.genotype_ids)
+        return {
+            'version': self.version,
+            'contigs': self.contigs,
+            'total_variants': self.total_variants,
+            'genotype_ids': self.genotype_ids,
+            'chromosome_ids': self.chromosome_ids,
+            'header': self.header,
+            'density': self.density,
+            'annotated_variants': self.annotated_variants,
+            'populate_genos': self.populate_genos(vcf_filepath),
+            'genotype_matrix': genotype_matrix,
+            'genotype_density': self.genotypes.density if self.genotypes is not None else None,
+            'file_ref': vcf_filepath
+        }
+
+    def scan(self, vcf_filepath):
+        """
+        Read the bgzipped vcf file once and return vcf_info
+        :param vcf_filepath: path of the bgzipped vcf file
+        :return: vcf_info dictionary
+        """
+        logging.info("Scanning vcf file " + vcf_filepath)
+        with BGZFReader(vcf_filepath, self.threads) as reader:
+            for record in reader:
+                self.feed(record)
+        return self.result(vcf_filepath)
@@ -0,0 +1,140 @@
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from VariationUtil.Util.BGZFReader import BGZFReader
+from VariationUtil.Util.SNPDensity import DENSITY_BINSIZES
+from VariationUtil.Util.StageScheduler import check_cancelled
+from VariationUtil.Util.TabixIndex import TabixIndex
+from VariationUtil.Util.VCFIngest import VCFIngest
+from VariationUtil.Util.VCFReaderStream import VCFReaderStream
+
+# Length (bp) of the regions a contig is split into, bounds the variants
+# a worker returns in one result
+REGION_SIZE = 1000000
+
+
+def region_records(vcf_filepath, region):
+    """
+    Data lines of a bgzipped, tabix indexed vcf that belong to region
+    :param region: (contig, start, end, virtual offset), start/end are 0-based
+    """
+    contig, start, end, offset = region
+    with BGZFReader(vcf_filepath, 1, offset) as reader:
+        for record in reader:
+            if record[0] == "#":
+                continue
+            CHROM, POS, _ = record.split("\t", 2)
+            if CHROM != contig:
+                break
+            pos = int(POS) - 1
+            if pos < start:
+                continue
+            if pos >= end:
+                break
+            yield record
+
+
+def _ingest_region(args):
+    vcf_filepath, region, binsizes = args
+    ingest = VCFIngest(binsizes=binsizes)
+    for record in region_records(vcf_filepath, region):
+        ingest.feed(record)
+    return (ingest.total_variants, ingest.annotated_variants,
+            ingest.density.contig_counts(region[0]) if region[0] in ingest.density else None)
+
+
+def _parse_region(args):
+    vcf_filepath, region, populate_genos = args
+    return [VCFReaderStream.parse_record(record, populate_genos)
+            for record in region_records(vcf_filepath, region)]
+
+
+class VCFRegionProcessor:
+    """
+    Splits a bgzipped, tabix indexed vcf file into regions of at most
+    region_size bp of one contig, processes the regions
+    on a process pool and merges the results back in contig order
+    """
+
+    def __init__(self, vcf_filepath, index_filepath, processes=None, region_size=REGION_SIZE,
+                 cancelled=None):
+        self.vcf_filepath = vcf_filepath
+        self.index = TabixIndex.read(index_filepath)
+        self.processes = processes or os.cpu_count() or 1
+        self.region_size = region_size or REGION_SIZE
+        # Optional StageScheduler.cancelled event of the import
+        self.cancelled = cancelled
+
+    def regions(self):
+        """
+        :return: list of (contig, start, end, virtual offset) in file order
+        """
+        regions = list()
+        for contig in self.index.names:
+            span = self.index.contig_span(contig)
+            if span <= self.region_size:
+                regions.append((contig, 0, span, self.index.contig_offset(contig)))
+                continue
+            for start in range(0, span, self.region_size):
+                end = min(start + self.region_size, span)
+                regions.append((contig, start, end,
+                                self.index.region_offset(contig, start)))
+        return regions
+
+    def _map(self, fn, args):
+        """
+        Ordered map over the process pool that keeps at most
+        2 * processes results waiting for the consumer, regions not
+        started yet are dropped when the map is left early.
+        Workers are started from a forkserver, the import has threads
+        running (uploads, other stages) that a fork would copy in the
+        middle of whatever they hold
+        """
+        window = 2 * self.processes
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=multiprocessing.get_context("forkserver")) as executor:
+            try:
+                for arg in args:
+                    check_cancelled(self.cancelled)
+                    pending.append(executor.submit(fn, arg))
+                    if len(pending) >= window:
+                        yield pending.popleft().result()
+                while pending:
+                    check_cancelled(self.cancelled)
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def ingest(self, binsizes=DENSITY_BINSIZES):
+        """
+        Parallel equivalent of VCFIngest(binsizes).scan(vcf_filepath)
+        :return: vcf_info dictionary
+        """
+        ingest = VCFIngest(binsizes=binsizes, cancelled=self.cancelled)
+        with BGZFReader(self.vcf_filepath, 1) as reader:
+            for record in reader:
+                if record[0] != "#":
+                    break
+                ingest.feed(record)
+
+        regions = self.regions()
+        logging.info("Scanning " + str(len(regions)) + " regions on "
+                     + str(self.processes) + " processes")
+        args = ((self.vcf_filepath, region, binsizes) for region in regions)
+        for region, result in zip(regions, self._map(_ingest_region, args)):
+            ingest.merge_region(region[0], *result)
+        return ingest.result(self.vcf_filepath)
+
+    def variation_details(self, populate_genos):
+        """
+        Generator of variation details, same output as VCFReaderStream
+        """
+        args = ((self.vcf_filepath, region, populate_genos)
+                for region in self.regions())
+        for variants in self._map(_parse_region, args):
+            yield from variants
@@ -1,14 +1,19 @@
 import hashlib
 import logging
 import os
-import gzip
-import re
 import time
 
 from installed_clients.AssemblyUtilClient import AssemblyUtil
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.WorkspaceClient import Workspace
+from VariationUtil.Util.AssemblyMetadata import AssemblyMetadata
+from VariationUtil.Util.StrainReconciler import normalise_name
+from VariationUtil.Util.UploadScheduler import UploadScheduler
+from VariationUtil.Util.VCFIngest import VCFIngest
 from VariationUtil.Util.VCFReaderStream import VCFReaderStream
+from VariationUtil.Util.VCFRegions import VCFRegionProcessor
+from VariationUtil.Util.VariationShards import VariationShardWriter, SHARD_BYTES
+from VariationUtil.Util.VariationSizeEstimator import VariationSizeEstimator
 
 
 def log(message, prefix_newline=False):
@@ -18,122 +23,56 @@ def log(message, prefix_newline=False):
 class VCFToVariation:
     def __init__(self, Config):
         self.scratch = Config['scratch']
+        self.threads = Config.get('threads')
+        self.processes = Config.get('processes')
+        self.region_size = Config.get('region_size')
+        # Optional StageScheduler.cancelled event of the import
+        self.cancelled = Config.get('cancelled')
         ws_url = Config['ws_url']
-        callback_url = os.environ['SDK_CALLBACK_URL']
-        self.dfu = DataFileUtil(callback_url)
+        self.callback_url = os.environ['SDK_CALLBACK_URL']
+        self.dfu = DataFileUtil(self.callback_url)
         self.wsc = Workspace(ws_url)
-        self.au = AssemblyUtil(callback_url)
+        self.au = AssemblyUtil(self.callback_url)
+        # contig ids and lengths shared with the other steps of the import
+        self.assembly_metadata = Config.get('assembly_metadata') or AssemblyMetadata(self.wsc)
+        # file_to_shock calls run on this scheduler while the vcf is parsed
+        self.uploads = Config.get('uploads') or UploadScheduler(self.dfu)
         self.vcf_info = dict()
 
-    def _parse_header(self, record, category):
-        """
-        parses vcf header which looks like the following
-        and get details for the IDs like DP, q10
-        This information is useful in filtering
-        ##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">
-        ##FILTER=<ID=q10,Description="Quality below 10">
-        ##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">
-        [
-            {
-            },
-            {
-            },
-            {
-            }
-        ]
-        """
-        returninfo = {"Category": category}
-
-        # remove all comma within quotes
-        record = re.sub(r'(?!(([^"]*"){2})*[^"]*$),', '', record)
-        record = record.rstrip()
-        # Remove last > character
-        record = record[:-1]
-        info = re.sub(".*=<", "", record)
-        infolist = info.replace('"', '').rstrip().split(",")
-        for fields in infolist:
-            data = fields.split("=")
-            key = data.pop(0)
-            val = "=".join(data)
-            val = val.replace("\"", "")
-            returninfo[key] = val
-        return returninfo
-
-
-    def parse_vcf_data(self, vcf_filepath):
+    def parse_vcf_data(self, vcf_filepath, vcf_info=None, vcf_index=None):
         """
         parses vcf file including headers and prepares
         information that will be uploaded to KBase workspace
         :param vcf_filepath:
+        :param vcf_info: result of an earlier VCFIngest pass over the same file,
+                         the file is only scanned when this is not given
+        :param vcf_index: tabix index of the file, used to parse contigs
+                          in parallel when more than one process is configured
         :return:
         """
-        reader = gzip.open(vcf_filepath, "rt")
-        version = ""
-        genotypes = ""
-        counter = 0
-        chromosomes = list()
-        contigs = {}
-        header = list()
-        totalvars = 0
-
-        for record in reader:
-
-            # Handle header lines and parse information
-            if record[0] == "#":
-                if record.startswith("##fileformat"):
-                    version = record.replace("##fileformat=", "").rstrip()
-                if record.startswith("##INFO=<"):
-                    info = self._parse_header(record, "INFO")
-                    header.append(info)
-                if record.startswith("##FORMAT=<"):
-                    info = self._parse_header(record, "FORMAT")
-                    header.append(info)
-                if record.startswith("##FILTER=<"):
-                    info = self._parse_header(record, "FILTER")
-                    header.append(info)
-                if (record.startswith("#CHROM")):
-                    # This is the chrome line
-                    record = record.rstrip()
-                    values = record.split("\t")
-                    genotypes = values[9:]
-                continue
-
-            # Handle the actual VCF content and parse information
-            counter = counter + 1
-
-            CHROM, *_ = record.split("\t")
-
-            totalvars += 1
-            if CHROM not in chromosomes:
-                chromosomes.append(CHROM)
-                contigs[CHROM] = {
-                    'contig_id': CHROM,
-                    'totalvariants': 1
-                }
+        regions = None
+        if vcf_index and self.processes and self.processes > 1:
+            regions = VCFRegionProcessor(vcf_filepath, vcf_index,
+                                         self.processes, self.region_size,
+                                         self.cancelled)
+
+        if vcf_info is None:
+            if regions is not None:
+                vcf_info = regions.ingest()
             else:
-                contigs[CHROM]['totalvariants'] += 1
-
-        variation_details = VCFReaderStream(vcf_filepath)
-        vcf_info = {
-            'version': version,
-            'contigs': contigs,
-            'total_variants': totalvars,
-            'genotype_ids': genotypes,
-            'chromosome_ids': chromosomes,
-            'variation_details': variation_details,
-            'file_ref': vcf_filepath,
-            'header': header
-        }
+                vcf_info = VCFIngest(threads=self.threads,
+                                     cancelled=self.cancelled).scan(vcf_filepath)
+
+        vcf_info['variation_details'] = VCFReaderStream(vcf_filepath,
+                                                        vcf_info['populate_genos'],
+                                                        self.threads,
+                                                        regions)
         return vcf_info
 
     def _validate_vcf_to_sample(self, vcf_genotypes, sample_ids):
-        genos_not_found = []
-        vgenotypes = [x.upper().strip() for x in vcf_genotypes]
-        sids = [x.upper().strip() for x in sample_ids]
-
-        for geno in vgenotypes:
-            if geno not in sids:
-                genos_not_found.append(geno)
+        sids = {normalise_name(x) for x in sample_ids}
+        genos_not_found = [geno for geno in map(normalise_name, vcf_genotypes)
+                           if geno not in sids]
 
         if not genos_not_found:
             return True
@@ -159,18 +98,14 @@ class VCFToVariation:
         else:
             return chromos_not_in_assembly
 
-    def _validate_assembly_ids(self, vcf_info):
+    def validate_assembly_ids(self, vcf_info):
         """
         All chromosome ids from the vcf should be in assembly
         but not all assembly chromosome ids need to be in vcf
-        :param params:
+        :param vcf_info: dict with assembly_ref and chromosome_ids
         :return: list of all assembly chromosome ids
         """
-        assembly_chromosome_ids_call = self.wsc.get_object_subset([{
-            'included': ['/contigs'],
-            'ref': vcf_info['assembly_ref']
-        }])
-        assembly_chromosomes = assembly_chromosome_ids_call[0]['data']['contigs'].keys()
+        assembly_chromosomes = self.assembly_metadata.contigs(vcf_info['assembly_ref'])
         vcf_chromosomes = vcf_info['chromosome_ids']
         chk_assembly_ids = self._chk_if_vcf_ids_in_assembly(vcf_chromosomes, assembly_chromosomes)
 
@@ -197,22 +132,41 @@ class VCFToVariation:
              } contig_info;
 
         """
-        assembly_chromosome_dict = self.wsc.get_object_subset([{
-            'included': ['/contigs'],
-            'ref': vcf_info['assembly_ref']
-        }])[0]['data']['contigs']
+        assembly_contigs = self.assembly_metadata.contigs(vcf_info['assembly_ref'])
 
         contigs = []
 
         contig_infos = vcf_info['contigs']
 
         for contig_id in contig_infos:
-            length_contig = assembly_chromosome_dict[contig_id].get("length")
+            length_contig = assembly_contigs.length(contig_id)
             contig_infos[contig_id]["length"] = length_contig
             contigs.append(contig_infos[contig_id])
 
         return contigs
 
+    def _start_uploads(self, vcf_info):
+        """
+        Starts the uploads of the vcf, its index and the genotype matrix that
+        were not started by the caller (see the uploads param)
+        :return: dict of file_to_shock futures
+        """
+        uploads = dict(vcf_info.get('uploads') or {})
+        files = {
+            'vcf': vcf_info['vcf_compressed'],
+            'vcf_index': vcf_info['vcf_index']
+        }
+        if vcf_info.get('genotype_matrix') and os.path.exists(vcf_info['genotype_matrix']):
+            files['genotype_matrix'] = vcf_info['genotype_matrix']
+        for name, file_path in files.items():
+            if uploads.get(name) is None:
+                logging.info("Uploading " + file_path + " to shock")
+                uploads[name] = self.uploads.upload({
+                    'file_path': file_path,
+                    'make_handle': 1
+                })
+        return uploads
+
     def _construct_variation_object_json(self, vcf_info):
 
         """
@@ -226,8 +180,11 @@ class VCFToVariation:
                  genome_ref - KBase reference to genome workspace object
                  assembly_ref - KBase reference to assemebly workspace object
                  vcf_handle_ref - VCF handle reference to VCF file
+                 genotype_matrix_handle - packed genotypes of all samples, see GenotypeMatrix
+                 variation_shards - directory of VariationShard objects holding the
+                                    variation details of large vcf files
 
-                 @optional genome_ref
+                 @optional genome_ref genotype_matrix_handle variation_shards
              */
              typedef structure {
                int numgenotypes;
@@ -242,23 +199,14 @@ class VCFToVariation:
             :param params: KBase ui input parameters
             :return: constructed variation object (dictionary)
         """
-        logging.info("Uploading VCF file to shock")
-        vcf_shock_file_ref = None
-        vcf_index_shock_file_ref = None
-        if os.path.exists(vcf_info['vcf_compressed']):
-            vcf_shock_file_ref = self.dfu.file_to_shock({
-                'file_path': vcf_info['vcf_compressed'],
-                'make_handle': 1
-            })
+        uploads = self._start_uploads(vcf_info)
+        vcf_shock_file_ref = uploads['vcf'].result()
         # compare_md5_local_with_shock(bgzip_file_path, vcf_shock_file_ref)
-
-        logging.info("Uploading VCF index file to shock")
-        if os.path.exists(vcf_info['vcf_index']):
-            vcf_index_shock_file_ref = self.dfu.file_to_shock({
-                'file_path': vcf_info['vcf_index'],
-                'make_handle': 1
-            })
+        vcf_index_shock_file_ref = uploads['vcf_index'].result()
         # compare_md5_local_with_shock(index_file_path, vcf_index_shock_file_ref)
+        genotype_matrix_shock_file_ref = None
+        if uploads.get('genotype_matrix') is not None:
+            genotype_matrix_shock_file_ref = uploads['genotype_matrix'].result()
 
         # TODO: remove any reference to samples in this file
         variation_obj_data = {
@@ -266,7 +214,6 @@ class VCFToVariation:
             'numvariants': int(vcf_info['total_variants']),
             'contigs': vcf_info['contigs_info'],
             "header": vcf_info['header'],
-            "variation_details": vcf_info['variation_details'],
             'assembly_ref': vcf_info['assembly_ref'],
             'vcf_handle_ref': vcf_shock_file_ref['handle']['hid'],
             'vcf_handle': vcf_shock_file_ref['handle'],
@@ -277,6 +224,18 @@ class VCFToVariation:
             variation_obj_data['genome_ref'] = vcf_info['genome_ref']
         if 'sample_attribute_ref' in vcf_info:
             variation_obj_data['sample_attribute_ref'] = vcf_info['sample_attribute_ref']
+        if vcf_info.get('shard_size'):
+            logging.info("Saving variation details in shards of "
+                         + str(vcf_info['shard_size']) + " variants")
+            shard_writer = VariationShardWriter(self.callback_url, vcf_info['ws_id'], self.scratch,
+                                                vcf_info['shard_size'],
+                                                cancelled=self.cancelled)
+            variation_obj_data['variation_shards'] = shard_writer.save(
+                vcf_info['variation_details'], vcf_info['variation_object_name'])
+        else:
+            variation_obj_data['variation_details'] = vcf_info['variation_details']
+        if genotype_matrix_shock_file_ref is not None:
+            variation_obj_data['genotype_matrix_handle'] = genotype_matrix_shock_file_ref['handle']
         return variation_obj_data
 
     def generate_variation_object_data (self, params):
@@ -285,9 +244,12 @@ class VCFToVariation:
 
         # Copy vcf_compressed, vcf_index,
 
-        vcf_info = self.parse_vcf_data(params['vcf_compressed'])
+        vcf_info = self.parse_vcf_data(params['vcf_compressed'],
+                                       params.get('vcf_info'),
+                                       params['vcf_index'])
         vcf_info['vcf_compressed'] = params['vcf_compressed']
         vcf_info['vcf_index'] = params['vcf_index']
+        vcf_info['uploads'] = params.get('uploads')
 
         assembly_ref = params['assembly_ref']
         if 'genome_ref' in params:
@@ -298,9 +260,21 @@ class VCFToVariation:
         if 'genome_ref' in params:
             vcf_info['genome_ref'] = genome_ref
 
+        # Variation details that do not fit in one object with their genotypes
+        # are saved as shards (see VariationShards)
+        shard_size = params.get('shard_size')
+        if not shard_size and not vcf_info['populate_genos'] and 'ws_id' in params:
+            shard_size = VariationSizeEstimator(params['vcf_compressed']).variants_per_object(
+                SHARD_BYTES)
+        if shard_size:
+            vcf_info['shard_size'] = int(shard_size)
+            vcf_info['ws_id'] = params['ws_id']
+            vcf_info['variation_object_name'] = params['variation_object_name']
+            vcf_info['variation_details'].populate_genos = True
+
         logging.info("Comparing assembly ids")
         # Validate vcf chromosome ids against assembly chromosome ids
-        result = self._validate_assembly_ids(vcf_info)
+        result = self.validate_assembly_ids(vcf_info)
         # Variation object construction
         # construct contigs_info
         if result:
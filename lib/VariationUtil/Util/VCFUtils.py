@@ -1,17 +1,40 @@
 import binascii
-import gzip
+import errno
+import fcntl
+import io
 import logging
 import os
 import re
-import subprocess
+import shutil
+import struct
 import uuid
+import zlib
+from bisect import bisect_right
 from itertools import islice
 
+from VariationUtil.Util.BGZFReader import BGZFReader, is_valid_bgzf_file
+from VariationUtil.Util.BGZFWriter import BGZFWriter, read_lines
+from VariationUtil.Util.GenotypeDensity import GenotypeDensity
+from VariationUtil.Util.GenotypeMatrix import GenotypeMatrixWriter
+from VariationUtil.Util.SNPDensity import DENSITY_BINSIZES
+from VariationUtil.Util.VCFIngest import VCFIngest
+from VariationUtil.Util.TabixIndex import TabixIndex, TabixIndexBuilder
+
+# ioctl request to clone (reflink) a file on btrfs / xfs
+FICLONE = 0x40049409
+END_PATTERN = re.compile(rb"(?:^|;)END=(\d+)")
+
 
 class VCFUtils:
 
     def __init__(self, Config):
         self.scratch = Config['scratch']
+        # Number of threads used for reading bgzipped files
+        self.threads = Config.get('threads')
+        # zlib compression level for bgzip compression
+        self.compress_level = Config.get('compress_level', 6)
+        # Optional StageScheduler.cancelled event of the import
+        self.cancelled = Config.get('cancelled')
 
     def _mkdir_p(self, path):
         """
@@ -67,7 +90,7 @@ class VCFUtils:
         filetype = None
         N = 100000
         if self.is_gz_file(filepath):
-            with gzip.open(filepath, 'rt') as infile:
+            with BGZFReader(filepath, self.threads) as infile:
                 lines_gen = islice(infile, N)
                 for line in lines_gen:
                     if line.startswith("#CHROM"):
@@ -91,162 +114,246 @@ class VCFUtils:
                                + filepath)
         return filetype
 
-    def run_command(self, command):
-        """
-        This function runs a third party command line tool
-        eg. bgzip etc.
-        :param command: command to be run
-        :return: success
+    def bgzip_and_index_vcf_file(self, filepath, filetype, session_directory,
+                                 filename, ingest=None):
         """
-        logging.info("Running command " + command)
-        cmdProcess = subprocess.Popen(command,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.STDOUT,
-                                      shell=True)
-        for line in cmdProcess.stdout:
-            logging.info(line.decode("utf-8").rstrip())
-            cmdProcess.wait()
-            logging.info('return code: ' + str(cmdProcess.returncode))
-            if cmdProcess.returncode != 0:
-                raise ValueError('Error in running command with return code: '
-                                 + command
-                                 + str(cmdProcess.returncode) + '\n')
-        logging.info("command " + command + " ran successfully")
-        return "success"
-
-    def bgzip_vcf_file(self, filepath, filetype, session_directory, filename):
-        """
-        Reads and compresses input vcf file (filepath) to a user specified
-        destination (session_directory + filename)
-        if filetype is gzip, it is decompressed and then recompressed using bgzip
-        algorithm
-        This also acts as a validation of vcf file because tabix indexing of vcf file
-        will only happen for a valid vcf file
+        Compresses the input vcf file (filepath) with bgzip and builds its
+        tabix index in the same pass (see TabixIndexBuilder). Sample names in
+        the #CHROM line are fixed on the way (see fix_header_line). Each line
+        can also be handed to a VCFIngest so the vcf content is parsed only once.
         :param filepath: user input vcf file (ascii or .gzip format)
-        :return: path of compressed bgzip file
+        :param ingest: optional VCFIngest that is fed every line
+        :return: (path of compressed bgzip file, path of index file)
         """
         destination_path = os.path.join(session_directory,
                                         filename)
-        if filetype == "gzip":
-            command = " ".join(["zcat",
-                                filepath,
-                                "|bgzip -c >",
-                                destination_path])
-        if filetype == "text":
-            command = " ".join(["cat",
-                                filepath,
-                                "|bgzip -c >",
-                                destination_path])
-        if filetype == "unsupported":
+        if filetype not in ("gzip", "text"):
             raise RuntimeError("Unsupported format in vcf file")
 
-        job_status = self.run_command(command)
-        if job_status == "success":
-            return destination_path
-        else:
-            raise RuntimeError("error in creating bgzipped staging file "
-                               + filepath)
-
-    def index_vcf_file(self, filepath):
+        builder = TabixIndexBuilder()
+        try:
+            with BGZFWriter(destination_path, self.compress_level, self.threads) as writer:
+                for line in read_lines(filepath, filetype, self.threads):
+                    if line.startswith(b"#CHROM"):
+                        line = self.fix_header_line(line)
+                    record_start = writer.bytes_in
+                    writer.write(line)
+                    if not line.strip():
+                        continue
+                    if ingest is not None:
+                        ingest.feed(line.decode("utf-8"))
+                    if line[:1] != b"#":
+                        self._index_record(builder, line, record_start, writer.bytes_in)
+        except (OSError, EOFError, zlib.error, ValueError) as e:
+            raise RuntimeError("error in creating bgzipped and indexed file from "
+                               + filepath + ": " + str(e))
+        logging.info("Compressed " + filepath + ": " + str(writer.stats()))
+
+        index_path = builder.write(destination_path, writer.virtual_offset)
+        return destination_path, index_path
+
+    def _index_record(self, builder, line, record_start, record_end):
         """
-        Runs tabix command line tool to
-        create .tbi index
-        :param filepath: path of bgzipped vcf file
-        :return: destination_path: path of index file
+        Adds a vcf data line to a TabixIndexBuilder
+        :param line: vcf data line (bytes)
+        :param record_start, record_end: uncompressed offsets of the line
         """
-        default_index_suffix = ".tbi"
-        command = "tabix -p vcf " + filepath
-        job_status = self.run_command(command)
-        if (job_status == "success"):
-            destination_path = filepath + default_index_suffix
-            if (os.path.exists(destination_path)):
-                return destination_path
-            else:
-                raise RuntimeError("Index created but can not find index file "
-                                   + destination_path)
-        else:
+        CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, *_ = line.split(b"\t", 8)
+        beg = int(POS) - 1
+        end = beg + len(REF)
+        if b"END=" in INFO:
+            match = END_PATTERN.search(INFO)
+            if match:
+                end = max(end, int(match.group(1)))
+        builder.push(CHROM.decode("utf-8"), beg, end, record_start, record_end)
+
+    def zero_copy_file(self, filepath, destination_path):
+        """
+        Copies a file without moving the data through python where possible:
+        hardlink, reflink (FICLONE), copy_file_range and finally a regular copy
+        :return: name of the method that was used
+        """
+        try:
+            os.link(filepath, destination_path)
+            return "hardlink"
+        except OSError:
+            pass
+        with open(filepath, "rb") as src, open(destination_path, "wb") as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+            if hasattr(os, "copy_file_range"):
+                try:
+                    remaining = os.fstat(src.fileno()).st_size
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                        if copied == 0:
+                            break
+                        remaining -= copied
+                    if remaining == 0:
+                        return "copy_file_range"
+                except OSError:
+                    pass
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+            shutil.copyfileobj(src, dst, 1 << 20)
+        return "copy"
+
+    def find_reusable_index(self, filepath):
+        """
+        Looks for a .tbi or .csi index next to a bgzipped vcf file and
+        checks that it can be used: not older than the vcf file, all
+        contig offsets inside the file and the first record of the first
+        and last contig found at the indexed offset
+        :return: path of the index file or None
+        """
+        size = os.path.getsize(filepath)
+        for suffix in (".tbi", ".csi"):
+            index_path = filepath + suffix
+            if not os.path.exists(index_path):
+                continue
+            if os.path.getmtime(index_path) < os.path.getmtime(filepath):
+                logging.info("Index " + index_path + " is older than the vcf file")
+                continue
+            try:
+                index = TabixIndex.read(index_path)
+                if not index.names:
+                    raise ValueError("no contigs in index")
+                for name in index.names:
+                    if index.contig_offset(name) >> 16 >= size:
+                        raise ValueError("offset of " + name + " is beyond end of file")
+                for name in {index.names[0], index.names[-1]}:
+                    with BGZFReader(filepath, 1, index.contig_offset(name)) as reader:
+                        record = next(iter(reader), "")
+                    if record.split("\t", 1)[0] != name:
+                        raise ValueError("first record of " + name + " not found")
+            except (OSError, EOFError, ValueError, struct.error, zlib.error) as e:
+                logging.info("Can not reuse index " + index_path + ": " + str(e))
+                continue
+            return index_path
+        return None
+
+    def index_bgzf_vcf_file(self, filepath, ingest=None):
+        """
+        Builds the tabix index of a bgzipped vcf file with one read pass,
+        each line can also be handed to a VCFIngest
+        :return: path of index file
+        """
+        builder = TabixIndexBuilder()
+        block_starts = list()
+        block_offsets = list()
+        uoffset = 0
+        remainder = b""
+        try:
+            with BGZFReader(filepath, self.threads) as reader:
+                for coffset, data in reader.blocks(with_offsets=True):
+                    block_starts.append(uoffset)
+                    block_offsets.append(coffset)
+                    record_start = uoffset - len(remainder)
+                    uoffset += len(data)
+                    chunk = remainder + data
+                    end = chunk.rfind(b"\n") + 1
+                    remainder = chunk[end:]
+                    self._index_lines(builder, chunk[:end], record_start, ingest)
+                # last line of a file without a final newline
+                if remainder.strip():
+                    self._index_lines(builder, remainder, uoffset - len(remainder), ingest)
+        except (OSError, EOFError, zlib.error, ValueError) as e:
             raise RuntimeError("Problem creating index file for "
-                               + filepath)
+                               + filepath + ": " + str(e))
+
+        def to_virtual(offset):
+            block = bisect_right(block_starts, offset) - 1
+            return block_offsets[block] << 16 | (offset - block_starts[block])
+
+        return builder.write(filepath, to_virtual)
 
-    def check_and_fix_headers(self, filepath):
+    def _index_lines(self, builder, data, record_start, ingest=None):
+        """
+        Adds the vcf data lines of data to a TabixIndexBuilder and feeds
+        all lines to ingest
+        :param data: complete lines (bytes)
+        :param record_start: uncompressed offset of data
+        """
+        for line in io.BytesIO(data):
+            record_end = record_start + len(line)
+            if line.strip():
+                if ingest is not None:
+                    ingest.feed(line.decode("utf-8"))
+                if line[:1] != b"#":
+                    self._index_record(builder, line, record_start, record_end)
+            record_start = record_end
+
+    def reuse_bgzf_vcf_file(self, filepath, session_directory, filename, ingest=None):
+        """
+        Input that is already valid BGZF (BC extra field and EOF marker) and
+        needs no #CHROM fixes is copied into the session directory instead
+        of being recompressed. A valid sibling .tbi / .csi index is reused,
+        otherwise the index is built from one read pass.
+        :return: (path of bgzip file, path of index file) or
+                 None if the file can not be reused
+        """
+        if not is_valid_bgzf_file(filepath):
+            return None
+        with BGZFReader(filepath, self.threads) as reader:
+            for line in reader:
+                if line.startswith("#CHROM"):
+                    header_line = line.encode("utf-8")
+                    if self.fix_header_line(header_line) != header_line:
+                        return None
+                    break
+
+        destination_path = os.path.join(session_directory, filename)
+        method = self.zero_copy_file(filepath, destination_path)
+        logging.info("Reusing bgzipped input " + filepath + " (" + method + ")")
+
+        source_index_path = self.find_reusable_index(filepath)
+        if source_index_path is None:
+            return destination_path, self.index_bgzf_vcf_file(destination_path, ingest)
+
+        index_path = destination_path + source_index_path[len(filepath):]
+        self.zero_copy_file(source_index_path, index_path)
+        logging.info("Reusing index " + source_index_path)
+        if ingest is not None:
+            with BGZFReader(destination_path, self.threads) as reader:
+                for line in reader:
+                    if line.strip():
+                        ingest.feed(line)
+        return destination_path, index_path
+
+    def fix_header_line(self, line):
         """
         Some software put the entire file path instead of sample
         name in the VCF column header. This function checks the
         column headers and removes everything before / if it looks
         like a path.
-        tabix -H only dumps the header from the vcf file
-        tabix -r optimizes the reheading process
-        :param filepath:
-        :return:
+        It is applied to the #CHROM line while the vcf is being
+        compressed, so no reheader of the compressed file is needed
+        :param line: #CHROM line (bytes)
+        :return: fixed #CHROM line (bytes)
         """
-        changed_headers = 0
-        dest_path = filepath + "_header.txt"
-        command = " ".join(["tabix -H",
-                            filepath,
-                            " > ",
-                            dest_path])
-
-        job_status = self.run_command(command)
-        if job_status == "success":
-            new_header_data = ""
-            with open(dest_path, "r") as f:
-                for line in f:
-                    if (line.startswith("#CHROM")):
-                        header_line = line
-                        header_line_elements = header_line.split("\t")
-                        new_header = list()
-                        # Take care of samples with "/"
-                        pattern1 = re.compile(r".*/")
-                        for sample in header_line_elements:
-                            # can use multiple_patterns here one in each line
-                            # sample_new = pattern2.sub("", sample_new)
-                            sample_new = pattern1.sub("", sample)
-                            if sample_new != sample:
-                                changed_headers += 1
-                                logging.info("Replacing old " + sample + " to " + sample_new)
-                                new_header.append(sample_new)
-                            else:
-                                new_header.append(sample)
-                        new_header_data += "\t".join(new_header)
-                    else:
-                        new_header_data += line
-        if (changed_headers > 0):
-            new_header_path = filepath + "_new_header.txt"
-            with open(new_header_path, "w") as wf:
-                wf.write(new_header_data)
-
-            reheader_vcf_path = filepath.replace(".vcf.gz", "") + "_reheader.vcf.gz"
-            command = " ".join(["tabix -r",
-                                new_header_path,
-                                filepath,
-                                ">",
-                                reheader_vcf_path])
-
-            job_status = self.run_command(command)
-            if job_status == "success":
-                if (os.path.exists(reheader_vcf_path)):
-                    reheader_index_file_path = self.index_vcf_file(reheader_vcf_path)
-                    return (reheader_vcf_path, reheader_index_file_path)
-        else:
-            return
-
-
-    def get_vcf_strain_ids(self, vcf_filepath):
-        reader = gzip.open(vcf_filepath, "rt")
-        for record in reader:
-            # Handle header lines and parse information
-            if (record.startswith("#CHROM")):
-                # This is the chrome line
-                record = record.rstrip()
-                values = record.split("\t")
-                genotypes = values[9:]
-                return (genotypes)
+        new_header = list()
+        # Take care of samples with "/"
+        pattern1 = re.compile(rb".*/")
+        for sample in line.split(b"\t"):
+            # can use multiple_patterns here one in each line
+            # sample_new = pattern2.sub("", sample_new)
+            sample_new = pattern1.sub(b"", sample)
+            if sample_new != sample:
+                logging.info("Replacing old " + sample.decode("utf-8")
+                             + " to " + sample_new.decode("utf-8"))
+            new_header.append(sample_new)
+        return b"\t".join(new_header)
 
     def validate_compress_and_index_vcf(self, params):
         """
         Parses VCF file, validates, compresses, indexes
-        and returns vcf file and index file path
-        :return:
+        and returns vcf file and index file path together with
+        the information collected from one pass over the final vcf file
+        :return: (vcf file path, index file path, vcf_info)
         """
 
         staging_path = params['vcf_staging_file_path']
@@ -267,32 +374,48 @@ class VCFUtils:
         filetype = self.looks_like_vcf_file(effective_staging_path)
         logging.info("Input file type is " + filetype)
 
-        # 4) Create bgzip compressed VCF variation
+        # 4) Create bgzip compressed VCF variation and its index in one pass
+        # Column headers in the VCF file with characters like "/" are fixed
+        # while compressing.
         # bgzip compressed variation can be used with large number of
-        # tools that work with vcf files. Default index is .tbi
-        logging.info("Compressing VCF file using bgzip")
+        # tools that work with vcf files. Default index is .tbi, .csi
+        # for contigs longer than 2^29.
+        # The same pass collects header, strain ids, contig counts and snp
+        # density bins for all the downstream steps, and packs the genotypes
+        # into a matrix file next to the vcf (see GenotypeMatrix)
+        logging.info("Compressing and indexing VCF file using bgzip")
+        binsizes = params.get('binsizes', DENSITY_BINSIZES)
+        # heterozygous / missing rates of the samples selected for jbrowse
+        # tracks are counted from the same genotype blocks
+        density = None
+        if params.get('genotype_track_samples'):
+            density = GenotypeDensity(params['genotype_track_samples'])
+        genotypes = GenotypeMatrixWriter(os.path.join(session_directory,
+                                                      "genotypes.npz"),
+                                         density=density)
+        ingest = VCFIngest(binsizes=binsizes, threads=self.threads,
+                           genotypes=genotypes, cancelled=self.cancelled)
         bgzip_filename = "variation.vcf.gz"
-        bgzip_filepath = self.bgzip_vcf_file(effective_staging_path,
-                                             filetype,
-                                             session_directory,
-                                             bgzip_filename)
-        logging.info("compressed vcf is in " + bgzip_filepath)
-
-        # 5) Create vcf index using tabix
-        logging.info("Creating index")
-        bgzip_index_filepath = self.index_vcf_file(bgzip_filepath)
-        logging.info("Created index " + bgzip_index_filepath)
-
-        # 6) Check if the column header in the VCF file has characters like "/" fix them
-        logging.info("Checking if headers in VCF need to be fixed")
-        reheader_result = self.check_and_fix_headers(bgzip_filepath)
-        if not reheader_result:
-            final_vcf, final_index = bgzip_filepath, bgzip_index_filepath
-        else:
-            final_vcf, final_index = reheader_result
-
-        vcf_strain_ids = self.get_vcf_strain_ids(final_vcf)
-        return (final_vcf, final_index, vcf_strain_ids)
+        try:
+            reused = None
+            if filetype == "gzip":
+                reused = self.reuse_bgzf_vcf_file(effective_staging_path,
+                                                  session_directory,
+                                                  bgzip_filename, ingest)
+            if reused is not None:
+                bgzip_filepath, bgzip_index_filepath = reused
+            else:
+                bgzip_filepath, bgzip_index_filepath = self.bgzip_and_index_vcf_file(
+                    effective_staging_path, filetype, session_directory,
+                    bgzip_filename, ingest)
+            logging.info("compressed vcf is in " + bgzip_filepath)
+            logging.info("Created index " + bgzip_index_filepath)
+
+            vcf_info = ingest.result(bgzip_filepath)
+        except BaseException:
+            genotypes.abort()
+            raise
+        return (bgzip_filepath, bgzip_index_filepath, vcf_info)
 
 
 if __name__ == '__main__':
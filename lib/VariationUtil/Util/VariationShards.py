@@ -0,0 +1,145 @@
+import json
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from VariationUtil.Util.StageScheduler import check_cancelled
+from VariationUtil.Util.StreamingJSON import save_objects_streaming
+
+SHARD_TYPE = "KBaseGwasData.VariationShard"
+# Serialized size of the shards made when no shard_size is given, far
+# below the workspace object limit so that the shards held in memory
+# while they are saved stay small
+SHARD_BYTES = 32 << 20
+# Serialized bytes of shards saved with one save_objects call, with the
+# default shard size every call saves a single shard
+BATCH_BYTES = SHARD_BYTES
+# Number of save_objects calls running at the same time, which is also
+# the number of batches held in memory besides the one being filled
+SAVE_THREADS = 4
+# Variants of a shard serialized to estimate its size
+SIZE_SAMPLES = 8
+
+
+def shard_variants(variation_details, shard_size):
+    """
+    Groups variants (in file order) into shards that hold the variants of
+    one contig, at most shard_size of them
+    :return: generator of (contig_id, variants)
+    """
+    contig = None
+    variants = list()
+    for variant in variation_details:
+        if variant["var"][0] != contig or len(variants) >= shard_size:
+            if variants:
+                yield contig, variants
+            contig = variant["var"][0]
+            variants = list()
+        variants.append(variant)
+    if variants:
+        yield contig, variants
+
+
+def shard_bytes(variants):
+    """
+    Estimates the serialized size of the variants from a few of them
+    spread over the shard
+    """
+    step = max(1, len(variants) // SIZE_SAMPLES)
+    sampled = variants[::step]
+    # ', ' between the variants
+    size = sum(len(json.dumps(variant)) + 2 for variant in sampled)
+    return size * len(variants) // len(sampled)
+
+
+class VariationShardWriter:
+    """
+    Saves variation_details as hidden KBaseGwasData.VariationShard objects
+    and returns the shard directory that goes into the Variations object:
+        [{contig_id, start, end, numvariants, shard_ref}, ...]
+
+    Shards are saved in batches of about batch_bytes serialized bytes per
+    save_objects call (a batch has at least one shard), up to threads calls
+    running at the same time. Only the shards of the running batches and
+    of the batch being filled are held in memory.
+    """
+
+    def __init__(self, callback_url, ws_id, scratch, shard_size, threads=SAVE_THREADS,
+                 batch_bytes=BATCH_BYTES, cancelled=None):
+        self.callback_url = callback_url
+        self.ws_id = ws_id
+        self.scratch = scratch
+        self.shard_size = shard_size
+        self.threads = threads
+        self.batch_bytes = batch_bytes
+        # Optional StageScheduler.cancelled event of the import
+        self.cancelled = cancelled
+
+    def _save_batch(self, objects):
+        infos = save_objects_streaming(self.callback_url, {
+            'id': self.ws_id,
+            'objects': objects
+        }, self.scratch)
+        return [str(info[6]) + "/" + str(info[0]) + "/" + str(info[4]) for info in infos]
+
+    def save(self, variation_details, object_name):
+        """
+        :param variation_details: iterable of variants, e.g. VCFReaderStream
+        :param object_name: name of the Variations object, shards are
+                            named <object_name>.shard<N>
+        :return: shard directory
+        """
+        directory = list()
+        pending = deque()
+        batch = list()
+        batch_size = 0
+
+        def collect(future, entries):
+            for entry, ref in zip(entries, future.result()):
+                entry['shard_ref'] = ref
+                directory.append(entry)
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            def submit(batch):
+                # wait for a running call to finish before another batch
+                # is handed to the executor, so no batch waits in its queue
+                while len(pending) >= self.threads:
+                    collect(*pending.popleft())
+                entries = [entry for entry, _ in batch]
+                objects = [obj for _, obj in batch]
+                pending.append((executor.submit(self._save_batch, objects), entries))
+
+            try:
+                shards = shard_variants(variation_details, self.shard_size)
+                for number, (contig, variants) in enumerate(shards):
+                    check_cancelled(self.cancelled)
+                    entry = {
+                        'contig_id': contig,
+                        'start': int(variants[0]["var"][1]),
+                        'end': int(variants[-1]["var"][1]),
+                        'numvariants': len(variants)
+                    }
+                    shard = dict(entry)
+                    shard['variation_details'] = variants
+                    batch.append((entry, {
+                        'type': SHARD_TYPE,
+                        'data': shard,
+                        'name': object_name + ".shard" + str(number),
+                        'hidden': 1
+                    }))
+                    batch_size += shard_bytes(variants)
+                    if batch_size >= self.batch_bytes:
+                        submit(batch)
+                        batch = list()
+                        batch_size = 0
+                if batch:
+                    submit(batch)
+                while pending:
+                    collect(*pending.popleft())
+            except Exception:
+                for future, _ in pending:
+                    future.cancel()
+                raise
+
+        logging.info("Saved " + str(len(directory)) + " variation shards")
+        return directory
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+
+from VariationUtil.Util.BGZFReader import BGZF_MAGIC, inflate_bgzf_block, read_bgzf_block
+from VariationUtil.Util.BGZFWriter import MAX_BLOCK_SIZE
+from VariationUtil.Util.StreamingJSON import WORKSPACE_OBJECT_LIMIT
+from VariationUtil.Util.TabixIndex import TabixIndex
+from VariationUtil.Util.VCFReaderStream import VCFReaderStream
+
+# Share of the workspace limit the projected variation_details may use,
+# the rest is left for header, contigs, strains and handles
+SIZE_MARGIN = 0.9
+# Complete records read at each sample point, blocks after the first one
+# are read until there are this many (records can be longer than a block)
+MIN_RECORDS = 8
+# Uncompressed bytes read at most at each sample point
+SAMPLE_BYTES = 16 << 20
+FIELDS = ("var", "alt_alleles", "annot", "geno")
+
+
+class VariationSizeEstimator:
+    """
+    Projects the serialized size of variation_details in the Variations
+    object without reading the whole vcf:
+        a few BGZF blocks spread evenly over the file are inflated (with
+        the blocks after them until MIN_RECORDS records are complete), their
+        records are parsed the same way VCFReaderStream does and the JSON
+        bytes per variant of each field are measured; the total comes from
+        the variant count (given, from the tabix index, or projected from
+        the compressed size of the sampled blocks)
+    """
+
+    def __init__(self, vcf_filepath, index_filepath=None, sample_blocks=16,
+                 size_limit=WORKSPACE_OBJECT_LIMIT):
+        self.vcf_filepath = vcf_filepath
+        self.index_filepath = index_filepath
+        self.sample_blocks = sample_blocks
+        self.size_limit = size_limit
+
+    @staticmethod
+    def _next_block(handle, position):
+        """
+        Finds the first BGZF block starting at or after position
+        :return: (compressed block size, uncompressed data) or None
+        """
+        handle.seek(position)
+        buf = handle.read(2 * MAX_BLOCK_SIZE)
+        start = buf.find(BGZF_MAGIC)
+        while start != -1:
+            if buf[start + 12:start + 14] == b"BC":
+                handle.seek(position + start)
+                try:
+                    block = read_bgzf_block(handle)
+                    if block is not None:
+                        return handle.tell() - position - start, inflate_bgzf_block(block)
+                except ValueError:
+                    pass
+            start = buf.find(BGZF_MAGIC, start + 1)
+        return None
+
+    def _sample_point(self, handle, position, seen):
+        """
+        Complete data lines from the first block at or after position and
+        as many blocks after it as needed for MIN_RECORDS of them
+        :param seen: compressed offsets of the blocks already read
+        :return: (data lines, compressed bytes read)
+        """
+        found = self._next_block(handle, position)
+        if found is None:
+            return [], 0
+        block_size, data = found
+        block_start = handle.tell() - block_size
+        if block_start in seen:
+            return [], 0
+        seen.add(block_start)
+        compressed = block_size
+        inflated = len(data)
+        # the first line may have started in the block before
+        partial = block_start != 0
+        remainder = b""
+        records = list()
+        while True:
+            lines = (remainder + data).split(b"\n")
+            # the last line ends in a block that is not read yet
+            remainder = lines.pop()
+            if partial and lines:
+                lines = lines[1:]
+                partial = False
+            records.extend(line.decode("utf-8", "replace") for line in lines
+                           if line and line[:1] != b"#")
+            if len(records) >= MIN_RECORDS or inflated >= SAMPLE_BYTES:
+                break
+            block_start = handle.tell()
+            block = read_bgzf_block(handle)
+            if block is None or block_start in seen:
+                break
+            seen.add(block_start)
+            data = inflate_bgzf_block(block)
+            if not data:
+                break
+            compressed += handle.tell() - block_start
+            inflated += len(data)
+        return records, compressed
+
+    def sample_records(self):
+        """
+        :return: (list of complete data lines from the sampled blocks,
+                  compressed bytes of the sampled blocks)
+        """
+        filesize = os.stat(self.vcf_filepath).st_size
+        positions = sorted({i * filesize // self.sample_blocks
+                            for i in range(self.sample_blocks)})
+        records = list()
+        compressed = 0
+        seen = set()
+        with open(self.vcf_filepath, "rb") as handle:
+            for position in positions:
+                point_records, point_compressed = self._sample_point(handle, position, seen)
+                records.extend(point_records)
+                compressed += point_compressed
+        return records, compressed
+
+    def _index_variants(self):
+        if not self.index_filepath or not os.path.exists(self.index_filepath):
+            return None
+        index = TabixIndex.read(self.index_filepath)
+        counts = [index.record_count(name) for name in index.names]
+        if None in counts:
+            return None
+        return sum(counts)
+
+    def _bytes_per_variant(self, records):
+        bytes_per_variant = {field: 0.0 for field in FIELDS}
+        for record in records:
+            variant = VCFReaderStream.parse_record(record, True)
+            for field in FIELDS:
+                if field in variant:
+                    # '"field": value' plus the ', ' separator
+                    bytes_per_variant[field] += len(json.dumps({field: variant[field]}))
+        if records:
+            bytes_per_variant = {field: size / len(records)
+                                 for field, size in bytes_per_variant.items()}
+        return bytes_per_variant
+
+    def estimate(self, total_variants=None):
+        """
+        :param total_variants: number of variants if already known
+        :return: dict with variants, bytes_per_variant of each field and
+                 projected size with and without genotypes
+        """
+        records, compressed = self.sample_records()
+        bytes_per_variant = self._bytes_per_variant(records)
+
+        if total_variants is None:
+            total_variants = self._index_variants()
+        if total_variants is None:
+            filesize = os.stat(self.vcf_filepath).st_size
+            total_variants = int(len(records) * filesize / compressed) if compressed else 0
+
+        # braces of each variant and ', ' between them
+        without_genos = 4 + sum(size for field, size in bytes_per_variant.items()
+                                if field != "geno")
+        estimate = {
+            "variants": total_variants,
+            "sampled_variants": len(records),
+            "bytes_per_variant": bytes_per_variant,
+            "size_without_genos": int(total_variants * without_genos),
+            "size_with_genos": int(total_variants * (without_genos + bytes_per_variant["geno"]))
+        }
+        logging.info("Estimated size of variation details: " + str(estimate))
+        return estimate
+
+    def populate_genos(self, total_variants=None):
+        """
+        :return: True if variation_details with genotypes are projected
+                 to fit in the workspace object size limit
+        """
+        estimate = self.estimate(total_variants)
+        if not estimate["sampled_variants"]:
+            logging.warning("No complete record found in the sampled blocks of "
+                            + self.vcf_filepath + ", genotypes are not stored")
+            return False
+        return estimate["size_with_genos"] <= self.size_limit * SIZE_MARGIN
+
+    def variants_per_object(self, object_size):
+        """
+        :param object_size: serialized size of the objects in bytes, e.g.
+                            VariationShards.SHARD_BYTES
+        :return: number of variants with genotypes that fit in an object of
+                 object_size (see VariationShards)
+        """
+        size = min(object_size, self.size_limit * SIZE_MARGIN)
+        records, _ = self.sample_records()
+        if not records:
+            # no record was complete in SAMPLE_BYTES, each is at least that long
+            logging.warning("No complete record found in the sampled blocks of "
+                            + self.vcf_filepath + ", using the smallest shards")
+            return max(1, int(size / SAMPLE_BYTES))
+        bytes_per_variant = 4 + sum(self._bytes_per_variant(records).values())
+        return max(1, int(size / bytes_per_variant))
@@ -3,14 +3,16 @@ import os
 from installed_clients.DataFileUtilClient import DataFileUtil
 from installed_clients.KBaseReportClient import KBaseReport
 from installed_clients.WorkspaceClient import Workspace
+from VariationUtil.Util.UploadScheduler import UploadScheduler
 import shutil 
 
 
 class htmlreportutils:
 
-    def __init__(self):
+    def __init__(self, uploads=None):
         callback_url = os.environ['SDK_CALLBACK_URL']
         self.dfu = DataFileUtil(callback_url)
+        self.uploads = uploads or UploadScheduler(self.dfu)
         self.report = KBaseReport(callback_url)
         pass
 
@@ -21,8 +23,8 @@ class htmlreportutils:
 
         report_name = 'VariationReport' + str(uuid.uuid4())
 
-        report_shock_id = self.dfu.file_to_shock({'file_path': output_dir,
-                                            'pack': 'zip'})['shock_id']
+        report_shock_id = self.uploads.upload({'file_path': output_dir,
+                                               'pack': 'zip'}).result()['shock_id']
 
         html_file = {
             'shock_id': report_shock_id,
@@ -10,9 +10,15 @@ from VariationUtil.Util.htmlreportutils import htmlreportutils
 from VariationUtil.Util.StrainInfo import StrainInfo
 from VariationUtil.Util.JbrowseUtil import JbrowseUtil
 from VariationUtil.Util.VariationReport import VariationReport
+from VariationUtil.Util.AssemblyMetadata import AssemblyMetadata
+from VariationUtil.Util.StreamingJSON import save_objects_streaming
+from VariationUtil.Util.StageScheduler import StageScheduler
+from VariationUtil.Util.SNPDensity import DENSITY_BINSIZES
+from VariationUtil.Util.UploadScheduler import UploadScheduler, DEFAULT_UPLOADS
 
 from installed_clients.WorkspaceClient import Workspace
 from installed_clients.DataFileUtilClient import DataFileUtil
+from installed_clients.baseclient import configure_session
 
 #END_HEADER
 
@@ -53,14 +59,38 @@ class VariationUtil:
         self.config['ws_url'] = config['workspace-url']
 
         self.callback_url = os.environ['SDK_CALLBACK_URL']
+        # Optional settings of the keep-alive connection pool shared by all
+        # service clients (see baseclient.get_session)
+        configure_session(
+            pool_size=int(config['client_pool_size']) if config.get('client_pool_size') else None,
+            retries=int(config['client_retries']) if config.get('client_retries') else None,
+            backoff=float(config['client_backoff']) if config.get('client_backoff') else None)
         self.scratch = config['scratch']
         self.shared_folder = config['scratch']
-        self.hr = htmlreportutils()
         self.ws_url = config['workspace-url']
         self.wsc = Workspace(self.ws_url)
         self.dfu = DataFileUtil(self.callback_url)
+        # Uploads to shock run in the background on upload_threads threads,
+        # shared by all steps of an import
+        upload_threads = int(config.get('upload_threads', DEFAULT_UPLOADS))
+        self.uploads = UploadScheduler(self.dfu, upload_threads)
+        self.hr = htmlreportutils(self.uploads)
         self.shock_url = config['shock-url']
         self.sw_url = config['srv-wiz-url']
+        # Optional number of threads for decompressing bgzipped vcf files,
+        # defaults to the number of cores
+        self.threads = int(config['threads']) if config.get('threads') else None
+        # Optional number of processes for contig parallel vcf processing and
+        # region size (bp) used to split very large contigs
+        self.processes = int(config['processes']) if config.get('processes') else None
+        self.region_size = int(config['region_size']) if config.get('region_size') else None
+        # Optional zlib level for bgzip compression of the uploaded vcf
+        self.compress_level = int(config.get('compress_level', 6))
+        # Contig ids and lengths of assemblies are fetched once per job and
+        # shared by its steps; assembly_cache_dir enables an LRU disk cache of
+        # assembly_cache_size bytes across jobs
+        self.assembly_cache_dir = config.get('assembly_cache_dir')
+        self.assembly_cache_size = int(config.get('assembly_cache_size', 1 << 30))
         pass
         #END_CONSTRUCTOR
         pass
@@ -78,16 +108,21 @@ class VariationUtil:
            associated with samples variation_object_name: output name for
            KBase variation object *** sample input data ***
            sample_attribute_ref: x/y/z reference to kbase sample attribute
-           optional params: NA output report: report_name report_ref HTML
-           visualization: Manhattan plot *** Visualization *** plot_maf:
-           generate histogram of minor allele frequencies plot_hwe: generate
-           histogram of Hardy-Weinberg Equilibrium p-values) -> structure:
-           parameter "workspace_name" of String, parameter
-           "genome_or_assembly_ref" of type "obj_ref" (An X/Y/Z style
-           reference), parameter "vcf_staging_file_path" of type "filepath"
-           (KBase file path to staging files), parameter
-           "variation_object_name" of String, parameter
-           "sample_attribute_ref" of type "obj_ref" (An X/Y/Z style reference)
+           optional params: shard_size: save the variant details in
+           VariationShard objects of at most this many variants (large files
+           are sharded automatically) genotype_track_samples: vcf sample names
+           that get heterozygosity and missing call rate tracks in the genome
+           browser output report: report_name report_ref HTML visualization:
+           Manhattan plot *** Visualization *** plot_maf: generate histogram
+           of minor allele frequencies plot_hwe: generate histogram of
+           Hardy-Weinberg Equilibrium p-values) -> structure: parameter
+           "workspace_name" of String, parameter "genome_or_assembly_ref" of
+           type "obj_ref" (An X/Y/Z style reference), parameter
+           "vcf_staging_file_path" of type "filepath" (KBase file path to
+           staging files), parameter "variation_object_name" of String,
+           parameter "sample_attribute_ref" of type "obj_ref" (An X/Y/Z style
+           reference), parameter "shard_size" of Long, parameter
+           "genotype_track_samples" of list of String
         :returns: instance of type "save_variation_output" -> structure:
            parameter "variation_ref" of String, parameter "report_name" of
            String, parameter "report_ref" of String
@@ -98,162 +133,261 @@ class VariationUtil:
 
         # Get workspace id
         ws_id = self.dfu.ws_name_to_id(params['workspace_name'])
-
-        genome_ref = None
-        assembly_ref = None
+        # variant density is counted at several resolutions, the snp
+        # frequency track is built at binsize
+        density_binsizes = DENSITY_BINSIZES
+        binsize = 10000
+
+        # The import runs as a graph of stages (see StageScheduler), independent
+        # stages such as the vcf compression and the sample set download run
+        # at the same time.
+        stages = StageScheduler()
+        assembly_metadata = AssemblyMetadata(self.wsc, self.assembly_cache_dir,
+                                             self.assembly_cache_size)
 
         # 1) Find whether the input is a genome or assembly
         #    and get genome_ref and assembly_ref
-
-        genome_or_assembly_ref = params['genome_or_assembly_ref']
-        obj_type = self.wsc.get_object_info3({
-            'objects':[{
-                'ref': genome_or_assembly_ref
-                      }]})['infos'][0][2]
-        if ('KBaseGenomes.Genome' in obj_type):
-            genome_ref = genome_or_assembly_ref
-            subset = self.wsc.get_object_subset([{
-                    'included': ['/assembly_ref'],
-                    'ref': genome_ref
-                }])
-            assembly_ref = subset[0]['data']['assembly_ref']
-        elif ('KBaseGenomeAnnotations.Assembly' in obj_type):
-            assembly_ref = genome_or_assembly_ref
-        else:
-            raise ValueError(obj_type + ' is not the right input for this method. '
-                                      + 'Valid input include KBaseGenomes.Genome or '
-                                      + 'KBaseGenomeAnnotations.Assembly ')
-
+        def resolve_refs():
+            genome_ref = None
+            genome_or_assembly_ref = params['genome_or_assembly_ref']
+            obj_type = self.wsc.get_object_info3({
+                'objects':[{
+                    'ref': genome_or_assembly_ref
+                          }]})['infos'][0][2]
+            if ('KBaseGenomes.Genome' in obj_type):
+                genome_ref = genome_or_assembly_ref
+                subset = self.wsc.get_object_subset([{
+                        'included': ['/assembly_ref'],
+                        'ref': genome_ref
+                    }])
+                assembly_ref = subset[0]['data']['assembly_ref']
+            elif ('KBaseGenomeAnnotations.Assembly' in obj_type):
+                assembly_ref = genome_or_assembly_ref
+            else:
+                raise ValueError(obj_type + ' is not the right input for this method. '
+                                          + 'Valid input include KBaseGenomes.Genome or '
+                                          + 'KBaseGenomeAnnotations.Assembly ')
+            return {'genome_ref': genome_ref, 'assembly_ref': assembly_ref}
+
+        stages.add('refs', resolve_refs)
 
         # 2)  Validate VCF, compress, and build VCF index
-        logging.info("Validating VCF, Compressing VCF and Indexing VCF")
-        VCFUtilsConfig = {
-            "scratch": self.scratch
-        }
-        VCFUtilsParams = {
-            'vcf_staging_file_path': params['vcf_staging_file_path']
-        }
-        VCU = VCFUtils(VCFUtilsConfig)
-        vcf_compressed, vcf_index, vcf_strain_ids = VCU.validate_compress_and_index_vcf(VCFUtilsParams)
-
-        if vcf_index is not None:
-            logging.info("vcf compressed :" + str(vcf_compressed))
-            logging.info("vcf index :" + str(vcf_index))
-            logging.info("vcf strain ids :" + str(vcf_strain_ids))
-        else:
-            raise ValueError("No result obtained after compression and indexing step")
-
+        def compress_vcf():
+            logging.info("Validating VCF, Compressing VCF and Indexing VCF")
+            VCFUtilsConfig = {
+                "scratch": self.scratch,
+                "threads": self.threads,
+                "compress_level": self.compress_level,
+                "cancelled": stages.cancelled
+            }
+            VCFUtilsParams = {
+                'vcf_staging_file_path': params['vcf_staging_file_path'],
+                'binsizes': density_binsizes,
+                'genotype_track_samples': params.get('genotype_track_samples')
+            }
+            VCU = VCFUtils(VCFUtilsConfig)
+            vcf_compressed, vcf_index, vcf_info = VCU.validate_compress_and_index_vcf(VCFUtilsParams)
+
+            if vcf_index is not None:
+                logging.info("vcf compressed :" + str(vcf_compressed))
+                logging.info("vcf index :" + str(vcf_index))
+                logging.info("vcf strain ids :" + str(vcf_info['genotype_ids']))
+            else:
+                raise ValueError("No result obtained after compression and indexing step")
+
+            # the compressed vcf, its index and the genotype matrix are uploaded
+            # while the strain info and the variation object are prepared
+            vcf_uploads = {
+                'vcf': self.uploads.upload({'file_path': vcf_compressed, 'make_handle': 1}),
+                'vcf_index': self.uploads.upload({'file_path': vcf_index, 'make_handle': 1})
+            }
+            if vcf_info.get('genotype_matrix'):
+                vcf_uploads['genotype_matrix'] = self.uploads.upload({
+                    'file_path': vcf_info['genotype_matrix'],
+                    'make_handle': 1
+                })
+            return {
+                'vcf_compressed': vcf_compressed,
+                'vcf_index': vcf_index,
+                'vcf_info': vcf_info,
+                'uploads': vcf_uploads
+            }
+
+        stages.add('vcf', compress_vcf)
 
         # Get strain info
         # TODO: Remove hard coded stuff
-        StrainInfoConfig = self.config
-        StrainInfoParams = {
-            "ws_id": ws_id,
-            "vcf_strain_ids": vcf_strain_ids,
-            "sample_set_ref": params["sample_set_ref"],
-            "sample_attribute_name": params["sample_attribute_name"]
+        si = StrainInfo(self.config)
+        stages.add('sample_set', lambda: si.prepare_sample_set(params["sample_set_ref"]))
+
+        def strain_info(vcf, sample_set):
+            StrainInfoParams = {
+                "ws_id": ws_id,
+                "vcf_strain_ids": vcf['vcf_info']['genotype_ids'],
+                "sample_set_ref": params["sample_set_ref"],
+                "sample_attribute_name": params["sample_attribute_name"]
+            }
+            sample_attribute_ref, strains = si.sample_strain_info(StrainInfoParams, sample_set)
+            print (sample_attribute_ref)
+            print (strains)
+            return sample_attribute_ref, strains
+
+        stages.add('strains', strain_info, after=('vcf', 'sample_set'))
+
+        VCFToVariationConfig = {
+            "ws_url": self.ws_url,
+            "scratch": self.scratch,
+            "threads": self.threads,
+            "processes": self.processes,
+            "region_size": self.region_size,
+            "assembly_metadata": assembly_metadata,
+            "uploads": self.uploads,
+            "cancelled": stages.cancelled
         }
-        si = StrainInfo(StrainInfoConfig)
-        sample_attribute_ref, strains = si.sample_strain_info(StrainInfoParams)
-        print (sample_attribute_ref)
-        print (strains)
 
+        # Validate vcf contig ids against the assembly before the variation
+        # object and the jbrowse tracks use the assembly contig lengths
+        def check_contigs(refs, vcf):
+            vtv = VCFToVariation(VCFToVariationConfig)
+            return vtv.validate_assembly_ids({
+                'assembly_ref': refs['assembly_ref'],
+                'chromosome_ids': vcf['vcf_info']['chromosome_ids']
+            })
+
+        stages.add('contigs', check_contigs, after=('refs', 'vcf'))
 
         # 3) Create json for variation object. In a following step genomic_indexes will be
         # added to this json before it is saved as Variation object
-
-        VCFToVariationConfig = {
-            "ws_url": self.ws_url,
-            "scratch": self.scratch
-        }
-        VCFToVariationParams = {
-            "vcf_compressed": vcf_compressed,
-            "vcf_index": vcf_index,
-            "assembly_ref": assembly_ref
-        }
-        if genome_ref is not None:
-            VCFToVariationParams['genome_ref'] = genome_ref
-
-        vtv = VCFToVariation(VCFToVariationConfig)
-        variation_object_data = vtv.generate_variation_object_data(VCFToVariationParams)
-        # Append sample information
-        if sample_attribute_ref:
-            variation_object_data['sample_attribute_ref'] = sample_attribute_ref
-        else:
-            raise ValueError(f'sample attribute ref not found')
-        if strains:
-            variation_object_data['strains'] = strains
-        else:
-            raise ValueError(f'strains not found')
-        if 'sample_set_ref' in params:
-            variation_object_data['sample_set_ref'] = params['sample_set_ref']
-        else:
-            raise ValueError(f'sample_set_ref not found in params')
-
-        # 4)
+        def variation_data(refs, vcf, contigs):
+            VCFToVariationParams = {
+                "vcf_compressed": vcf['vcf_compressed'],
+                "vcf_index": vcf['vcf_index'],
+                "vcf_info": vcf['vcf_info'],
+                "assembly_ref": refs['assembly_ref'],
+                "ws_id": ws_id,
+                "variation_object_name": params['variation_object_name'],
+                "uploads": vcf['uploads']
+            }
+            if params.get('shard_size'):
+                VCFToVariationParams['shard_size'] = params['shard_size']
+            if refs['genome_ref'] is not None:
+                VCFToVariationParams['genome_ref'] = refs['genome_ref']
+
+            vtv = VCFToVariation(VCFToVariationConfig)
+            return vtv.generate_variation_object_data(VCFToVariationParams)
+
+        stages.add('variation', variation_data, after=('refs', 'vcf', 'contigs'))
+
+        # 4) Jbrowse tracks, the genome features track only needs the genome
         JbrowseConfig = {
             "ws_url": self.ws_url,
             "scratch": self.scratch,
             "sw_url": self.sw_url,
-            "shock_url":self.shock_url
+            "shock_url":self.shock_url,
+            "threads": self.threads,
+            "assembly_metadata": assembly_metadata,
+            "uploads": self.uploads,
+            "feature_track_cache_dir": self.config.get('feature_track_cache_dir'),
+            "feature_track_cache_size": self.config.get('feature_track_cache_size')
         }
-        JbrowseParams = {
-            "vcf_path": vcf_compressed,
-            "assembly_ref": assembly_ref,
-            "binsize": 10000,
-            "vcf_shock_id": variation_object_data['vcf_handle']['id'],
-            "vcf_index_shock_id":variation_object_data['vcf_index_handle']['id']
-        }
-        if genome_ref is not None:
-            JbrowseParams["genome_ref"] = genome_ref
-
         jb = JbrowseUtil(JbrowseConfig)
-        jbrowse_report = jb.prepare_jbrowse_report(JbrowseParams)
 
+        def genome_features(refs):
+            if refs['genome_ref'] is None:
+                return None
+            vfs_url = jb.get_variation_service_url(self.sw_url)
+            return jb.prepare_genome_features_track(refs['genome_ref'], vfs_url)
+
+        stages.add('genome_features', genome_features, after=('refs',))
+
+        def jbrowse(refs, vcf, genome_features, contigs):
+            JbrowseParams = {
+                "vcf_path": vcf['vcf_compressed'],
+                "vcf_index_path": vcf['vcf_index'],
+                "assembly_ref": refs['assembly_ref'],
+                "binsize": binsize,
+                "density": vcf['vcf_info']['density'],
+                "genotype_density": vcf['vcf_info'].get('genotype_density'),
+                "vcf_shock_id": vcf['uploads']['vcf'].result()['handle']['id'],
+                "vcf_index_shock_id": vcf['uploads']['vcf_index'].result()['handle']['id']
+            }
+            if refs['genome_ref'] is not None:
+                JbrowseParams["genome_ref"] = refs['genome_ref']
+                JbrowseParams["genome_features"] = genome_features
+            return jb.prepare_jbrowse_report(JbrowseParams)
+
+        stages.add('jbrowse', jbrowse, after=('refs', 'vcf', 'genome_features', 'contigs'))
 
         # 5) Now we have the genomic indices and we have all the information needed to save
         # the variation object
         # TODO: Take out the genomic_indexes field from the object spec
         #  TODO: Take out the vcf_handle stuff not needed
-
-        variation_object_data['genomic_indexes'] = jbrowse_report['genomic_indexes']
-
-        var_obj = self.dfu.save_objects({
-            'id': self.dfu.ws_name_to_id(params['workspace_name']),
-            'objects': [{
-                'type': 'KBaseGwasData.Variations',
-                'data': variation_object_data,
-                'name': params['variation_object_name']
-            }]
-        })[0]
-
-        var_obj_ref = str(var_obj[6]) + "/" + str(var_obj[0]) + "/" + str(var_obj[4])
-        print (var_obj_ref)
-
-
-        # 5) Build Variation report
+        def save_variation(variation, strains, jbrowse):
+            variation_object_data = variation
+            sample_attribute_ref, strains = strains
+            # Append sample information
+            if sample_attribute_ref:
+                variation_object_data['sample_attribute_ref'] = sample_attribute_ref
+            else:
+                raise ValueError(f'sample attribute ref not found')
+            if strains:
+                variation_object_data['strains'] = strains
+            else:
+                raise ValueError(f'strains not found')
+            if 'sample_set_ref' in params:
+                variation_object_data['sample_set_ref'] = params['sample_set_ref']
+            else:
+                raise ValueError(f'sample_set_ref not found in params')
+
+            variation_object_data['genomic_indexes'] = jbrowse['genomic_indexes']
+
+            # variation_details is a generator over the vcf file, the request is
+            # streamed to a file in scratch so the object is never held in memory
+            var_obj = save_objects_streaming(self.callback_url, {
+                'id': ws_id,
+                'objects': [{
+                    'type': 'KBaseGwasData.Variations',
+                    'data': variation_object_data,
+                    'name': params['variation_object_name']
+                }]
+            }, self.scratch)[0]
+
+            var_obj_ref = str(var_obj[6]) + "/" + str(var_obj[0]) + "/" + str(var_obj[4])
+            print (var_obj_ref)
+            return var_obj_ref
+
+        stages.add('save', save_variation, after=('variation', 'strains', 'jbrowse'))
+
+        # 6) Build Variation report
         # This is a simple report
         #
-        workspace = params['workspace_name']
-        created_objects = []
-        created_objects.append({
-            "ref": var_obj_ref,
-            "description": "Variation Object"
-            })
-        ReportConfig = {
-            "ws_url": self.ws_url,
-            "scratch": self.scratch,
-        }
-        ReportParams = {
-            "variation_ref": var_obj_ref
-        }
-        vr = VariationReport(ReportConfig)
-        htmlreport_dir = vr.create_variation_report(ReportParams)
-
-        report = self.hr.create_html_report(htmlreport_dir,
-                                            workspace,
-                                            created_objects)
-        report['variation_ref'] = var_obj_ref
+        def variation_report(save):
+            var_obj_ref = save
+            workspace = params['workspace_name']
+            created_objects = []
+            created_objects.append({
+                "ref": var_obj_ref,
+                "description": "Variation Object"
+                })
+            ReportConfig = {
+                "ws_url": self.ws_url,
+                "scratch": self.scratch,
+            }
+            ReportParams = {
+                "variation_ref": var_obj_ref
+            }
+            vr = VariationReport(ReportConfig)
+            htmlreport_dir = vr.create_variation_report(ReportParams)
+
+            report = self.hr.create_html_report(htmlreport_dir,
+                                                workspace,
+                                                created_objects)
+            report['variation_ref'] = var_obj_ref
+            return report
+
+        stages.add('report', variation_report, after=('save',))
+
+        report = stages.run()['report']
         print(report)
         #END save_variation_from_vcf
 
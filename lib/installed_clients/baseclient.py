@@ -11,9 +11,13 @@ import json as _json
 import requests as _requests
 import random as _random
 import os as _os
+import tempfile as _tempfile
+import threading as _threading
 import traceback as _traceback
+from requests.adapters import HTTPAdapter as _HTTPAdapter
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import ProtocolError
+from urllib3.util.retry import Retry as _Retry
 
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
@@ -31,6 +35,62 @@ _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
 _CHECK_JOB_RETRYS = 3
 
+# Connection pool shared by all clients in the process, see get_session
+_SESSION = None
+_SESSION_LOCK = _threading.Lock()
+_SESSION_CONFIG = {
+    'pool_size': int(_os.environ.get('KB_CLIENT_POOL_SIZE', 20)),
+    'retries': int(_os.environ.get('KB_CLIENT_RETRIES', 3)),
+    'backoff': float(_os.environ.get('KB_CLIENT_BACKOFF', 0.5))
+}
+
+
+def configure_session(pool_size=None, retries=None, backoff=None):
+    '''
+    Changes the settings of the shared session, the session is rebuilt on
+    the next call.
+    pool_size - keep-alive connections kept per host.
+    retries - retries of requests that failed to connect or got a 503
+        (a JSON-RPC call that reached the server is never sent twice).
+    backoff - backoff factor in seconds between retries (backoff * 2^n).
+    '''
+    global _SESSION
+    with _SESSION_LOCK:
+        for key, value in (('pool_size', pool_size), ('retries', retries),
+                           ('backoff', backoff)):
+            if value is not None:
+                _SESSION_CONFIG[key] = value
+        _SESSION = None
+
+
+def get_session():
+    '''
+    The requests.Session with a keep-alive connection pool shared by all
+    clients in the process
+    '''
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            retry_args = dict(total=_SESSION_CONFIG['retries'],
+                              connect=_SESSION_CONFIG['retries'], read=0,
+                              status=_SESSION_CONFIG['retries'],
+                              status_forcelist=(503,),
+                              backoff_factor=_SESSION_CONFIG['backoff'],
+                              raise_on_status=False)
+            try:
+                retry = _Retry(allowed_methods=None, **retry_args)
+            except TypeError:
+                # urllib3 < 1.26
+                retry = _Retry(method_whitelist=False, **retry_args)
+            adapter = _HTTPAdapter(pool_connections=_SESSION_CONFIG['pool_size'],
+                                   pool_maxsize=_SESSION_CONFIG['pool_size'],
+                                   max_retries=retry)
+            session = _requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _SESSION = session
+        return _SESSION
+
 
 def _get_token(user_id, password, auth_svc):
     # This is bandaid helper function until we get a full
@@ -164,7 +224,8 @@ class BaseClient(object):
         if self.timeout < 1:
             raise ValueError('Timeout value must be at least 1 second')
 
-    def _call(self, url, method, params, context=None):
+    def _call(self, url, method, params, context=None, body_writer=None,
+              body_dir=None):
         arg_hash = {'method': method,
                     'params': params,
                     'version': '1.1',
@@ -175,10 +236,19 @@ class BaseClient(object):
                 raise ValueError('context is not type dict as required.')
             arg_hash['context'] = context
 
-        body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
-                             timeout=self.timeout,
-                             verify=not self.trust_all_ssl_certificates)
+        if body_writer is None:
+            body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
+            ret = get_session().post(url, data=body, headers=self._headers,
+                                     timeout=self.timeout,
+                                     verify=not self.trust_all_ssl_certificates)
+        else:
+            with _tempfile.TemporaryFile(dir=body_dir) as body:
+                body_writer(arg_hash, body)
+                body.seek(0)
+                ret = get_session().post(
+                    url, data=body, headers=self._headers,
+                    timeout=self.timeout,
+                    verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
         if ret.status_code == 500:
             if ret.headers.get(_CT) == _AJ:
@@ -220,13 +290,14 @@ class BaseClient(object):
         return self._call(self.url, service + '._check_job', [job_id])
 
     def _submit_job(self, service_method, args, service_ver=None,
-                    context=None):
+                    context=None, body_writer=None, body_dir=None):
         context = self._set_up_context(service_ver, context)
         mod, meth = service_method.split('.')
         return self._call(self.url, mod + '._' + meth + '_submit',
-                          args, context)
+                          args, context, body_writer, body_dir)
 
-    def run_job(self, service_method, args, service_ver=None, context=None):
+    def run_job(self, service_method, args, service_ver=None, context=None,
+                body_writer=None, body_dir=None):
         '''
         Run a SDK method asynchronously.
         Required arguments:
@@ -236,9 +307,15 @@ class BaseClient(object):
         service_ver - the version of the service to run, e.g. a git hash
             or dev/beta/release.
         context - the rpc context dict.
+        body_writer - function(request, file) that writes the JSON-RPC
+            request of the submit call to a binary file, which is then
+            streamed as the request body instead of a string built in
+            memory.
+        body_dir - directory of that temporary file.
         '''
         mod, _ = service_method.split('.')
-        job_id = self._submit_job(service_method, args, service_ver, context)
+        job_id = self._submit_job(service_method, args, service_ver, context,
+                                  body_writer, body_dir)
         async_job_check_time = self.async_job_check_time
         check_job_failures = 0
         while check_job_failures < _CHECK_JOB_RETRYS:
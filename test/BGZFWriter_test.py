@@ -0,0 +1,72 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from VariationUtil.Util.BGZFReader import BGZFReader, BGZF_EOF, is_valid_bgzf_file
+from VariationUtil.Util.BGZFWriter import BGZFWriter, BLOCK_SIZE, bgzip_file
+
+small_poplar_vcf_gz = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "sample_data", "small_poplar", "small_poplar.vcf.gz")
+
+
+class BGZFWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random.seed(4)
+        self.lines = [("chr" + str(i % 3) + "\t" + str(i) + "\t"
+                       + "ACGT" * random.randint(1, 200) + "\n").encode()
+                      for i in range(20000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, threads):
+        path = os.path.join(self.tmp_dir, "out_" + str(threads) + ".gz")
+        with BGZFWriter(path, 6, threads) as writer:
+            for line in self.lines:
+                writer.write(line)
+        return path, writer
+
+    def test_round_trip(self):
+        for threads in (1, 4):
+            path, writer = self._write(threads)
+            data = b"".join(self.lines)
+            with gzip.open(path, "rb") as f:
+                self.assertEqual(f.read(), data)
+            with open(path, "rb") as f:
+                self.assertTrue(f.read().endswith(BGZF_EOF))
+            self.assertTrue(is_valid_bgzf_file(path))
+            self.assertEqual(writer.bytes_in, len(data))
+            self.assertEqual(writer.bytes_out, os.path.getsize(path))
+
+    def test_block_offsets(self):
+        path, writer = self._write(4)
+        with BGZFReader(path, 2) as reader:
+            blocks = list(reader.blocks(with_offsets=True))
+        # every block except the last one is full
+        self.assertTrue(all(len(data) == BLOCK_SIZE for _, data in blocks[:-2]))
+        self.assertEqual([offset for offset, _ in blocks], writer.block_offsets)
+
+    def test_virtual_offset(self):
+        path, writer = self._write(4)
+        starts = [0]
+        for line in self.lines:
+            starts.append(starts[-1] + len(line))
+        with pysam.BGZFile(path, "rb") as f:
+            for i in (0, 1, 999, 5000, len(self.lines) - 1):
+                f.seek(writer.virtual_offset(starts[i]))
+                self.assertEqual(f.readline().rstrip(b"\n"), self.lines[i].rstrip(b"\n"))
+
+    def test_bgzip_file(self):
+        path = os.path.join(self.tmp_dir, "small_poplar.vcf.gz")
+        stats = bgzip_file(small_poplar_vcf_gz, "gzip", path, threads=2)
+        with gzip.open(small_poplar_vcf_gz, "rb") as expected, gzip.open(path, "rb") as f:
+            self.assertEqual(f.read(), expected.read())
+        self.assertTrue(is_valid_bgzf_file(path))
+        self.assertEqual(stats["bytes_out"], os.path.getsize(path))
@@ -0,0 +1,106 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pyBigWig
+
+from VariationUtil.Util.BigWigWriter import BigWigWriter, summarise
+
+BINSIZE = 10000
+
+
+class BigWigWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random.seed(1)
+        np.random.seed(1)
+        self.sizes = {"c" + str(i): random.randrange(50000, 3000000) for i in range(40)}
+        self.data = dict()
+        for contig, size in self.sizes.items():
+            if random.random() < 0.2:
+                continue
+            nbins = (size + BINSIZE - 1) // BINSIZE
+            bins = np.array(sorted(random.sample(range(nbins), random.randrange(1, nbins + 1))))
+            starts = bins * BINSIZE
+            ends = np.minimum(starts + BINSIZE, size)
+            values = np.random.randint(1, 100, len(starts)).astype(float)
+            self.data[contig] = (starts, ends, values)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, compress=True):
+        path = os.path.join(self.tmp_dir, "track.bw")
+        with BigWigWriter(path, self.sizes.items(), compress) as bigwig:
+            # contigs are written in name order whatever the order they come in
+            for contig in reversed(list(self.data)):
+                bigwig.add(contig, *self.data[contig])
+        return path
+
+    def test_intervals(self):
+        for compress in (True, False):
+            bw = pyBigWig.open(self._write(compress))
+            try:
+                self.assertTrue(bw.isBigWig())
+                self.assertEqual(bw.chroms(), self.sizes)
+                for contig, (starts, ends, values) in self.data.items():
+                    self.assertEqual(bw.intervals(contig),
+                                     tuple(zip(starts.tolist(), ends.tolist(), values.tolist())))
+                    size = self.sizes[contig]
+                    for _ in range(20):
+                        start = random.randrange(size)
+                        end = min(start + 50000, size)
+                        expected = tuple((s, e, v) for s, e, v in
+                                         zip(starts.tolist(), ends.tolist(), values.tolist())
+                                         if s < end and e > start)
+                        self.assertEqual(bw.intervals(contig, start, end) or (), expected)
+            finally:
+                bw.close()
+
+    def test_zoom_levels(self):
+        bw = pyBigWig.open(self._write())
+        try:
+            self.assertGreater(bw.header()["nLevels"], 0)
+            for contig in self.data:
+                size = self.sizes[contig]
+                for stat in ("mean", "max", "min", "coverage"):
+                    # bins aligned to the zoom levels are answered from them
+                    for reduction in (size, 160000, 640000):
+                        nbins = size // reduction
+                        if not nbins:
+                            continue
+                        end = nbins * reduction
+                        zoomed = bw.stats(contig, 0, end, type=stat, nBins=nbins)
+                        exact = bw.stats(contig, 0, end, type=stat, nBins=nbins, exact=True)
+                        np.testing.assert_allclose([x or 0 for x in zoomed],
+                                                   [x or 0 for x in exact], rtol=1e-3)
+        finally:
+            bw.close()
+
+    def test_summarise(self):
+        starts = np.array([0, 5, 18])
+        ends = np.array([3, 12, 25])
+        values = np.array([1.0, 2.0, 4.0])
+        bin_starts, bin_ends, bases, mins, maxs, sums, squares = summarise(
+            starts, ends, values, 10, 25)
+        self.assertEqual(bin_starts.tolist(), [0, 10, 20])
+        self.assertEqual(bin_ends.tolist(), [10, 20, 25])
+        self.assertEqual(bases.tolist(), [8, 4, 5])
+        self.assertEqual(mins.tolist(), [1, 2, 4])
+        self.assertEqual(maxs.tolist(), [2, 4, 4])
+        self.assertEqual(sums.tolist(), [13, 12, 20])
+        self.assertEqual(squares.tolist(), [23, 40, 80])
+
+    def test_invalid_intervals(self):
+        bigwig = BigWigWriter(os.path.join(self.tmp_dir, "bad.bw"), [("c0", 100)])
+        with self.assertRaises(ValueError):
+            bigwig.add("c1", [0], [10], [1.0])
+        with self.assertRaises(ValueError):
+            bigwig.add("c0", [90], [110], [1.0])
+        bigwig.add("c0", [0], [10], [1.0])
+        with self.assertRaises(ValueError):
+            bigwig.add("c0", [20], [30], [1.0])
@@ -0,0 +1,69 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from collections import defaultdict
+
+from VariationUtil.Util.GenotypeDensity import GenotypeDensity
+from VariationUtil.Util.GenotypeMatrix import GenotypeMatrixWriter
+
+BINSIZE = 1000
+CALLS = ["0/0", "0/1", "1/1", "1|2", "./.", "0", "1", ".", "0/0/1/1", "1/1/1/1"]
+
+
+def is_het(gt):
+    alleles = gt.replace("|", "/").split("/")
+    alt = sum(allele != "0" for allele in alleles)
+    return "." not in alleles and 0 < alt < len(alleles)
+
+
+class GenotypeDensityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        random.seed(8)
+        self.samples = ["s" + str(i) for i in range(6)]
+        self.rows = list()
+        for contig in ("chr1", "chr2"):
+            for pos in sorted(random.sample(range(1, 20000), 400)):
+                self.rows.append((contig, pos, [random.choice(CALLS) for _ in self.samples]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rates(self):
+        selected = ["s4", "s1"]
+        density = GenotypeDensity(selected, BINSIZE)
+        writer = GenotypeMatrixWriter(os.path.join(self.tmp_dir, "genotypes.npz"),
+                                      chunk_rows=64, density=density)
+        writer.set_samples(self.samples)
+        for contig, pos, calls in self.rows:
+            writer.add(contig + "\t" + str(pos) + "\t.\tA\tT,G\t.\tPASS\t.\tGT\t"
+                       + "\t".join(calls) + "\n")
+        writer.close(self.samples)
+
+        for sample in selected:
+            column = self.samples.index(sample)
+            totals, hets, missing = defaultdict(int), defaultdict(int), defaultdict(int)
+            for contig, pos, calls in self.rows:
+                key = (contig, (pos - 1) // BINSIZE * BINSIZE)
+                totals[key] += 1
+                hets[key] += is_het(calls[column])
+                missing[key] += "." in calls[column]
+            expected_het = {key: hets[key] / (totals[key] - missing[key])
+                            if totals[key] > missing[key] else 0.0 for key in totals}
+            expected_missing = {key: missing[key] / totals[key] for key in totals}
+            for kind, expected in (("het", expected_het), ("missing", expected_missing)):
+                rates = dict()
+                for contig, starts, ends, values in density.arrays(sample, kind):
+                    for start, value in zip(starts.tolist(), values.tolist()):
+                        rates[(contig, start)] = value
+                self.assertEqual(set(rates), set(expected))
+                for key, value in expected.items():
+                    self.assertAlmostEqual(rates[key], value, msg=sample + " " + kind)
+
+    def test_unknown_sample(self):
+        density = GenotypeDensity(["x"])
+        with self.assertRaises(ValueError):
+            density.select(["a", "b"])
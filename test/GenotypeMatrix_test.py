@@ -0,0 +1,110 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from VariationUtil.Util.GenotypeMatrix import (GenotypeMatrix, GenotypeMatrixWriter,
+                                               pack_codes, unpack_codes)
+
+small_poplar_vcf_gz = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "sample_data", "small_poplar", "small_poplar.vcf.gz")
+
+
+def record(pos, calls, fmt="GT"):
+    return "chr1\t" + str(pos) + "\t.\tA\tT,G\t.\tPASS\t.\t" + fmt + "\t" + "\t".join(calls) + "\n"
+
+
+def dosage(gt):
+    """
+    Expected code of a GT call, None for missing
+    """
+    alleles = gt.replace("|", "/").split("/")
+    if "." in alleles:
+        return None
+    return sum(allele != "0" for allele in alleles)
+
+
+class GenotypeMatrixTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "genotypes.npz")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _round_trip(self, rows, samples, chunk_rows=3):
+        writer = GenotypeMatrixWriter(self.path, chunk_rows=chunk_rows)
+        writer.set_samples(samples)
+        for row in rows:
+            writer.add(row)
+        writer.close(samples)
+        matrix = GenotypeMatrix(self.path)
+        self.assertEqual(matrix.samples, samples)
+        self.assertEqual(matrix.meta["n_variants"], len(rows))
+        return [(codes, missing) for codes, missing in matrix.chunks()]
+
+    def _check(self, chunks, calls):
+        codes = np.vstack([c for c, _ in chunks])
+        missing = np.vstack([m for _, m in chunks])
+        for i, row in enumerate(calls):
+            for j, gt in enumerate(row):
+                expected = dosage(gt)
+                self.assertEqual(bool(missing[i, j]), expected is None, gt)
+                if expected is not None:
+                    self.assertEqual(int(codes[i, j]), expected, gt)
+
+    def test_pack_unpack(self):
+        np.random.seed(2)
+        for bits in (2, 4, 8):
+            for samples in (1, 3, 8, 13):
+                codes = np.random.randint(0, 1 << bits, (7, samples)).astype(np.uint8)
+                packed = pack_codes(codes, bits)
+                self.assertEqual(packed.shape[1], -(-samples * bits // 8))
+                np.testing.assert_array_equal(unpack_codes(packed, bits, samples), codes)
+
+    def test_round_trip_mixed_ploidy(self):
+        random.seed(3)
+        samples = ["s" + str(i) for i in range(7)]
+        choices = ["0/0", "0/1", "1/1", "0|1", "1|2", "./.", ".", "1", "0", "0/1/1/1",
+                   "2/2/2/2", "0/0/0/0/0/0/0/0/0/1"]
+        calls = [[random.choice(choices[:6]) for _ in samples] for _ in range(5)]
+        calls += [[random.choice(choices) for _ in samples] for _ in range(6)]
+        rows = [record(i + 1, row) for i, row in enumerate(calls)]
+        chunks = self._round_trip(rows, samples)
+        self._check(chunks, calls)
+
+    def test_format_fields(self):
+        samples = ["a", "b", "c"]
+        rows = [record(1, ["0/1:3", "1/1:4", "./.:0"], "GT:DP"),
+                record(2, ["3:0/1", "4:1/1", "5"], "DP:GT"),
+                record(3, ["0/1", "1/1", "0/0"])]
+        chunks = self._round_trip(rows, samples)
+        self._check(chunks, [["0/1", "1/1", "./."], ["0/1", "1/1", "."], ["0/1", "1/1", "0/0"]])
+
+    def test_missing_gt(self):
+        samples = ["a", "b"]
+        rows = [record(1, ["3", "4"], "DP"),
+                record(2, ["0/1", "1/1"]),
+                record(3, ["3:7", "4:8"], "DP:GQ")]
+        chunks = self._round_trip(rows, samples, chunk_rows=2)
+        self._check(chunks, [[".", "."], ["0/1", "1/1"], [".", "."]])
+
+    def test_sites_only(self):
+        writer = GenotypeMatrixWriter(self.path)
+        writer.add("chr1\t1\t.\tA\tT\t.\tPASS\t.\n")
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_small_poplar(self):
+        with gzip.open(small_poplar_vcf_gz, "rt") as f:
+            lines = f.readlines()
+        samples = [line for line in lines if line.startswith("#CHROM")][0].rstrip().split("\t")[9:]
+        rows = [line for line in lines if not line.startswith("#")]
+        chunks = self._round_trip(rows, samples, chunk_rows=100)
+        calls = [[call.split(":")[0] for call in row.rstrip("\n").split("\t")[9:]]
+                 for row in rows]
+        self._check(chunks, calls)
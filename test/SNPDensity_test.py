@@ -0,0 +1,76 @@
+import random
+import unittest
+from collections import Counter
+
+import numpy as np
+
+from VariationUtil.Util import SNPDensity as density_module
+from VariationUtil.Util.SNPDensity import SNPDensity
+
+BINSIZES = (1000, 10000, 100000)
+
+
+class SNPDensityTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(7)
+        self.variants = list()
+        for contig in ("chr2", "chr1", "chr10"):
+            positions = sorted(random.randrange(0, 2000000) for _ in range(20000))
+            self.variants += [(contig, pos) for pos in positions]
+        self.lengths = {"chr1": 2000000, "chr2": 1999999, "chr10": 2500000}
+
+    def _expected(self, binsize):
+        counts = Counter((contig, pos // binsize) for contig, pos in self.variants)
+        return sorted(counts.items())
+
+    def _intervals(self, density, binsize, lengths=None):
+        return [((contig, start // binsize), count) for contig, start, end, count
+                in density.intervals(binsize, lengths)]
+
+    def test_add(self):
+        # small buffers so that counts of a contig are flushed several times
+        flush_size = density_module.FLUSH_SIZE
+        density_module.FLUSH_SIZE = 1000
+        try:
+            density = SNPDensity(BINSIZES)
+            for contig, pos in self.variants:
+                density.add(contig, pos)
+        finally:
+            density_module.FLUSH_SIZE = flush_size
+        self.assertEqual(density.contigs(), ["chr1", "chr10", "chr2"])
+        for binsize in BINSIZES:
+            self.assertEqual(self._intervals(density, binsize), self._expected(binsize))
+
+    def test_add_positions_and_merge(self):
+        density = SNPDensity(BINSIZES)
+        merged = SNPDensity(BINSIZES)
+        for contig in ("chr2", "chr1", "chr10"):
+            positions = np.array([pos for c, pos in self.variants if c == contig])
+            half = len(positions) // 2
+            density.add_positions(contig, positions)
+            # two regions of a contig counted separately, as in VCFRegions
+            for part in (positions[:half], positions[half:]):
+                region = SNPDensity(BINSIZES)
+                region.add_positions(contig, part)
+                merged.merge(contig, region.contig_counts(contig))
+        for binsize in BINSIZES:
+            self.assertEqual(self._intervals(density, binsize), self._expected(binsize))
+            self.assertEqual(self._intervals(merged, binsize), self._expected(binsize))
+
+    def test_clipped_to_contig_length(self):
+        density = SNPDensity(BINSIZES)
+        for contig, pos in self.variants:
+            density.add(contig, pos)
+        for contig, start, end, count in density.intervals(100000, self.lengths):
+            self.assertLessEqual(end, self.lengths[contig])
+            self.assertLess(start, end)
+        last = [end for contig, start, end, count in density.intervals(100000, self.lengths)
+                if contig == "chr2"][-1]
+        self.assertEqual(last, 1999999)
+
+    def test_unknown_binsize(self):
+        density = SNPDensity(BINSIZES)
+        density.add("chr1", 10)
+        with self.assertRaises(ValueError):
+            density.counts("chr1", 500)
@@ -0,0 +1,85 @@
+import threading
+import time
+import unittest
+
+from VariationUtil.Util.StageScheduler import StageScheduler, check_cancelled
+
+
+class StageSchedulerTest(unittest.TestCase):
+
+    def test_results_and_dependencies(self):
+        stages = StageScheduler()
+        stages.add("a", lambda: 1)
+        stages.add("b", lambda: 2)
+        stages.add("c", lambda a, b: a + b, after=("a", "b"))
+        stages.add("d", lambda c: c * 10, after=("c",))
+        self.assertEqual(stages.run(), {"a": 1, "b": 2, "c": 3, "d": 30})
+        self.assertEqual(set(stages.timings), {"a", "b", "c", "d"})
+
+    def test_independent_stages_run_together(self):
+        barrier = threading.Barrier(2, timeout=5)
+        stages = StageScheduler()
+        # each stage waits for the other one, this only passes if both run at once
+        stages.add("a", barrier.wait)
+        stages.add("b", barrier.wait)
+        results = stages.run()
+        self.assertEqual(sorted(results.values()), [0, 1])
+
+    def test_invalid_graphs(self):
+        stages = StageScheduler()
+        stages.add("a", lambda: 1)
+        with self.assertRaises(ValueError):
+            stages.add("a", lambda: 1)
+        stages.add("b", lambda x: 1, after=("x",))
+        with self.assertRaisesRegex(ValueError, "unknown stage"):
+            stages.run()
+
+        stages = StageScheduler()
+        stages.add("a", lambda b: 1, after=("b",))
+        stages.add("b", lambda a: 1, after=("a",))
+        with self.assertRaisesRegex(ValueError, "dependency cycle"):
+            stages.run()
+
+    def test_failure_is_raised_without_waiting(self):
+        started = threading.Event()
+        stopped = threading.Event()
+        dependent_ran = threading.Event()
+        stages = StageScheduler()
+
+        def long_stage():
+            started.set()
+            try:
+                for _ in range(500):
+                    time.sleep(0.01)
+                    check_cancelled(stages.cancelled)
+                return "done"
+            finally:
+                stopped.set()
+
+        def failing_stage():
+            started.wait(5)
+            raise ValueError("bad input")
+
+        def dependent_stage(long, failing):
+            dependent_ran.set()
+
+        stages.add("long", long_stage)
+        stages.add("failing", failing_stage)
+        stages.add("dependent", dependent_stage, after=("long", "failing"))
+
+        start = time.time()
+        with self.assertRaisesRegex(ValueError, "bad input"):
+            stages.run()
+        # the long stage takes 5 seconds unless it is cancelled
+        self.assertLess(time.time() - start, 2)
+        self.assertTrue(stages.cancelled.is_set())
+        self.assertTrue(stopped.wait(2))
+        self.assertFalse(dependent_ran.is_set())
+
+    def test_check_cancelled(self):
+        check_cancelled(None)
+        cancelled = threading.Event()
+        check_cancelled(cancelled)
+        cancelled.set()
+        with self.assertRaises(RuntimeError):
+            check_cancelled(cancelled)
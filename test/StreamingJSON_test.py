@@ -0,0 +1,79 @@
+import io
+import json
+import unittest
+
+from VariationUtil.Util import StreamingJSON as streaming_module
+from VariationUtil.Util.StreamingJSON import StreamingJSONWriter
+
+
+class VariantStream(list):
+    """
+    List subclass without items of its own that yields variants when
+    iterated, like VCFReaderStream
+    """
+
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+        self.iterations = 0
+
+    def __iter__(self):
+        self.iterations += 1
+        for i in range(self.n):
+            yield {"var": ["chr1", str(i + 1)], "geno": ["0/1", "1/1"]}
+
+
+class StreamingJSONWriterTest(unittest.TestCase):
+
+    def _encode(self, value, **kwargs):
+        handle = io.BytesIO()
+        writer = StreamingJSONWriter(handle, **kwargs)
+        writer.write(value)
+        self.assertEqual(writer.bytes_written, len(handle.getvalue()))
+        return handle.getvalue(), writer
+
+    def test_plain_values(self):
+        value = {"a": [1, 2.5, None, True, "x\"y", {"b": ("c", "d")}], "é": {}, "e": []}
+        data, _ = self._encode(value)
+        self.assertEqual(json.loads(data), json.loads(json.dumps(value)))
+
+    def test_sets(self):
+        data, _ = self._encode({"a": {3}})
+        self.assertEqual(json.loads(data), {"a": [3]})
+
+    def test_streamed_lists(self):
+        batch_size = streaming_module.BATCH_SIZE
+        streaming_module.BATCH_SIZE = 7
+        try:
+            for n in (0, 1, 7, 50):
+                variants = VariantStream(n)
+                value = {"objects": [{"data": {"variation_details": variants,
+                                               "numvariants": n},
+                                      "name": "v"}],
+                         "genes": (gene for gene in ("g1", "g2"))}
+                data, _ = self._encode(value)
+                decoded = json.loads(data)
+                self.assertEqual(decoded["objects"][0]["data"]["variation_details"],
+                                 list(VariantStream(n)))
+                self.assertEqual(decoded["genes"], ["g1", "g2"])
+                # the stream is iterated once, not held as a list
+                self.assertEqual(variants.iterations, 1)
+        finally:
+            streaming_module.BATCH_SIZE = batch_size
+
+    def test_data_bytes(self):
+        value = {"objects": [{"type": "t", "data": {"x": "a" * 100}},
+                             {"type": "t", "data": {"x": "b" * 50}}]}
+        data, writer = self._encode(value)
+        expected = sum(len(json.dumps(obj["data"])) for obj in value["objects"])
+        self.assertEqual(writer.data_bytes, expected)
+        self.assertLess(writer.data_bytes, writer.bytes_written)
+
+    def test_size_limit_per_object(self):
+        objects = [{"data": {"variation_details": VariantStream(100)}} for _ in range(3)]
+        size = len(json.dumps(objects[0]["data"]))
+        # every object fits, all of them together do not
+        self._encode({"objects": objects}, size_limit=size)
+        with self.assertRaises(ValueError):
+            self._encode({"objects": [{"data": {"variation_details": VariantStream(101)}}]},
+                         size_limit=size)
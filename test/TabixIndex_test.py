@@ -0,0 +1,143 @@
+import gzip
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pysam
+
+from VariationUtil.Util.BGZFReader import BGZFReader
+from VariationUtil.Util.BGZFWriter import BGZFWriter
+from VariationUtil.Util.TabixIndex import TabixIndex
+from VariationUtil.Util.VCFIngest import VCFIngest
+from VariationUtil.Util.VCFUtils import VCFUtils
+
+small_poplar_vcf_gz = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "sample_data", "small_poplar", "small_poplar.vcf.gz")
+
+
+class TabixIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.vcf_utils = VCFUtils({"scratch": self.tmp_dir})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_vcf(self, name, header, records):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, "w") as f:
+            f.writelines(header)
+            f.writelines(records)
+        return path
+
+    def _compress_and_index(self, path):
+        return self.vcf_utils.bgzip_and_index_vcf_file(path, "text", self.tmp_dir,
+                                                       os.path.basename(path) + ".gz")
+
+    @staticmethod
+    def _overlapping(records, contig, start, end):
+        """
+        Records overlapping the 0-based, end exclusive region, by brute force
+        """
+        found = list()
+        for record in records:
+            fields = record.split("\t")
+            beg = int(fields[1]) - 1
+            if fields[0] == contig and beg < end and beg + len(fields[3]) > start:
+                found.append(record.rstrip("\n"))
+        return found
+
+    def _check_fetches(self, vcf_gz, index_path, records, regions):
+        with pysam.TabixFile(vcf_gz, index=index_path) as tabix:
+            for contig, start, end in regions:
+                self.assertEqual(list(tabix.fetch(contig, start, end)),
+                                 self._overlapping(records, contig, start, end),
+                                 contig + ":" + str(start) + "-" + str(end))
+
+    def test_tbi_small_poplar(self):
+        with gzip.open(small_poplar_vcf_gz, "rt") as f:
+            lines = f.readlines()
+        header = [line for line in lines if line.startswith("#")]
+        records = [line for line in lines if not line.startswith("#")]
+        path = self._write_vcf("small_poplar.vcf", header, records)
+
+        vcf_gz, index_path = self._compress_and_index(path)
+        self.assertTrue(index_path.endswith(".tbi"))
+        index = TabixIndex.read(index_path)
+        self.assertEqual(index.names, ["Chr01"])
+        self.assertEqual(index.record_count("Chr01"), len(records))
+
+        random.seed(5)
+        regions = [("Chr01", 0, 100), ("Chr01", 51, 52), ("Chr01", 0, 60000)]
+        for _ in range(50):
+            start = random.randint(0, 55000)
+            regions.append(("Chr01", start, start + random.randint(1, 5000)))
+        self._check_fetches(vcf_gz, index_path, records, regions)
+
+    def test_csi_long_contig(self):
+        header = ["##fileformat=VCFv4.2\n",
+                  "##contig=<ID=chrA,length=900000000>\n",
+                  "##contig=<ID=chrB,length=1000>\n",
+                  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"]
+        random.seed(6)
+        positions = sorted(random.sample(range(1, 800000000), 5000))
+        records = ["chrA\t" + str(pos) + "\t.\t" + "A" * random.randint(1, 30)
+                   + "\tT\t.\tPASS\t.\tGT\t0/1\n" for pos in positions]
+        records += ["chrB\t" + str(pos) + "\t.\tA\tT\t.\tPASS\t.\tGT\t1/1\n"
+                    for pos in range(10, 1000, 10)]
+        path = self._write_vcf("long.vcf", header, records)
+
+        vcf_gz, index_path = self._compress_and_index(path)
+        self.assertTrue(index_path.endswith(".csi"))
+        index = TabixIndex.read(index_path)
+        self.assertEqual(index.names, ["chrA", "chrB"])
+        self.assertEqual(index.record_count("chrA"), len(positions))
+
+        regions = [("chrA", 0, 1 << 29), ("chrA", 1 << 29, 800000000), ("chrB", 0, 1000),
+                   ("chrB", 95, 96)]
+        for _ in range(50):
+            start = random.randint(0, 800000000)
+            regions.append(("chrA", start, start + random.randint(1, 2000000)))
+        self._check_fetches(vcf_gz, index_path, records, regions)
+
+        # regions of a long contig start near their first record, not at the contig
+        offsets = list()
+        for start in range(0, 800000000, 10000000):
+            offset = index.region_offset("chrA", start)
+            offsets.append(offset)
+            with BGZFReader(vcf_gz, 1, offset) as reader:
+                first = int(next(iter(reader)).split("\t")[1]) - 1
+            expected = min(pos - 1 for pos in positions if pos - 1 >= start)
+            self.assertLessEqual(first, expected)
+            self.assertGreater(first, start - 20000000)
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertGreater(len(set(offsets)), 70)
+
+    def test_bgzf_without_final_newline(self):
+        header = ["##fileformat=VCFv4.2\n",
+                  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\ts1\n"]
+        records = ["chr1\t" + str(pos) + "\t.\tA\tT\t.\tPASS\t.\tGT\t0/1\n"
+                   for pos in range(100, 200000, 100)]
+        vcf_gz = os.path.join(self.tmp_dir, "no_newline.vcf.gz")
+        with BGZFWriter(vcf_gz) as writer:
+            writer.write("".join(header + records).rstrip("\n").encode())
+
+        ingest = VCFIngest()
+        index_path = self.vcf_utils.index_bgzf_vcf_file(vcf_gz, ingest)
+        self.assertEqual(ingest.total_variants, len(records))
+        index = TabixIndex.read(index_path)
+        self.assertEqual(index.record_count("chr1"), len(records))
+        self._check_fetches(vcf_gz, index_path, records,
+                            [("chr1", 199800, 200000), ("chr1", 0, 200000)])
+
+    def test_unsorted_vcf(self):
+        header = ["##fileformat=VCFv4.2\n",
+                  "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"]
+        records = ["chr1\t20\t.\tA\tT\t.\tPASS\t.\n",
+                   "chr1\t10\t.\tA\tT\t.\tPASS\t.\n"]
+        path = self._write_vcf("unsorted.vcf", header, records)
+        with self.assertRaises(RuntimeError):
+            self._compress_and_index(path)
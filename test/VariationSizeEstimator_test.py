@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from VariationUtil.Util import VariationSizeEstimator as estimator_module
+from VariationUtil.Util.BGZFWriter import BGZFWriter, BLOCK_SIZE, bgzip_file
+from VariationUtil.Util.VariationSizeEstimator import VariationSizeEstimator
+
+small_poplar_vcf_gz = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "sample_data", "small_poplar", "small_poplar.vcf.gz")
+
+CALLS = ["0/0:10,0:10:30:0,30,300", "0/1:5,6:11:99:90,0,80", "1/1:0,12:12:36:360,36,0"]
+
+
+class VariationSizeEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_vcf(self, n_samples, n_records):
+        path = os.path.join(self.tmp_dir, "wide.vcf.gz")
+        samples = ["sample" + str(i) for i in range(n_samples)]
+        with BGZFWriter(path) as writer:
+            writer.write(b"##fileformat=VCFv4.2\n")
+            writer.write(("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+                          + "\t".join(samples) + "\n").encode())
+            for i in range(n_records):
+                calls = [CALLS[(i + j) % len(CALLS)] for j in range(n_samples)]
+                writer.write(("chr1\t" + str(i + 1) + "\t.\tA\tT\t50\tPASS\t.\t"
+                              + "GT:AD:DP:GQ:PL\t" + "\t".join(calls) + "\n").encode())
+        return path
+
+    def test_records_longer_than_a_block(self):
+        path = self._write_vcf(4000, 60)
+        estimator = VariationSizeEstimator(path)
+        records, compressed = estimator.sample_records()
+        self.assertTrue(records)
+        for record in records:
+            self.assertGreater(len(record), BLOCK_SIZE)
+            self.assertEqual(len(record.split("\t")), 9 + 4000)
+
+        # every variant has 4000 genotypes, 60 of them fit in 1 MB without genotypes only
+        estimate = estimator.estimate(60)
+        self.assertEqual(estimate["sampled_variants"], len(records))
+        self.assertGreater(estimate["bytes_per_variant"]["geno"], 4000 * 5)
+        small = VariationSizeEstimator(path, size_limit=1 << 20)
+        self.assertFalse(small.populate_genos(60))
+        self.assertTrue(VariationSizeEstimator(path).populate_genos(60))
+
+        bytes_per_variant = len(json.dumps({"geno": ["0/0"] * 4000}))
+        per_object = estimator.variants_per_object(32 << 20)
+        self.assertLess(per_object, (32 << 20) / bytes_per_variant)
+        self.assertGreater(per_object, 0)
+
+    def test_no_complete_record(self):
+        path = self._write_vcf(4000, 5)
+        sample_bytes = estimator_module.SAMPLE_BYTES
+        estimator_module.SAMPLE_BYTES = BLOCK_SIZE
+        try:
+            estimator = VariationSizeEstimator(path)
+            records, _ = estimator.sample_records()
+            self.assertEqual(records, [])
+            # nothing is decided from an empty sample
+            self.assertFalse(estimator.populate_genos())
+            self.assertFalse(estimator.populate_genos(5))
+            self.assertEqual(estimator.variants_per_object(32 << 20), (32 << 20) // BLOCK_SIZE)
+        finally:
+            estimator_module.SAMPLE_BYTES = sample_bytes
+
+    def test_small_poplar(self):
+        path = os.path.join(self.tmp_dir, "small_poplar.vcf.gz")
+        bgzip_file(small_poplar_vcf_gz, "gzip", path)
+        estimator = VariationSizeEstimator(path)
+        records, compressed = estimator.sample_records()
+        self.assertGreater(len(records), 0)
+        self.assertGreater(compressed, 0)
+        self.assertEqual(len(records), len(set(records)))
+        for record in records:
+            self.assertFalse(record.startswith("#"))
+            self.assertEqual(record.split("\t")[0][:3], "Chr")